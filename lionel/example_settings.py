@@ -85,6 +85,65 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# File previews and choice lists are cached. With more than one worker process use a shared backend
+# such as memcached so signal based invalidation reaches every worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Results of deterministic procedures are kept on disk, least recently used first out once the limit is reached.
+# LIONEL_RESULT_CACHE_DIR defaults to results/ under MEDIA_ROOT.
+
+LIONEL_RESULT_CACHE_SIZE = 1024 ** 3
+
+# Profiling, loading and procedure runs reserve their estimated memory from a budget shared by every process on the
+# node, work that doesn't fit queues or, for profiling, falls back to reading the file in chunks. The budget defaults
+# to half of physical memory and LIONEL_ADMISSION_LEDGER, where reservations are kept, to a file in the temp dir.
+
+LIONEL_MEMORY_BUDGET = None
+LIONEL_ADMISSION_TIMEOUT = 300
+
+# Memory the set of row hashes may use when a feed drops duplicates on load, past this it spills to disk.
+
+LIONEL_DEDUP_MEMORY = 64 * 1024 ** 2
+
+
+# Connections a large upload is loaded over at once, a number or a dict of database vendor to number. SQLite always
+# loads over one.
+
+LIONEL_LOAD_PARALLELISM = {'postgresql': 4, 'oracle': 4, 'mysql': 2}
+
+
+# Feed inboxes are only watched under the LIONEL_INBOX_ROOTS directories, feeds with an inbox elsewhere are skipped.
+
+LIONEL_INBOX_ROOTS = []
+
+
+# The JSON API. Each request may hold up to LIONEL_API_BATCH_LIMIT items, and files are only read from the server's
+# disk under the LIONEL_API_PATHS directories.
+
+LIONEL_API_BATCH_LIMIT = 1000
+LIONEL_API_PATHS = []
+
+
+# Procedure runs. At most LIONEL_RUN_WORKERS go at once per process, taking turns between feeds by their priority and
+# weight, runs queued through the API are carried out by that many threads, 0 runs them in the request. Each run's
+# process is limited to LIONEL_RUN_CPU_SECONDS of CPU, LIONEL_RUN_MEMORY bytes and LIONEL_RUN_WALL_SECONDS, unless its
+# feed sets its own limits, None for no limit. A run still waiting for its turn after LIONEL_RUN_QUEUE_TIMEOUT seconds
+# fails.
+
+LIONEL_RUN_WORKERS = 4
+LIONEL_RUN_QUEUE_TIMEOUT = 300
+LIONEL_RUN_CPU_SECONDS = None
+LIONEL_RUN_MEMORY = None
+LIONEL_RUN_WALL_SECONDS = 3600
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
 
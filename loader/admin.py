@@ -1,5 +1,18 @@
 from django.contrib import admin
-from loader.models import Feed, File, Column, Procedure
+from django.core.urlresolvers import reverse
+from django.utils.html import format_html
+
+from loader import metrics
+from loader.models import (ApiToken, Feed, File, Column, KeyIndex, Procedure, ProcedureRun, ProfileCapture,
+                           ProfileSwitch, SchemaDrift, StageMetric)
+
+
+class SchemaDriftInline(admin.TabularInline):
+    model = SchemaDrift
+    fields = ['file', 'detected', 'changes', 'blocked']
+    readonly_fields = ['file', 'detected', 'changes', 'blocked']
+    extra = 0
+    can_delete = False
 
 
 class FeedAdmin(admin.ModelAdmin):
@@ -7,9 +20,35 @@ class FeedAdmin(admin.ModelAdmin):
         (None,
          {'fields': ['name',
                      'users']}
+         ),
+        ('Schema',
+         {'fields': ['block_on_drift',
+                     'schema']}
+         ),
+        ('Intake',
+         {'fields': ['inbox']}
+         ),
+        ('Load',
+         {'fields': ['dedup',
+                     'dedup_keep']}
+         ),
+        ('Retention',
+         {'fields': ['compress_after',
+                     'compression',
+                     'prune_after']}
+         ),
+        ('Scheduling',
+         {'fields': ['priority',
+                     'weight',
+                     'max_runs',
+                     'cpu_limit',
+                     'memory_limit',
+                     'wall_limit']}
          )
     ]
-    list_display = ('name',)
+    readonly_fields = ('schema',)
+    list_display = ('name', 'priority', 'weight', 'max_runs')
+    inlines = [SchemaDriftInline]
 
 
 class FileAdmin(admin.ModelAdmin):
@@ -21,7 +60,12 @@ class FileAdmin(admin.ModelAdmin):
          )
     ]
 
-    list_display = ['user', 'upload_date', 'data']
+    list_display = ['user', 'feed', 'upload_date', 'data']
+    list_select_related = ('user', 'feed')
+    list_filter = ('feed',)
+    ordering = ('-upload_date',)
+    raw_id_fields = ('user', 'feed')
+    show_full_result_count = False  # Counting every upload on each page load is the slowest part of the list.
 
 
 class ColumnAdmin(admin.ModelAdmin):
@@ -29,9 +73,86 @@ class ColumnAdmin(admin.ModelAdmin):
         (None,
          {'fields': ['name',
                      'col_type']}
+         ),
+        ('Validation',
+         {'fields': ['required',
+                     'min_value',
+                     'max_value',
+                     'pattern',
+                     'allowed']}
          )
     ]
-    list_display = ('name', 'col_type',)
+    list_display = ('name', 'col_type', 'required',)
+
+
+def accept_drifted_files(modeladmin, request, queryset):
+    """
+    Accept the files behind the selected drifts as the new schema for their feeds.
+    """
+    for drift in queryset.select_related('file', 'feed').order_by('detected'):
+        drift.file.accept()
+        drift.blocked = False
+        drift.save()
+
+accept_drifted_files.short_description = 'Accept the new layout of the selected files'
+
+
+class SchemaDriftAdmin(admin.ModelAdmin):
+    list_display = ('file', 'feed', 'detected', 'blocked')
+    list_filter = ('blocked', 'feed')
+    readonly_fields = ('feed', 'file', 'detected', 'changes')
+    actions = [accept_drifted_files]
+
+
+class StageMetricAdmin(admin.ModelAdmin):
+    list_display = ('stage', 'feed', 'file', 'procedure', 'started', 'duration', 'rows', 'bytes', 'success')
+    list_filter = ('stage', 'success', 'feed')
+    list_select_related = ('feed', 'file', 'procedure')
+    show_full_result_count = False
+
+    def changelist_view(self, request, extra_context=None):
+        """
+        Show per feed, per stage percentiles above the list of measurements.
+        """
+        extra_context = extra_context or {}
+        extra_context['summaries'] = metrics.summarise()
+        extra_context['window_hours'] = metrics.WINDOW // 3600
+
+        return super(StageMetricAdmin, self).changelist_view(request, extra_context)
+
+
+class ProfileSwitchAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'user', 'feed', 'url_pattern', 'active', 'remaining', 'created')
+    list_filter = ('active',)
+    raw_id_fields = ('user', 'feed')
+
+
+class ProfileCaptureAdmin(admin.ModelAdmin):
+    list_display = ('target', 'user', 'feed', 'created', 'duration', 'download')
+    list_select_related = ('user', 'feed')
+    readonly_fields = ('switch', 'target', 'user', 'feed', 'created', 'duration', 'download', 'report_text',
+                       'allocations_text')
+    fields = readonly_fields
+
+    def download(self, obj):
+        """
+        Link to the pstats dump.
+        """
+        return format_html('<a href="{}">pstats</a>', reverse('loader:download_profile', kwargs={'pk': obj.pk}))
+
+    def report_text(self, obj):
+        """
+        Show the profile report preformatted.
+        """
+        return format_html('<pre>{}</pre>', obj.report)
+    report_text.short_description = 'Top functions'
+
+    def allocations_text(self, obj):
+        """
+        Show the allocation report preformatted.
+        """
+        return format_html('<pre>{}</pre>', obj.allocations)
+    allocations_text.short_description = 'Top allocations'
 
 
 class ProcedureAdmin(admin.ModelAdmin):
@@ -40,12 +161,70 @@ class ProcedureAdmin(admin.ModelAdmin):
          {'fields': ['name',
                      'language',
                      'comments',
-                     'procedure']}
+                     'procedure',
+                     'deterministic']}
          )
     ]
-    list_display = ('name', 'language', 'comments')
+    list_display = ('name', 'language', 'comments', 'deterministic')
+
+class KeyIndexAdmin(admin.ModelAdmin):
+    fields = ['file', 'column', 'position', 'count', 'bits', 'hashes', 'keys', 'created']
+    readonly_fields = fields
+    list_display = ('file', 'column', 'position', 'count', 'created')
+    list_select_related = ('file', 'column')
+    list_filter = ('column',)
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        """
+        Indexes are only ever built from files.
+
+        :return: bool, False.
+        """
+        return False
+
+class ProcedureRunAdmin(admin.ModelAdmin):
+    fields = ['procedure', 'file', 'user', 'args', 'force', 'status', 'queued', 'started', 'finished', 'exit_code',
+              'cached', 'artifacts', 'error', 'output']
+    readonly_fields = fields
+    list_display = ('procedure', 'file', 'user', 'status', 'queued', 'finished', 'exit_code', 'cached')
+    list_select_related = ('procedure', 'file', 'user')
+    list_filter = ('status', 'procedure')
+    show_full_result_count = False
+
+    def has_add_permission(self, request):
+        """
+        Runs are only ever queued through the API.
+
+        :return: bool, False.
+        """
+        return False
+
+
+class ApiTokenAdmin(admin.ModelAdmin):
+    fields = ['name', 'user', 'active', 'created', 'last_used']
+    readonly_fields = ['name', 'user', 'created', 'last_used']
+    list_display = ('name', 'user', 'active', 'created', 'last_used')
+    list_select_related = ('user',)
+    list_filter = ('active',)
+
+    def has_add_permission(self, request):
+        """
+        Tokens are issued by the issue_token command, the only time their key is shown.
+
+        :return: bool, False.
+        """
+        return False
+
 
+admin.site.register(ApiToken, ApiTokenAdmin)
 admin.site.register(Feed, FeedAdmin)
 admin.site.register(File, FileAdmin)
+admin.site.register(KeyIndex, KeyIndexAdmin)
 admin.site.register(Column, ColumnAdmin)
 admin.site.register(Procedure, ProcedureAdmin)
+admin.site.register(ProcedureRun, ProcedureRunAdmin)
+admin.site.register(SchemaDrift, SchemaDriftAdmin)
+admin.site.register(StageMetric, StageMetricAdmin)
+admin.site.register(ProfileSwitch, ProfileSwitchAdmin)
+admin.site.register(ProfileCapture, ProfileCaptureAdmin)
@@ -0,0 +1,289 @@
+"""
+Node wide memory admission control for heavy work.
+
+Profiling, loading, key indexing and procedure runs reserve an estimate of the memory they need from a budget shared by every
+process on the node. The reservations live in a small JSON ledger guarded by an fcntl lock, entries left by processes
+which have died are dropped the next time anyone looks. Work which doesn't fit waits for memory to free up, or, where
+there is a lighter way of doing it (e.g. profiling in chunks rather than from one DataFrame), is downgraded to that.
+"""
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+
+from loader import keyindex, loading, readers
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SHARE = 0.5  # Fraction of physical memory budgeted when LIONEL_MEMORY_BUDGET isn't set.
+
+DEFAULT_TIMEOUT = 300  # Seconds to wait for memory before giving up.
+
+POLL_INTERVAL = 0.5
+
+# Rough in-memory cost of one value of each stored column type in a pandas DataFrame.
+NUMBER_BYTES = 8
+STRING_OVERHEAD = 50  # A Python str object costs around this much on top of its characters.
+
+COMPRESSION_RATIO = 5  # Assumed expansion of compressed uploads.
+
+DEFAULT_ROW_BYTES = 100  # Assumed row length when there's no sample to go on.
+
+DEFAULT_VALUE_BYTES = 20  # Assumed length of a value of unknown type.
+
+PROFILE_OVERHEAD = 2  # Profiling holds the frame plus intermediate copies for nunique and isnull.
+
+
+class AdmissionError(Exception):
+    """
+    Work could not get the memory it needs.
+    """
+
+
+def budget():
+    """
+    :return: int, bytes of memory heavy work may reserve on this node, LIONEL_MEMORY_BUDGET or half of physical memory.
+    """
+    configured = getattr(settings, 'LIONEL_MEMORY_BUDGET', None)
+
+    if configured:
+        return int(configured)
+
+    try:
+        return int(os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') * DEFAULT_SHARE)
+    except (ValueError, OSError, AttributeError):
+        return 4 * 1024 ** 3
+
+
+def ledger_path():
+    """
+    :return: str, the ledger shared by every process on the node, LIONEL_ADMISSION_LEDGER or one in the temp dir.
+    """
+    return getattr(settings, 'LIONEL_ADMISSION_LEDGER', None) or os.path.join(tempfile.gettempdir(),
+                                                                             'lionel-admission.json')
+
+
+def _alive(pid):
+    """
+    :param pid: int, a process id.
+    :return: bool, is the process still running?
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+@contextlib.contextmanager
+def _ledger():
+    """
+    Lock the ledger and yield its reservations, any changes made to the dict are written back.
+
+    :return: context manager yielding a dict of reservation id to reservation.
+    """
+    path = ledger_path()
+
+    with open(path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            try:
+                with open(path) as ledger_file:
+                    reservations = json.load(ledger_file)
+            except (OSError, ValueError):
+                reservations = {}
+
+            # Drop reservations of processes that died without releasing them.
+            reservations = {key: value for key, value in reservations.items() if _alive(value['pid'])}
+
+            yield reservations
+
+            temporary = '{}.{}'.format(path, os.getpid())
+
+            with open(temporary, 'w') as ledger_file:
+                json.dump(reservations, ledger_file)
+
+            os.replace(temporary, path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def in_use():
+    """
+    :return: int, bytes currently reserved on the node.
+    """
+    with _ledger() as reservations:
+        return sum(value['bytes'] for value in reservations.values())
+
+
+def try_reserve(operation, size):
+    """
+    Reserve memory if it fits in what's left of the budget.
+
+    Work is always admitted when nothing else holds a reservation, so a single job bigger than the budget runs alone
+    rather than never.
+
+    :param operation: str, what the memory is for.
+    :param size: int, bytes wanted.
+    :return: str or None, the reservation id, None if it didn't fit.
+    """
+    with _ledger() as reservations:
+        used = sum(value['bytes'] for value in reservations.values())
+
+        if reservations and used + size > budget():
+            return None
+
+        key = uuid.uuid4().hex
+        reservations[key] = {'pid': os.getpid(), 'bytes': size, 'operation': operation, 'since': time.time()}
+
+        return key
+
+
+def release(key):
+    """
+    :param key: str, a reservation id from try_reserve.
+    """
+    with _ledger() as reservations:
+        reservations.pop(key, None)
+
+
+class Ticket(object):
+    """
+    Admission to run a piece of work.
+    """
+
+    def __init__(self, operation, size, downgraded):
+        self.operation = operation
+        self.size = size
+        self.downgraded = downgraded
+
+
+@contextlib.contextmanager
+def admit(operation, size, fallback=None, timeout=None):
+    """
+    Wait for memory to run a piece of work.
+
+    Work with a lighter way of doing it is downgraded straight away rather than kept waiting, other work queues until
+    its memory is free.
+
+    :param operation: str, what the work is, e.g. profile.
+    :param size: int, estimated bytes the work needs.
+    :param fallback: int, bytes a lighter way of doing the work needs, None if there isn't one.
+    :param timeout: float, seconds to wait, LIONEL_ADMISSION_TIMEOUT by default.
+    :return: context manager yielding a Ticket, whose downgraded flag says to take the lighter way.
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'LIONEL_ADMISSION_TIMEOUT', DEFAULT_TIMEOUT)
+
+    never_fits = size > budget()
+    deadline = time.monotonic() + timeout
+
+    while True:
+        # The full way if it fits now, otherwise the lighter way if there is one, otherwise queue.
+        key = None if never_fits and fallback is not None else try_reserve(operation, size)
+        downgraded = key is None and fallback is not None
+
+        if downgraded:
+            key = try_reserve(operation, fallback)
+
+        if key is not None:
+            break
+
+        if time.monotonic() >= deadline:
+            raise AdmissionError('No memory for {} ({} bytes) after {}s.'.format(operation, size, timeout))
+
+        time.sleep(POLL_INTERVAL)
+
+    if downgraded:
+        logger.info('Running %s the lighter way, %s bytes would not fit', operation, size)
+
+    try:
+        yield Ticket(operation, fallback if downgraded else size, downgraded)
+    finally:
+        release(key)
+
+
+def row_bytes(file):
+    """
+    Average bytes per row of a file, from its sample.
+
+    :param file: File obj, the file.
+    :return: float or None, None if there is no sample.
+    """
+    sample = file.get_sample()
+
+    if not sample:
+        return None
+
+    return sum(len(file.delimiter or ',') * (len(values) - 1) + sum(len(value) for value in values) + 1
+               for _, values in sample) / len(sample)
+
+
+def estimate_rows(file):
+    """
+    Estimate how many rows a file has.
+
+    :param file: File obj, the file.
+    :return: int, estimated rows.
+    """
+    size = file.data.size
+
+    if readers.is_compressed(file.data.path):
+        size *= COMPRESSION_RATIO
+
+    return int(size / max(row_bytes(file) or DEFAULT_ROW_BYTES, 1)) + 1
+
+
+def value_bytes(col_type):
+    """
+    :param col_type: str or None, a stored column type.
+    :return: int, estimated bytes per value in a DataFrame.
+    """
+    if col_type in ('number', 'date'):
+        return NUMBER_BYTES
+
+    if col_type and col_type.startswith('varchar'):
+        try:
+            return int(col_type[col_type.index('(') + 1:-1]) + STRING_OVERHEAD
+        except ValueError:
+            pass
+
+    return DEFAULT_VALUE_BYTES + STRING_OVERHEAD
+
+
+def estimate(file, operation):
+    """
+    Estimate the memory an operation on a file needs, from its size, sample and stored column types.
+
+    :param file: File obj, the file.
+    :param operation: str, one of
+                      profile, the whole file in a DataFrame plus working copies;
+                      chunked, the same work a chunk of rows at a time;
+                      load, a batch of rows being inserted;
+                      index, a run of keys being sorted for the key index;
+                      procedure, a procedure holding the whole file.
+    :return: int, estimated bytes.
+    """
+    types = file.get_column_types() or [None] * max(file.reader().width, 1)
+    per_row = sum(value_bytes(col_type) for col_type in types) + NUMBER_BYTES  # Plus the index.
+
+    if operation == 'profile':
+        return per_row * estimate_rows(file) * PROFILE_OVERHEAD
+    if operation == 'chunked':
+        return per_row * min(readers.CHUNK_SIZE, estimate_rows(file)) * PROFILE_OVERHEAD
+    if operation == 'load':
+        return per_row * min(loading.BATCH_SIZE, estimate_rows(file))
+    if operation == 'index':
+        return per_row * min(keyindex.RUN_KEYS, estimate_rows(file))
+
+    return per_row * estimate_rows(file)
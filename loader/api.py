@@ -0,0 +1,313 @@
+"""
+Token authenticated JSON API for scripts driving Lionel in bulk.
+
+Every request carries the key of an ApiToken, issued by the issue_token command, as Authorization: Bearer <key>. Each
+endpoint takes a batch, many uploads, many procedure runs or the status of many files and runs, and answers the whole
+batch with one compact JSON document rather than a rendered page per item:
+
+    POST api/files/   multipart uploads in data and/or local paths, into one feed.
+    POST api/runs/    {"runs": [{"file": 1, "procedure": 2, "args": [], "force": false}, ...]}
+    GET  api/status/  ?files=1,2&runs=3,4, or POST the same as JSON lists.
+
+Procedure runs are queued and carried out in the background, see loader.runs, their progress is polled through the
+status endpoint. Runs left behind by a process which stopped are recovered the first time either endpoint is called.
+"""
+import functools
+import json
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.db import transaction
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+
+from loader import ingest, runs
+from loader.models import ApiToken, Feed, File, Procedure, ProcedureRun
+
+DEFAULT_BATCH_LIMIT = 1000  # Items one request may hold unless LIONEL_API_BATCH_LIMIT says otherwise.
+
+_COMPACT = {'separators': (',', ':')}
+
+
+class ApiError(Exception):
+    """
+    A request the API can't act on, answered with a 400 and the message.
+    """
+
+
+def respond(data, status=200):
+    """
+    :param data: dict, the response document.
+    :param status: int, HTTP status.
+    :return: JsonResponse, the document without needless whitespace.
+    """
+    return JsonResponse(data, status=status, json_dumps_params=_COMPACT)
+
+
+def api_view(view):
+    """
+    Authenticate a request by its token and turn ApiErrors into 400 responses.
+
+    Token requests carry no session, so they are exempt from CSRF checks.
+
+    :param view: function, the view, called with request.user set to the token's user.
+    :return: function, the wrapped view.
+    """
+    @csrf_exempt
+    @functools.wraps(view)
+    def wrapped(request, *args, **kwargs):
+        scheme, _, key = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+        user = ApiToken.authenticate(key.strip()) if scheme == 'Bearer' and key.strip() else None
+
+        if user is None:
+            return respond({'error': 'A valid API token is required.'}, status=401)
+
+        request.user = user
+
+        try:
+            return view(request, *args, **kwargs)
+        except ApiError as error:
+            return respond({'error': str(error)}, status=400)
+
+    return wrapped
+
+
+def batch_limit():
+    """
+    :return: int, the most items one request may hold.
+    """
+    return getattr(settings, 'LIONEL_API_BATCH_LIMIT', DEFAULT_BATCH_LIMIT)
+
+
+def parse_body(request):
+    """
+    :param request: HTTP request.
+    :return: dict, the JSON body, or the form fields for multipart and form requests, lists kept as lists.
+    """
+    if request.content_type == 'application/json':
+        try:
+            body = json.loads(request.body.decode('utf-8') or '{}')
+        except ValueError:
+            raise ApiError('The body is not valid JSON.')
+
+        if not isinstance(body, dict):
+            raise ApiError('The body must be a JSON object.')
+
+        return body
+
+    return {key: values if len(values) > 1 or key == 'paths' else values[0]
+            for key, values in request.POST.lists()}
+
+
+def id_list(value, name):
+    """
+    :param value: list or str, ids as a list or a comma separated string.
+    :param name: str, what the ids are of, for errors.
+    :return: lst[int], the ids.
+    """
+    if value in (None, ''):
+        return []
+
+    if isinstance(value, str):
+        value = value.split(',')
+
+    try:
+        ids = [int(pk) for pk in value]
+    except (TypeError, ValueError):
+        raise ApiError('{} must be a list of ids.'.format(name))
+
+    if len(ids) > batch_limit():
+        raise ApiError('At most {} {} per request.'.format(batch_limit(), name))
+
+    return ids
+
+
+def allowed_path(path):
+    """
+    :param path: str, a path on the server.
+    :return: bool, is it a file under one of the LIONEL_API_PATHS directories?
+    """
+    path = os.path.realpath(path)
+
+    for root in getattr(settings, 'LIONEL_API_PATHS', []):
+        root = os.path.join(os.path.realpath(root), '')
+
+        if path.startswith(root) and os.path.isfile(path):
+            return True
+
+    return False
+
+
+def describe(result):
+    """
+    :param result: ingest.Result, what happened to one file.
+    :return: dict, the parts of it clients need.
+    """
+    described = {'name': os.path.basename(result.path), 'status': result.status}
+
+    if result.file is not None:
+        described['id'] = result.file.pk
+    if result.rows is not None:
+        described['rows'] = result.rows
+    if result.error:
+        described['error'] = result.error
+
+    return described
+
+
+@api_view
+def upload_files(request):
+    """
+    Upload a batch of files into a feed.
+
+    Takes the feed's id as feed, uploads as data and paths of files on the server, under LIONEL_API_PATHS, as paths.
+    load asks for each file to be loaded into its table straight away. Content already in the feed is skipped.
+
+    :param request: HTTP POST request.
+    :return: JsonResponse, files, one entry per upload then per path, each with its status and id.
+    """
+    if request.method != 'POST':
+        raise ApiError('Uploads must be POSTed.')
+
+    body = parse_body(request)
+    uploads = request.FILES.getlist('data')
+    paths = body.get('paths') or []
+
+    if isinstance(paths, str):
+        paths = [paths]
+
+    if not uploads and not paths:
+        raise ApiError('Nothing to upload.')
+
+    if len(uploads) + len(paths) > batch_limit():
+        raise ApiError('At most {} files per request.'.format(batch_limit()))
+
+    try:
+        feed = Feed.objects.get(pk=int(body.get('feed')))
+    except (Feed.DoesNotExist, TypeError, ValueError):
+        raise ApiError('Unknown feed.')
+
+    if not feed.has_user(request.user):
+        raise ApiError('Unknown feed.')
+
+    refused = [path for path in paths if not allowed_path(path)]
+
+    if refused:
+        raise ApiError('Not allowed to read: {}.'.format(', '.join(refused)))
+
+    load = body.get('load') in (True, 'true', '1', 1)
+    ingester = ingest.Ingester(feed, request.user, profile=False, load=load)
+    described = []
+
+    for upload in uploads:
+        # Uploads are written out under their own name, then moved into storage as if they'd been on disk.
+        directory = tempfile.mkdtemp(prefix='lionel-api-')
+
+        try:
+            path = os.path.join(directory, os.path.basename(upload.name) or 'upload')
+
+            with open(path, 'wb') as target:
+                for chunk in upload.chunks():
+                    target.write(chunk)
+
+            described.append(describe(ingester.ingest(path, move=True)))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    for path in paths:
+        described.append(describe(ingester.ingest(path)))
+
+    return respond({'files': described})
+
+
+@api_view
+def queue_runs(request):
+    """
+    Queue a batch of procedure runs.
+
+    :param request: HTTP POST request, a JSON body with runs, each with a file and procedure id and optionally args and
+                    force.
+    :return: JsonResponse, runs, one entry per run asked for, in order, with its id and status or an error.
+    """
+    if request.method != 'POST':
+        raise ApiError('Runs must be POSTed.')
+
+    asked = parse_body(request).get('runs')
+
+    if not isinstance(asked, list) or not asked:
+        raise ApiError('runs must be a list of runs.')
+
+    if len(asked) > batch_limit():
+        raise ApiError('At most {} runs per request.'.format(batch_limit()))
+
+    if not all(isinstance(item, dict) for item in asked):
+        raise ApiError('Each run must be an object.')
+
+    file_ids = id_list([item.get('file') for item in asked], 'files')
+    procedure_ids = id_list([item.get('procedure') for item in asked], 'procedures')
+
+    runs.recover_once(ProcedureRun)
+
+    # One query each for every file and procedure in the batch, the files only from the user's feeds.
+    files = File.objects.select_related('feed', 'user').filter(pk__in=file_ids,
+                                                              feed_id__in=Feed.user_feed_ids(request.user))
+    files = {file.pk: file for file in files}
+    procedures = Procedure.objects.in_bulk(procedure_ids)
+
+    queued = []
+    described = []
+
+    with transaction.atomic():
+        for item, file_id, procedure_id in zip(asked, file_ids, procedure_ids):
+            args = item.get('args') or []
+
+            if file_id not in files:
+                described.append({'error': 'Unknown file.'})
+            elif procedure_id not in procedures:
+                described.append({'error': 'Unknown procedure.'})
+            elif not files[file_id].accepted:
+                described.append({'error': 'The file has drifted from the feed schema and must be accepted first.'})
+            elif not isinstance(args, list):
+                described.append({'error': 'args must be a list.'})
+            else:
+                run = ProcedureRun.objects.create(procedure=procedures[procedure_id], file=files[file_id],
+                                                  user=request.user, args=json.dumps([str(arg) for arg in args]),
+                                                  force=bool(item.get('force')))
+                queued.append(run)
+                described.append({'id': run.pk, 'status': run.status})
+
+    # Only once the runs are committed, the workers look them up on their own connections.
+    for run in queued:
+        runs.submit(run)
+
+    return respond({'runs': described}, status=202)
+
+
+@api_view
+def status(request):
+    """
+    Report on a batch of files and runs.
+
+    :param request: HTTP request, files and runs as comma separated ids on a GET or JSON lists on a POST, output asks
+                    for the stdout of finished runs.
+    :return: JsonResponse, files and runs, each a dict of id to its status, ids the user can't see are left out.
+    """
+    body = request.GET.dict() if request.method == 'GET' else parse_body(request)
+    file_ids = id_list(body.get('files'), 'files')
+    run_ids = id_list(body.get('runs'), 'runs')
+    output = body.get('output') in (True, 'true', '1', 1)
+    feed_ids = Feed.user_feed_ids(request.user)
+
+    runs.recover_once(ProcedureRun)
+
+    files = File.objects.filter(pk__in=file_ids, feed_id__in=feed_ids).values('pk', 'accepted', 'table', 'rejected',
+                                                                            'duplicated', 'upload_date')
+
+    fields = ['pk', 'status', 'exit_code', 'cached', 'error', 'queued', 'started', 'finished'] + (['output'] if output
+                                                                                                 else [])
+    found = ProcedureRun.objects.filter(pk__in=run_ids, file__feed_id__in=feed_ids).values(*fields)
+
+    return respond({'files': {values.pop('pk'): values for values in files},
+                    'runs': {values.pop('pk'): values for values in found}})
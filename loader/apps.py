@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class LoaderConfig(AppConfig):
     name = 'loader'
+
+    def ready(self):
+        """
+        Connect the signal handlers once the models are loaded.
+        """
+        from loader import signals  # noqa: F401
@@ -0,0 +1,167 @@
+"""
+Synthetic feed files and import time measurements for benchmarks and load tests.
+
+Files are generated from a seed so the same options always give the same bytes, which keeps benchmark runs
+comparable with a stored baseline. Import times come from python -X importtime in a fresh interpreter, which is what a
+new worker pays before it can serve anything.
+"""
+import bz2
+import csv
+import datetime
+import gzip
+import io
+import lzma
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+
+TYPES = ('int', 'float', 'str', 'date')
+
+QUOTING = {'minimal': csv.QUOTE_MINIMAL,
+           'all': csv.QUOTE_ALL,
+           'nonnumeric': csv.QUOTE_NONNUMERIC,
+           'none': csv.QUOTE_NONE}
+
+COMPRESSIONS = {'none': open,
+                'gzip': gzip.open,
+                'bz2': bz2.open,
+                'xz': lzma.open}
+
+_EPOCH = datetime.date(2000, 1, 1)
+
+# What a worker imports before it can serve a request.
+WORKER_STARTUP = 'import django; django.setup(); import loader.urls, loader.admin'
+
+HEAVIEST = 10  # Modules listed in an import report.
+
+
+def _value(col_type, row, rand):
+    """
+    Generate one value of a type.
+
+    :param col_type: str, one of TYPES.
+    :param row: int, the row number, the first int column is the row number so files have a key.
+    :param rand: random.Random, source of randomness.
+    :return: object, the value.
+    """
+    if col_type == 'int':
+        return rand.randint(0, 10 ** 9)
+    if col_type == 'float':
+        return round(rand.uniform(-10 ** 6, 10 ** 6), 4)
+    if col_type == 'date':
+        return (_EPOCH + datetime.timedelta(days=rand.randint(0, 9000))).isoformat()
+
+    length = rand.randint(3, 20)
+    return ''.join(rand.choice(string.ascii_letters + ' ,') for _ in range(length))
+
+
+def column_types(width, types=TYPES):
+    """
+    Decide the type of each column by cycling through the requested types.
+
+    :param width: int, number of columns.
+    :param types: tuple[str], types to use.
+    :return: lst[str], the type of each column.
+    """
+    return [types[idx % len(types)] for idx in range(width)]
+
+
+def generate_rows(rows, width, types=TYPES, seed=0):
+    """
+    Generate the rows of a synthetic file, the first column is always a unique id.
+
+    :param rows: int, number of data rows.
+    :param width: int, number of columns.
+    :param types: tuple[str], types to cycle through for the other columns.
+    :param seed: int, seed for reproducible data.
+    :return: generator, lists of values.
+    """
+    rand = random.Random(seed)
+    col_types = column_types(width - 1, types)
+
+    for row in range(rows):
+        yield [row] + [_value(col_type, row, rand) for col_type in col_types]
+
+
+def generate_file(path, rows=10000, width=10, types=TYPES, quoting='minimal', delimiter=',', encoding='utf-8',
+                  compression='none', header=True, seed=0):
+    """
+    Write a synthetic delimited file.
+
+    :param path: str, where to write it.
+    :param rows: int, number of data rows.
+    :param width: int, number of columns, at least 1.
+    :param types: tuple[str], column types to cycle through.
+    :param quoting: str, one of QUOTING.
+    :param delimiter: str, field delimiter.
+    :param encoding: str, text encoding.
+    :param compression: str, one of COMPRESSIONS.
+    :param header: bool, write a header row?
+    :param seed: int, seed for reproducible data.
+    :return: str, the path written.
+    """
+    with COMPRESSIONS[compression](path, 'wb') as binary:
+        with io.TextIOWrapper(binary, encoding=encoding, newline='') as text:
+            writer = csv.writer(text, delimiter=delimiter, quoting=QUOTING[quoting], escapechar='\\')
+
+            if header:
+                writer.writerow(['id'] + ['{}_{}'.format(col_type, idx)
+                                          for idx, col_type in enumerate(column_types(width - 1, types), 1)])
+
+            writer.writerows(generate_rows(rows, width, types, seed))
+
+    return path
+
+
+def parse_importtime(text):
+    """
+    Parse the report python -X importtime writes to stderr.
+
+    :param text: str, the report.
+    :return: lst[tuple], (module, self seconds, cumulative seconds, nesting depth) in import order.
+    """
+    imports = []
+
+    for line in text.splitlines():
+        if not line.startswith('import time:'):
+            continue
+
+        own, cumulative, name = line[len('import time:'):].split('|', 2)
+
+        if not own.strip().isdigit():
+            continue  # The column headings.
+
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+
+        imports.append((name.strip(), int(own) / 1e6, int(cumulative) / 1e6, depth))
+
+    return imports
+
+
+def import_report(code=WORKER_STARTUP, cwd=None, env=None):
+    """
+    Time the imports of a fresh interpreter running some code.
+
+    :param code: str, Python to run, by default what a worker runs at startup.
+    :param cwd: str, directory to run it in, the project root so its packages are importable.
+    :param env: dict, environment, this process's by default so DJANGO_SETTINGS_MODULE carries over.
+    :return: dict, total seconds spent importing, wall clock seconds of the whole run and the heaviest top level
+             imports with their cumulative seconds.
+    """
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=cwd, env=env or dict(os.environ),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    wall = time.perf_counter() - start
+
+    if process.returncode:
+        raise RuntimeError('Import run failed: {}'.format(process.stderr.strip().splitlines()[-1:]))
+
+    top = [(name, cumulative) for name, _, cumulative, depth in parse_importtime(process.stderr) if depth == 0]
+
+    return {'total': sum(cumulative for _, cumulative in top),
+            'wall': wall,
+            'heaviest': sorted(top, key=lambda item: -item[1])[:HEAVIEST]}
@@ -0,0 +1,105 @@
+"""
+Cached pieces of the file preview page.
+
+Uploaded files never change, so a rendered preview can be kept until the file's dialect does. The choice lists built
+from Column and Procedure are shared by every preview and are dropped by the signals in loader.signals whenever
+either table changes.
+"""
+import hashlib
+
+from django.core.cache import cache
+from django.db.models.functions import Lower
+from django.template.loader import render_to_string
+
+from loader.models import Column, Procedure
+
+PREVIEW_TIMEOUT = 60 * 60 * 24  # Previews only depend on immutable files, keep them for a day.
+
+SPECIAL_COLUMNS_KEY = 'loader:special_columns'
+PROCEDURES_KEY = 'loader:procedures'
+DRIFT_KEY = 'loader:drift:{}'
+
+
+def special_column_choices():
+    """
+    Return the special columns as (pk, name) pairs, ordered by name.
+
+    :return: lst[tuple], the choices.
+    """
+    choices = cache.get(SPECIAL_COLUMNS_KEY)
+
+    if choices is None:
+        choices = list(Column.objects.order_by(Lower('name')).values_list('pk', 'name'))
+        cache.set(SPECIAL_COLUMNS_KEY, choices, None)
+
+    return choices
+
+
+def procedure_choices():
+    """
+    Return the procedures as (pk, name) pairs.
+
+    :return: lst[tuple], the choices.
+    """
+    choices = cache.get(PROCEDURES_KEY)
+
+    if choices is None:
+        choices = list(Procedure.objects.values_list('pk', 'name'))
+        cache.set(PROCEDURES_KEY, choices, None)
+
+    return choices
+
+
+def file_drift(file):
+    """
+    Return the descriptions of the latest drift recorded for a file.
+
+    :param file: File obj, the file.
+    :return: lst[str], the changes, empty if the file never drifted.
+    """
+    key = DRIFT_KEY.format(file.pk)
+    described = cache.get(key)
+
+    if described is None:
+        drift = file.schemadrift_set.order_by('-detected').first()
+        described = drift.describe() if drift else []
+        cache.set(key, described, None)
+
+    return described
+
+
+def preview_key(file, view, page):
+    """
+    Build the cache key for a rendered preview.
+
+    The dialect settings are part of the key so correcting a file's delimiter or header never shows a stale table.
+
+    :param file: File obj, the file being previewed.
+    :param view: str, 'head' or 'sample'.
+    :param page: int, the page of the head being shown.
+    :return: str, the cache key.
+    """
+    dialect = '{}|{}|{}|{}'.format(file.data.name, file.delimiter, file.encoding, file.has_header)
+
+    return 'loader:preview:{}:{}:{}:{}'.format(file.pk, view, page,
+                                                hashlib.md5(dialect.encode('utf-8')).hexdigest())
+
+
+def render_preview(file, view, page, build_context):
+    """
+    Return the rendered preview table for a file, rendering it only if it isn't cached.
+
+    :param file: File obj, the file being previewed.
+    :param view: str, 'head' or 'sample'.
+    :param page: int, the page of the head being shown.
+    :param build_context: callable, returns the template context, only called on a cache miss.
+    :return: str, the rendered HTML fragment.
+    """
+    key = preview_key(file, view, page)
+    fragment = cache.get(key)
+
+    if fragment is None:
+        fragment = render_to_string('table_preview.html', build_context())
+        cache.set(key, fragment, PREVIEW_TIMEOUT)
+
+    return fragment
@@ -0,0 +1,207 @@
+"""
+Recompress or prune old uploads as their feed's retention policy asks.
+
+Uploads older than their feed's compress_after days are rewritten compressed, with xz, gzip or zstd, and File.data is
+pointed at the new file. Readers recognise compressed files by their magic numbers, so the file reads exactly as it did
+before. Uploads older than prune_after days are removed entirely: the data, everything derived from it and the record.
+"""
+import collections
+import datetime
+import gzip
+import hashlib
+import logging
+import lzma
+import os
+
+from django.utils import timezone
+
+from loader import loading, metrics, readers
+
+logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 1024 * 1024
+
+# Codec name to how to open a file for writing with it and its extension.
+CODECS = collections.OrderedDict([('xz', (lambda path: lzma.open(path, 'wb', preset=6), '.xz')),
+                                  ('gzip', (lambda path: gzip.open(path, 'wb', compresslevel=9), '.gz')),
+                                  ('zstd', (lambda path: readers.zstd_open(path, 'wb'), '.zst'))])
+
+CODEC_CHOICES = tuple((codec, codec) for codec in CODECS)
+
+Outcome = collections.namedtuple('Outcome', ['file', 'action', 'before', 'after'])
+
+COMPACTED = 'compacted'
+PRUNED = 'pruned'
+
+
+def compress(path, codec, target=None):
+    """
+    Write a compressed copy of a file and check it reads back the same.
+
+    :param path: str, the file.
+    :param codec: str, one of CODECS.
+    :param target: str, where to write the copy, beside the file with the codec's extension by default.
+    :return: str, path of the compressed copy.
+    """
+    opener, extension = CODECS[codec]
+    target = target or path + extension
+    partial = target + '.part'
+    digest = hashlib.sha256()
+
+    try:
+        with open(path, 'rb') as source, opener(partial) as compressed:
+            for block in iter(lambda: source.read(BLOCK_SIZE), b''):
+                digest.update(block)
+                compressed.write(block)
+
+        check = hashlib.sha256()
+
+        with readers.open_binary(partial) as copy:
+            for block in iter(lambda: copy.read(BLOCK_SIZE), b''):
+                check.update(block)
+
+        if check.digest() != digest.digest():
+            raise IOError('{} did not read back the same after compressing.'.format(path))
+
+        os.rename(partial, target)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+    return target
+
+
+def compact(file, codec):
+    """
+    Recompress a file's upload in place of the original.
+
+    The checksum is left as it was, so the same content uploaded again is still recognised.
+
+    :param file: File obj, the file.
+    :param codec: str, one of CODECS.
+    :return: tuple, (bytes before, bytes after).
+    """
+    path = file.data.path
+    before = os.path.getsize(path)
+
+    # A name nothing in storage has yet, another upload may already be called what the copy would be.
+    name = file.data.storage.get_available_name(file.data.name + CODECS[codec][1])
+
+    with metrics.stage('compact', file=file) as timer:
+        target = compress(path, codec, file.data.storage.path(name))
+        timer.bytes = before
+
+    file.data.name = name
+    file.save(update_fields=['data'])
+    os.remove(path)
+
+    return before, os.path.getsize(target)
+
+
+def prune(file):
+    """
+    Remove a file entirely: its upload, key indexes, reports, loaded table and record.
+
+    :param file: File obj, the file.
+    :return: int, bytes reclaimed on disk, not counting the table.
+    """
+    reclaimed = 0
+    stored = [file.data, file.rejects, file.duplicates] + [index.keys for index in file.keyindex_set.all()]
+
+    for field in stored:
+        if field and field.storage.exists(field.name):
+            reclaimed += field.size
+            field.storage.delete(field.name)
+
+    if file.table:
+        loading.drop_table(file.table)
+
+    file.delete()
+
+    return reclaimed
+
+
+def due(feed, now=None):
+    """
+    Find the files of a feed its retention policy says are due.
+
+    :param feed: Feed obj, the feed.
+    :param now: datetime, the time to measure age from, now by default.
+    :return: tuple, (files to prune, files to compact), querysets, the latter only of files not due for pruning.
+    """
+    now = now or timezone.now()
+    files = feed.file_set.exclude(data='').order_by('upload_date')
+    prune_files = files.none()
+    compact_files = files.none()
+    prune_before = None
+
+    if feed.prune_after is not None:
+        prune_before = now - datetime.timedelta(days=feed.prune_after)
+        prune_files = files.filter(upload_date__lt=prune_before)
+
+    if feed.compress_after is not None:
+        compact_files = files.filter(upload_date__lt=now - datetime.timedelta(days=feed.compress_after))
+
+        if prune_before is not None:
+            compact_files = compact_files.filter(upload_date__gte=prune_before)
+
+    return prune_files, compact_files
+
+
+def apply(feed, now=None, dry_run=False):
+    """
+    Apply a feed's retention policy.
+
+    :param feed: Feed obj, the feed.
+    :param now: datetime, the time to measure age from, now by default.
+    :param dry_run: bool, only report what would be done?
+    :return: generator, an Outcome per file acted on, after is None on a dry run.
+    """
+    prune_files, compact_files = due(feed, now)
+
+    # Lists rather than iterators, as the files are changed while going through them.
+    for file in list(prune_files):
+        if dry_run:
+            yield Outcome(file, PRUNED, file.data.size if file.data.storage.exists(file.data.name) else 0, None)
+        else:
+            yield Outcome(file, PRUNED, prune(file), 0)
+
+    for file in list(compact_files):
+        if not file.data.storage.exists(file.data.name) or readers.is_compressed(file.data.path):
+            continue
+
+        if dry_run:
+            yield Outcome(file, COMPACTED, file.data.size, None)
+            continue
+
+        try:
+            before, after = compact(file, feed.compression)
+        except (IOError, OSError, ImportError) as error:
+            logger.error('Could not compact %s: %s', file.data.name, error)
+            continue
+
+        yield Outcome(file, COMPACTED, before, after)
+
+
+def summarise(outcomes):
+    """
+    Sum up what a run did.
+
+    :param outcomes: iterable, Outcomes.
+    :return: dict, files and bytes compacted and pruned, and the bytes reclaimed in all.
+    """
+    summary = {'compacted': 0, 'compacted_before': 0, 'compacted_after': 0, 'pruned': 0, 'pruned_bytes': 0}
+
+    for outcome in outcomes:
+        if outcome.action == COMPACTED:
+            summary['compacted'] += 1
+            summary['compacted_before'] += outcome.before
+            summary['compacted_after'] += outcome.after if outcome.after is not None else outcome.before
+        else:
+            summary['pruned'] += 1
+            summary['pruned_bytes'] += outcome.before
+
+    summary['reclaimed'] = summary['compacted_before'] - summary['compacted_after'] + summary['pruned_bytes']
+
+    return summary
@@ -0,0 +1,320 @@
+"""
+Drop duplicate rows from a load in bounded memory.
+
+Rows are hashed, on the file's key columns or on the whole row, and checked against a set of the hashes seen so far.
+The set lives in memory until it reaches its limit, then it is sorted and spilled to a run file on disk with a Bloom
+filter in front of it, so most lookups of new rows never touch the runs.
+
+Keeping the first of each set of duplicates is a single streaming pass. Keeping the last means knowing the future, so
+the rows are spooled to disk as they go by and the hashes are walked backwards: the first time a hash is seen going
+backwards is its last row, any earlier row with it is dropped. The spool is then streamed forwards without them.
+"""
+import csv
+import hashlib
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from django.conf import settings
+
+from loader.keyindex import BloomFilter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MEMORY = 64 * 1024 ** 2  # Bytes the in-memory set may use unless LIONEL_DEDUP_MEMORY says otherwise.
+
+ENTRY_BYTES = 150  # Rough cost of one hash and its row number in a dict.
+
+BLOCK_ENTRIES = 4096  # Hashes read at a time when walking them backwards.
+
+KEY = 'key'
+ROW = 'row'
+
+FIRST = 'first'
+LAST = 'last'
+
+_SEPARATOR = '\x1f'  # ASCII unit separator, never found in text fields.
+
+_ENTRY = struct.Struct('<16sQ')  # Hash, row number.
+_ROW = struct.Struct('<Q')
+
+
+def row_hash(fields):
+    """
+    :param fields: lst[str], the values to hash.
+    :return: bytes, a 16 byte hash of them.
+    """
+    return hashlib.blake2b(_SEPARATOR.join(fields).encode('utf-8'), digest_size=16).digest()
+
+
+class Run(object):
+    """
+    A sorted spill of the set, searched with a binary search over a memory map.
+    """
+
+    def __init__(self, path, entries):
+        """
+        :param path: str, where to write the run.
+        :param entries: lst[tuple], (hash, row number) pairs, sorted.
+        """
+        self.bloom = BloomFilter.for_capacity(len(entries))
+
+        with open(path, 'wb') as run_file:
+            for raw, row in entries:
+                run_file.write(_ENTRY.pack(raw, row))
+                self.bloom.add_digest(BloomFilter.split(raw))
+
+        with open(path, 'rb') as run_file:
+            self.map = mmap.mmap(run_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.count = len(entries)
+
+    def find(self, raw):
+        """
+        :param raw: bytes, a hash.
+        :return: int or None, the row number stored with it, None if it isn't in the run.
+        """
+        if not self.bloom.might_contain(BloomFilter.split(raw)):
+            return None
+
+        low, high = 0, self.count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.map[middle * _ENTRY.size:middle * _ENTRY.size + 16] < raw:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self.count:
+            found, row = _ENTRY.unpack_from(self.map, low * _ENTRY.size)
+
+            if found == raw:
+                return row
+
+        return None
+
+    def close(self):
+        self.map.close()
+
+
+class SpillingSet(object):
+    """
+    Set of row hashes, remembering the row each was first added with, that spills to disk past a size limit.
+    """
+
+    def __init__(self, limit, directory):
+        """
+        :param limit: int, hashes held in memory before spilling.
+        :param directory: str, where to write runs.
+        """
+        self.limit = max(limit, 1)
+        self.directory = directory
+        self.memory = {}
+        self.runs = []
+
+    def add(self, raw, row):
+        """
+        Add a hash unless it is already there.
+
+        :param raw: bytes, the hash.
+        :param row: int, the row it came from.
+        :return: int or None, the row it was first added with, None if it is new.
+        """
+        earlier = self.memory.get(raw)
+
+        if earlier is None:
+            for run in self.runs:
+                earlier = run.find(raw)
+
+                if earlier is not None:
+                    break
+
+        if earlier is not None:
+            return earlier
+
+        self.memory[raw] = row
+
+        if len(self.memory) >= self.limit:
+            self.spill()
+
+        return None
+
+    def spill(self):
+        """
+        Write the in-memory hashes out as a sorted run.
+        """
+        path = os.path.join(self.directory, 'run_{}'.format(len(self.runs)))
+        self.runs.append(Run(path, sorted(self.memory.items())))
+        self.memory = {}
+        logger.debug('Spilled run %s of duplicate hashes', len(self.runs))
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+
+
+class Report(object):
+    """
+    The duplicate report, every dropped row with the row that was kept.
+    """
+
+    def __init__(self, stream, header, delimiter=','):
+        """
+        :param stream: file obj, text stream to write to.
+        :param header: lst[str], the file's header.
+        :param delimiter: str, field delimiter.
+        """
+        self.writer = csv.writer(stream, delimiter=delimiter)
+        self.writer.writerow(['row', 'duplicate_of'] + list(header))
+        self.count = 0
+
+    def add(self, row_number, kept, row):
+        """
+        :param row_number: int, the dropped row's index among the file's data rows.
+        :param kept: int, index of the row kept in its place.
+        :param row: lst[str], the dropped row's fields.
+        """
+        self.writer.writerow([row_number, kept] + list(row))
+        self.count += 1
+
+
+class Deduplicator(object):
+    """
+    Drops duplicate rows as they stream past on their way into the table.
+    """
+
+    def __init__(self, positions=None, keep=FIRST, memory=None):
+        """
+        :param positions: lst[int], columns that make a row's key, None to compare whole rows.
+        :param keep: str, FIRST or LAST, which of a set of duplicates is loaded.
+        :param memory: int, bytes the set of hashes may hold in memory, LIONEL_DEDUP_MEMORY by default.
+        """
+        if memory is None:
+            memory = getattr(settings, 'LIONEL_DEDUP_MEMORY', DEFAULT_MEMORY)
+
+        self.positions = positions
+        self.keep = keep
+        self.limit = memory // ENTRY_BYTES
+
+    @classmethod
+    def for_file(cls, file):
+        """
+        Set up deduplication as the file's feed asks for it.
+
+        The key is made of the file's special columns. A feed deduplicating on keys whose files have none compares
+        whole rows instead.
+
+        :param file: File obj, the file.
+        :return: Deduplicator or None, None if the feed doesn't deduplicate.
+        """
+        if not file.feed.dedup:
+            return None
+
+        positions = None
+
+        if file.feed.dedup == KEY:
+            positions = [position for position, _ in file.key_columns()] or None
+
+            if positions is None:
+                logger.warning('%s has no key columns, deduplicating on whole rows', file)
+
+        return cls(positions, file.feed.dedup_keep)
+
+    def key(self, row):
+        """
+        :param row: lst[str], the row.
+        :return: bytes, the hash it is compared on.
+        """
+        if self.positions is None:
+            return row_hash(row)
+
+        return row_hash([row[position] if position < len(row) else '' for position in self.positions])
+
+    def unique(self, rows, report):
+        """
+        Pass on the rows to load, reporting the duplicates dropped.
+
+        :param rows: iterable, (row number, row) pairs in file order.
+        :param report: Report, where dropped rows go.
+        :return: generator, (row number, row) pairs of the rows kept.
+        """
+        directory = tempfile.mkdtemp(prefix='lionel-dedup-')
+        seen = SpillingSet(self.limit, directory)
+
+        try:
+            if self.keep == LAST:
+                for pair in self._keep_last(rows, report, seen, directory):
+                    yield pair
+                return
+
+            for number, row in rows:
+                kept = seen.add(self.key(row), number)
+
+                if kept is None:
+                    yield number, row
+                else:
+                    report.add(number, kept, row)
+        finally:
+            seen.close()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def _keep_last(self, rows, report, seen, directory):
+        """
+        Keep the last of each set of duplicates, see the module docstring.
+        """
+        spool_path = os.path.join(directory, 'spool.csv')
+        hashes_path = os.path.join(directory, 'hashes')
+        dropped_path = os.path.join(directory, 'dropped')
+
+        with open(spool_path, 'w', encoding='utf-8', newline='') as spool, open(hashes_path, 'wb') as hashes:
+            writer = csv.writer(spool)
+
+            for number, row in rows:
+                writer.writerow([number] + row)
+                hashes.write(_ENTRY.pack(self.key(row), number))
+
+        # Walk the hashes backwards, noting rows with a later duplicate, and the row that is kept in their place.
+        with open(hashes_path, 'rb') as hashes, open(dropped_path, 'wb') as dropped:
+            end = os.fstat(hashes.fileno()).st_size
+
+            while end > 0:
+                start = max(end - BLOCK_ENTRIES * _ENTRY.size, 0)
+                hashes.seek(start)
+                block = hashes.read(end - start)
+
+                for offset in range(len(block) - _ENTRY.size, -1, -_ENTRY.size):
+                    raw, number = _ENTRY.unpack_from(block, offset)
+                    kept = seen.add(raw, number)
+
+                    if kept is not None:
+                        dropped.write(_ROW.pack(number) + _ROW.pack(kept))
+
+                end = start
+
+        # The dropped rows were noted last first, read them back from the end to go through them in file order.
+        with open(spool_path, encoding='utf-8', newline='') as spool, open(dropped_path, 'rb') as dropped:
+            position = os.fstat(dropped.fileno()).st_size
+
+            def next_dropped():
+                if position <= 0:
+                    return None, None
+
+                dropped.seek(position - 2 * _ROW.size)
+                return _ROW.unpack(dropped.read(_ROW.size))[0], _ROW.unpack(dropped.read(_ROW.size))[0]
+
+            drop, kept = next_dropped()
+
+            for record in csv.reader(spool):
+                number, row = int(record[0]), record[1:]
+
+                if number == drop:
+                    report.add(number, kept, row)
+                    position -= 2 * _ROW.size
+                    drop, kept = next_dropped()
+                else:
+                    yield number, row
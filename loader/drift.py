@@ -0,0 +1,137 @@
+"""
+Schema drift detection.
+
+A schema is the small dict built by File.build_schema at upload time:
+
+    {'delimiter': ',', 'has_header': True, 'width': 3, 'columns': ['a', 'b', 'c'], 'types': [...]}
+
+Comparing two of these only ever walks the column lists, so the check costs the same whether the
+file has ten rows or ten million.
+"""
+import re
+
+_VARCHAR = re.compile(r'^varchar2?\((\d+)\)$')
+
+# Moving from the left hand type to any on the right loses no information.
+_WIDENINGS = {'number': ('varchar',),
+              'date': ('varchar',)}
+
+
+def _base_type(col_type):
+    """
+    Strip any length from a type so varchar2(10) and varchar2(20) compare as the same family.
+
+    :param col_type: str, sql friendly type as produced by File.get_datatype_of_column.
+    :return: tuple, (family, length or None)
+    """
+    match = _VARCHAR.match(col_type or '')
+    if match:
+        return 'varchar', int(match.group(1))
+    return col_type, None
+
+
+def is_widening(old_type, new_type):
+    """
+    Is a change of type one which only widens the column?
+
+    :param old_type: str, type in the accepted schema.
+    :param new_type: str, type in the new file.
+    :return: bool, True if every old value still fits the new type.
+    """
+    old_family, old_len = _base_type(old_type)
+    new_family, new_len = _base_type(new_type)
+
+    if old_family == new_family:
+        return (new_len or 0) >= (old_len or 0)
+
+    return new_family in _WIDENINGS.get(old_family, ())
+
+
+def compare_schemas(old, new):
+    """
+    Find every difference between an accepted schema and a new one.
+
+    Each change is a dict holding a 'kind' plus whatever detail is relevant to it:
+    delimiter, header, width, added, removed, moved and type.
+
+    :param old: dict, the last accepted schema for the feed.
+    :param new: dict, the schema of the file being uploaded.
+    :return: lst[dict], the changes found, empty if the schemas match.
+    """
+    changes = []
+
+    for key, kind in (('delimiter', 'delimiter'), ('has_header', 'header')):
+        if old.get(key) != new.get(key):
+            changes.append({'kind': kind, 'old': old.get(key), 'new': new.get(key)})
+
+    if old.get('width') != new.get('width'):
+        changes.append({'kind': 'width', 'old': old.get('width'), 'new': new.get('width')})
+
+    old_cols = old.get('columns') or []
+    new_cols = new.get('columns') or []
+
+    # Headerless files can only be compared by width and position.
+    if old_cols and new_cols:
+        old_pos = {name: idx for idx, name in enumerate(old_cols)}
+        new_pos = {name: idx for idx, name in enumerate(new_cols)}
+
+        for name, idx in new_pos.items():
+            if name not in old_pos:
+                changes.append({'kind': 'added', 'column': name, 'new': idx})
+            elif old_pos[name] != idx:
+                changes.append({'kind': 'moved', 'column': name, 'old': old_pos[name], 'new': idx})
+
+        for name, idx in old_pos.items():
+            if name not in new_pos:
+                changes.append({'kind': 'removed', 'column': name, 'old': idx})
+    else:
+        old_pos = new_pos = None
+
+    old_types = old.get('types') or []
+    new_types = new.get('types') or []
+
+    if old_types and new_types:
+        names = new_cols if new_cols else range(len(new_types))
+
+        for idx, name in enumerate(names):
+            old_idx = old_pos.get(name) if old_pos is not None else idx
+
+            if old_idx is None or old_idx >= len(old_types) or idx >= len(new_types):
+                continue
+
+            if old_types[old_idx] != new_types[idx]:
+                changes.append({'kind': 'type',
+                                'column': name,
+                                'old': old_types[old_idx],
+                                'new': new_types[idx],
+                                'widened': is_widening(old_types[old_idx], new_types[idx])})
+
+    return changes
+
+
+def describe(change):
+    """
+    Turn a change into a sentence for the drift history.
+
+    :param change: dict, a change as returned by compare_schemas.
+    :return: str, human readable description.
+    """
+    kind = change['kind']
+
+    if kind == 'delimiter':
+        return 'Delimiter changed from {old!r} to {new!r}'.format(**change)
+    if kind == 'header':
+        return 'Header row {}'.format('added' if change['new'] else 'removed')
+    if kind == 'width':
+        return 'Column count changed from {old} to {new}'.format(**change)
+    if kind == 'added':
+        return 'Column {column!r} added at position {new}'.format(**change)
+    if kind == 'removed':
+        return 'Column {column!r} removed from position {old}'.format(**change)
+    if kind == 'moved':
+        return 'Column {column!r} moved from position {old} to {new}'.format(**change)
+    if kind == 'type':
+        return 'Column {!r} type changed from {} to {}{}'.format(change['column'], change['old'], change['new'],
+                                                                 ' (widened)' if change.get('widened') else '')
+
+    return kind
@@ -0,0 +1,275 @@
+"""
+Stream a File's loaded table or raw data back out as CSV.
+
+Rows are read in batches, from a server side cursor where the database has them, and written out as they arrive, so an
+export of any size runs in constant memory and the first bytes are sent straight away. Exports can be cut down to a
+subset of columns, filtered on column values and gzipped on the fly.
+"""
+import csv
+import io
+import uuid
+import zlib
+
+from django.db import connections, transaction
+
+BATCH_SIZE = 2000  # Rows fetched and written at a time.
+
+GZIP_LEVEL = 6  # Speed matters more than size when compressing on the fly.
+
+LIKE_ESCAPE = '!'  # Escapes LIKE wildcards in contains filters, not a backslash, which MySQL reads as its own escape.
+
+# Filter operators, their SQL and how to apply them to the strings of a raw file.
+OPERATORS = {'eq': ('{} = %s', lambda value, arg: value == arg),
+             'ne': ('{} <> %s', lambda value, arg: value != arg),
+             'lt': ('{} < %s', lambda value, arg: _compare(value, arg) < 0),
+             'le': ('{} <= %s', lambda value, arg: _compare(value, arg) <= 0),
+             'gt': ('{} > %s', lambda value, arg: _compare(value, arg) > 0),
+             'ge': ('{} >= %s', lambda value, arg: _compare(value, arg) >= 0),
+             'contains': ("{{}} LIKE %s ESCAPE '{}'".format(LIKE_ESCAPE), lambda value, arg: arg in value),
+             'null': ('{} IS NULL', lambda value, arg: value == ''),
+             'notnull': ('{} IS NOT NULL', lambda value, arg: value != '')}
+
+
+class ExportError(ValueError):
+    """
+    An export asked for columns or filters that don't exist.
+    """
+
+
+def _compare(value, arg):
+    """
+    Compare two raw fields, as numbers if they both are.
+
+    :return: int, negative, zero or positive like a cmp function.
+    """
+    try:
+        value, arg = float(value), float(arg)
+    except ValueError:
+        pass
+
+    return (value > arg) - (value < arg)
+
+
+def parse_filters(specs, columns):
+    """
+    Parse filters given as column:operator:value, e.g. age:gt:30 or name:null.
+
+    :param specs: lst[str], the filters.
+    :param columns: lst[str], the columns that can be filtered on.
+    :return: lst[tuple], (column, operator, value) triples.
+    """
+    filters = []
+
+    for spec in specs:
+        parts = spec.split(':', 2)
+
+        if len(parts) < 2 or parts[0] not in columns or parts[1] not in OPERATORS:
+            raise ExportError('Bad filter {!r}, use column:operator:value with one of {}.'.format(
+                spec, ', '.join(sorted(OPERATORS))))
+
+        filters.append((parts[0], parts[1], parts[2] if len(parts) == 3 else ''))
+
+    return filters
+
+
+def parse_columns(spec, columns):
+    """
+    Parse a comma separated projection.
+
+    :param spec: str, the columns wanted, empty for all of them.
+    :param columns: lst[str], the columns there are.
+    :return: lst[str], the columns to export, in the order asked for.
+    """
+    if not spec:
+        return list(columns)
+
+    wanted = spec.split(',')
+    missing = [column for column in wanted if column not in columns]
+
+    if missing:
+        raise ExportError('Unknown columns: {}.'.format(', '.join(missing)))
+
+    return wanted
+
+
+def table_columns(table, using='default'):
+    """
+    :param table: str, a loaded table.
+    :param using: str, database alias.
+    :return: lst[str], the table's column names in order.
+    """
+    connection = connections[using]
+
+    with connection.cursor() as cursor:
+        return [column.name for column in connection.introspection.get_table_description(cursor, table)]
+
+
+def like_escape(value):
+    """
+    :param value: str, text a contains filter looks for.
+    :return: str, the text with LIKE's wildcards and escape character escaped, so they match themselves.
+    """
+    for char in (LIKE_ESCAPE, '%', '_'):
+        value = value.replace(char, LIKE_ESCAPE + char)
+
+    return value
+
+
+def select_sql(connection, table, columns, filters):
+    """
+    Build the query for an export.
+
+    :return: tuple, (sql, params).
+    """
+    quote = connection.ops.quote_name
+    where = []
+    params = []
+
+    for column, operator, value in filters:
+        where.append(OPERATORS[operator][0].format(quote(column)))
+
+        if operator == 'contains':
+            params.append('%{}%'.format(like_escape(value)))
+        elif operator not in ('null', 'notnull'):
+            params.append(value)
+
+    sql = 'SELECT {} FROM {}'.format(', '.join(quote(column) for column in columns), quote(table))
+
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+
+    return sql, params
+
+
+def table_rows(table, columns, filters=(), using='default', batch_size=BATCH_SIZE):
+    """
+    Read rows from a loaded table in batches.
+
+    PostgreSQL gets a named, server side cursor so rows stay on the server until fetched. Other backends use fetchmany
+    on a normal cursor.
+
+    :param table: str, the table.
+    :param columns: lst[str], columns to read.
+    :param filters: lst[tuple], (column, operator, value) filters, all of which must match.
+    :param using: str, database alias.
+    :param batch_size: int, rows per fetch.
+    :return: generator, lists of row tuples.
+    """
+    connection = connections[using]
+    sql, params = select_sql(connection, table, columns, filters)
+
+    if connection.vendor == 'postgresql':
+        with transaction.atomic(using=using):  # Named cursors only live inside a transaction.
+            connection.ensure_connection()
+            cursor = connection.connection.cursor(name='lnl_export_{}'.format(uuid.uuid4().hex))
+            cursor.itersize = batch_size
+
+            try:
+                cursor.execute(sql, params)
+
+                for batch in iter(lambda: cursor.fetchmany(batch_size), []):
+                    yield batch
+            finally:
+                cursor.close()
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+        for batch in iter(lambda: cursor.fetchmany(batch_size), []):
+            yield batch
+
+
+def file_rows(reader, columns, filters=(), batch_size=BATCH_SIZE):
+    """
+    Read rows from a file in batches, projected and filtered like a table export.
+
+    :param reader: FileReader, reader over the file.
+    :param columns: lst[str], columns to keep, named as in export_columns.
+    :param filters: lst[tuple], (column, operator, value) filters, all of which must match.
+    :param batch_size: int, rows per batch.
+    :return: generator, lists of rows.
+    """
+    names = export_columns(reader)
+    keep = [names.index(column) for column in columns]
+    tests = [(names.index(column), OPERATORS[operator][1], value) for column, operator, value in filters]
+    batch = []
+
+    for row in reader.rows():
+        row = row + [''] * (len(names) - len(row))
+
+        if all(test(row[idx], value) for idx, test, value in tests):
+            batch.append([row[idx] for idx in keep])
+
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+    if batch:
+        yield batch
+
+
+def export_columns(reader):
+    """
+    :param reader: FileReader, reader over a file.
+    :return: lst[str], the names its columns are exported and filtered by, the header or col_0, col_1...
+    """
+    header = reader.header
+
+    return [header[idx] if idx < len(header) and header[idx] else 'col_{}'.format(idx) for idx in range(reader.width)]
+
+
+def csv_chunks(header, batches, delimiter=','):
+    """
+    Write batches of rows as CSV.
+
+    :param header: lst[str], the header row.
+    :param batches: iterable, lists of rows.
+    :param delimiter: str, field delimiter.
+    :return: generator, bytes of CSV, one chunk per batch.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=delimiter)
+
+    writer.writerow(header)
+
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def raw_chunks(reader, chunk_size=1024 * 1024):
+    """
+    Read a file's uncompressed bytes.
+
+    :param reader: FileReader, reader over the file.
+    :param chunk_size: int, bytes per chunk.
+    :return: generator, bytes.
+    """
+    with reader.open_binary() as data:
+        for chunk in iter(lambda: data.read(chunk_size), b''):
+            yield chunk
+
+
+def gzipped(chunks, level=GZIP_LEVEL):
+    """
+    Gzip a stream of bytes as it goes.
+
+    :param chunks: iterable, bytes.
+    :param level: int, compression level.
+    :return: generator, gzip compressed bytes.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+
+        if compressed:
+            yield compressed
+
+    yield compressor.flush()
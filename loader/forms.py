@@ -2,6 +2,7 @@ from django import forms
 from django.forms import Form, ModelForm, ValidationError
 from django.contrib.auth import authenticate, login
 
+from loader import plugins
 from loader.models import File, Procedure
 
 
@@ -35,7 +36,7 @@ class FileForm(ModelForm):
         feed = cleaned_data.get('feed')
 
         if feed:
-            if self.user not in feed.users.all():
+            if not feed.has_user(self.user):
                 raise ValidationError('This User is not authorised to upload files to this feed!')
         else:
             raise ValidationError('No valid feed given')
@@ -71,13 +72,11 @@ class ProcedureForm(ModelForm):
         """
         cleaned_data = super(ProcedureForm, self).clean()
 
-        if not cleaned_data['procedure'].name.endswith(Procedure.LANGUAGE_EXTENSIONS[cleaned_data['language']]):
+        if not cleaned_data['procedure'].name.endswith(plugins.extension(cleaned_data['language'])):
             raise ValidationError('The file extension does not match the language picked!')
 
         cleaned_data['user'] = self.user
 
-        print(cleaned_data, self.user.id)
-
         return cleaned_data
 
 class LoginForm(Form):
@@ -0,0 +1,327 @@
+"""
+Watch feed inbox directories and ingest files as they arrive.
+
+Upstream systems drop files into a feed's inbox. A file is taken once it is complete, either because a marker file
+(name + MARKER_SUFFIX) has appeared next to it or because its size and modification time have stopped changing for
+the settle time. Complete files are moved into storage and ingested on a bounded pool of workers; while the pool is
+full, files simply wait in the inbox.
+
+On Linux the inboxes are watched with inotify so the watcher sleeps until something changes, elsewhere they are
+polled.
+"""
+import concurrent.futures
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import shutil
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from loader import ingest
+
+logger = logging.getLogger(__name__)
+
+MARKER_SUFFIX = '.done'
+
+# Names still being written by common transfer tools, never picked up.
+PARTIAL_SUFFIXES = ('.tmp', '.part', '.partial', '.filepart', '.crdownload')
+
+SKIPPED_DIR = '.skipped'
+FAILED_DIR = '.failed'
+
+# inotify event masks, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+_EVENT = struct.Struct('iIII')
+
+
+def allowed_inbox(path):
+    """
+    :param path: str, a feed's inbox.
+    :return: bool, is it one of the LIONEL_INBOX_ROOTS directories or under one?
+    """
+    path = os.path.join(os.path.realpath(path), '')
+
+    for root in getattr(settings, 'LIONEL_INBOX_ROOTS', []):
+        if path.startswith(os.path.join(os.path.realpath(root), '')):
+            return True
+
+    return False
+
+
+def is_candidate(name):
+    """
+    :param name: str, name of a file in an inbox.
+    :return: bool, could this be a feed file? Hidden, partial and marker files are not.
+    """
+    return not (name.startswith('.') or name.endswith(PARTIAL_SUFFIXES) or name.endswith(MARKER_SUFFIX))
+
+
+class Inotify(object):
+    """
+    Minimal inotify binding, just enough to wake up when an inbox changes.
+    """
+
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.watches = {}
+
+    @classmethod
+    def available(cls):
+        """
+        :return: bool, can inotify be used here?
+        """
+        try:
+            cls().close()
+            return True
+        except (OSError, AttributeError, TypeError):
+            return False
+
+    def add(self, directory):
+        """
+        :param directory: str, directory to watch.
+        """
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), self.MASK)
+
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'Could not watch {}'.format(directory))
+
+        self.watches[wd] = directory
+
+    def wait(self, timeout):
+        """
+        Wait for changes.
+
+        :param timeout: float, seconds to wait at most.
+        :return: set[str], paths that changed, empty on timeout.
+        """
+        changed = set()
+
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+
+        while True:
+            try:
+                buffer = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return changed
+
+            offset = 0
+
+            while offset < len(buffer):
+                wd, _, _, length = _EVENT.unpack_from(buffer, offset)
+                offset += _EVENT.size
+                name = buffer[offset:offset + length].rstrip(b'\0')
+                offset += length
+
+                if wd in self.watches and name:
+                    changed.add(os.path.join(self.watches[wd], os.fsdecode(name)))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller(object):
+    """
+    Stand in for Inotify where it isn't available, every wait ends with a rescan.
+    """
+
+    def __init__(self):
+        self.watches = []
+
+    def add(self, directory):
+        self.watches.append(directory)
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return set()
+
+    def close(self):
+        pass
+
+
+class Watcher(object):
+    """
+    Watch the inboxes of a set of feeds.
+    """
+
+    def __init__(self, ingesters, workers=2, backlog=None, settle=5.0, interval=2.0, poll=False):
+        """
+        :param ingesters: dict, inbox directory to the Ingester for its feed.
+        :param workers: int, files ingested at once.
+        :param backlog: int, files allowed to queue for a worker, defaults to the number of workers.
+        :param settle: float, seconds a file's size must hold still before it is taken, if it has no marker.
+        :param interval: float, seconds between rescans of the inboxes.
+        :param poll: bool, poll even if inotify is available?
+        """
+        self.ingesters = ingesters
+        self.settle = settle
+        self.interval = interval
+
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers + (workers if backlog is None else backlog))
+        self.in_flight = set()
+        self.lock = threading.Lock()
+        self.seen = {}  # Path to (size, mtime, time first seen with them).
+
+        self.notifier = Poller() if poll or not Inotify.available() else Inotify()
+
+        for directory in ingesters:
+            self.notifier.add(directory)
+
+    def complete(self, path, now):
+        """
+        Has a file finished arriving?
+
+        :param path: str, the file.
+        :param now: float, time.monotonic() of this check.
+        :return: bool, True once it has a marker or has held still for the settle time.
+        """
+        if os.path.exists(path + MARKER_SUFFIX):
+            return True
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.seen.pop(path, None)
+            return False
+
+        state = (stat.st_size, stat.st_mtime)
+        previous = self.seen.get(path)
+
+        if previous is None or previous[:2] != state:
+            self.seen[path] = state + (now,)
+            return False
+
+        return now - previous[2] >= self.settle
+
+    def scan(self):
+        """
+        Find the complete files waiting in the inboxes.
+
+        :return: lst[tuple], (inbox, path) pairs, oldest first.
+        """
+        now = time.monotonic()
+        ready = []
+
+        for directory in self.ingesters:
+            try:
+                entries = list(os.scandir(directory))
+            except FileNotFoundError:
+                logger.warning('Inbox %s does not exist', directory)
+                continue
+
+            for entry in entries:
+                if not entry.is_file() or not is_candidate(entry.name):
+                    continue
+
+                with self.lock:
+                    if entry.path in self.in_flight:
+                        continue
+
+                if self.complete(entry.path, now):
+                    ready.append((entry.stat().st_mtime, directory, entry.path))
+
+        return [(directory, path) for _, directory, path in sorted(ready)]
+
+    def submit(self, directory, path):
+        """
+        Hand a file to the worker pool if there's room.
+
+        :param directory: str, the inbox it is in.
+        :param path: str, the file.
+        :return: Future or None, None when the pool is full and the file has to wait.
+        """
+        if not self.slots.acquire(blocking=False):
+            return None
+
+        with self.lock:
+            self.in_flight.add(path)
+
+        self.seen.pop(path, None)
+
+        return self.pool.submit(self.process, directory, path)
+
+    def process(self, directory, path):
+        """
+        Ingest a file, then clear it out of the inbox.
+
+        :param directory: str, the inbox it is in.
+        :param path: str, the file.
+        :return: ingest.Result, what happened.
+        """
+        try:
+            result = self.ingesters[directory].ingest(path, move=True)
+
+            if result.status in (ingest.SKIPPED, ingest.FAILED) and os.path.exists(path):
+                aside = os.path.join(directory, SKIPPED_DIR if result.status == ingest.SKIPPED else FAILED_DIR)
+                os.makedirs(aside, exist_ok=True)
+                shutil.move(path, os.path.join(aside, os.path.basename(path)))
+
+            if os.path.exists(path + MARKER_SUFFIX):
+                os.remove(path + MARKER_SUFFIX)
+
+            logger.info('%s %s in %.2fs', result.status, path, result.seconds)
+
+            return result
+        finally:
+            connection.close()
+
+            with self.lock:
+                self.in_flight.discard(path)
+
+            self.slots.release()
+
+    def run_once(self):
+        """
+        Submit every complete file there's room for.
+
+        :return: lst[Future], the submitted work.
+        """
+        futures = []
+
+        for directory, path in self.scan():
+            future = self.submit(directory, path)
+
+            if future is None:
+                break  # Backpressure, the rest wait in the inbox for a free slot.
+
+            futures.append(future)
+
+        return futures
+
+    def run(self, stop=None):
+        """
+        Watch until stopped.
+
+        :param stop: threading.Event, set it to stop watching.
+        """
+        stop = stop or threading.Event()
+
+        try:
+            while not stop.is_set():
+                self.run_once()
+                # Wakes early on inotify events, the timeout covers files waiting to settle.
+                self.notifier.wait(self.interval)
+        finally:
+            self.close()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        self.notifier.close()
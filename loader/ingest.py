@@ -0,0 +1,241 @@
+"""
+Headless ingestion of files already on disk.
+
+Each file is stored under the same layout as a web upload, then sniffed, sampled, profiled, loaded, key indexed and
+passed through any procedures, without the web form in the way. Files whose content is already in the feed are skipped.
+"""
+import collections
+import concurrent.futures
+import glob
+import logging
+import os
+import shutil
+import threading
+import time
+
+from django.core.files import File as DjangoFile
+from django.db import connection
+
+from loader import compaction, loading, readers
+from loader.models import File
+
+logger = logging.getLogger(__name__)
+
+SKIPPED = 'skipped'
+INGESTED = 'ingested'
+BLOCKED = 'blocked'  # Stored and analysed but held back by schema drift.
+FAILED = 'failed'
+
+Result = collections.namedtuple('Result', ['path', 'status', 'file', 'bytes', 'rows', 'seconds', 'error'])
+
+
+def find_files(patterns, recursive=False):
+    """
+    Expand directories and glob patterns into the files they hold.
+
+    :param patterns: lst[str], directories, files or glob patterns.
+    :param recursive: bool, descend into subdirectories of directories?
+    :return: lst[str], sorted paths of regular files, each only once.
+    """
+    paths = set()
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            if recursive:
+                for root, _, names in os.walk(pattern):
+                    paths.update(os.path.join(root, name) for name in names)
+            else:
+                paths.update(os.path.join(pattern, name) for name in os.listdir(pattern))
+        else:
+            paths.update(glob.glob(pattern, recursive=recursive))
+
+    return sorted(path for path in paths if os.path.isfile(path))
+
+
+def store(file, path, move=False):
+    """
+    Put a file into storage under its feed's upload layout.
+
+    :param file: File obj, the unsaved file record, its data is set to the stored file.
+    :param path: str, the file on disk.
+    :param move: bool, move rather than copy? A move on the same filesystem is a rename, nothing is copied.
+    """
+    name = os.path.basename(path)
+
+    if not move:
+        with open(path, 'rb') as data:
+            file.data.save(name, DjangoFile(data), save=False)
+        return
+
+    storage = file.data.storage
+    name = storage.get_available_name(file.data.field.generate_filename(file, name))
+    target = storage.path(name)
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    if os.stat(path).st_dev == os.stat(os.path.dirname(target)).st_dev:
+        os.rename(path, target)
+    else:
+        shutil.move(path, target)
+
+    file.data.name = name
+
+
+def discard(file):
+    """
+    Remove everything a failed ingest left behind: the stored copy, table, key indexes, reports and the record.
+
+    :param file: File obj, the file being ingested, saved or not.
+    """
+    if file.pk is None:
+        if file.data.name and file.data.storage.exists(file.data.name):
+            file.data.storage.delete(file.data.name)
+        return
+
+    # A load which failed part way never set the table, but may have left it behind where DDL isn't transactional.
+    file.table = file.table or loading.table_name(file)
+    compaction.prune(file)
+
+
+class Ingester(object):
+    """
+    Ingest files into one feed, remembering content already seen so parallel workers never store it twice.
+    """
+
+    def __init__(self, feed, user, procedures=(), profile=True, load=True):
+        """
+        :param feed: Feed obj, the feed the files belong to.
+        :param user: User obj, who the files are recorded as uploaded by.
+        :param procedures: lst[Procedure], procedures to run on each loaded file, in order.
+        :param profile: bool, profile every column of each file?
+        :param load: bool, load each file into its table?
+        """
+        self.feed = feed
+        self.user = user
+        self.procedures = list(procedures)
+        self.profile = profile
+        self.load = load
+
+        self.lock = threading.Lock()
+        self.seen = set(File.objects.filter(feed=feed).exclude(checksum='').values_list('checksum', flat=True))
+
+    def claim(self, checksum):
+        """
+        :param checksum: str, checksum of a file about to be ingested.
+        :return: bool, True if nobody has ingested this content yet, it is then ours.
+        """
+        with self.lock:
+            if checksum in self.seen:
+                return False
+
+            self.seen.add(checksum)
+            return True
+
+    def ingest(self, path, move=False):
+        """
+        Ingest one file.
+
+        :param path: str, path to the file.
+        :param move: bool, move the file into storage rather than copying it? Skipped files are never moved.
+        :return: Result, what happened.
+        """
+        start = time.perf_counter()
+        size = os.path.getsize(path)
+        checksum = file = None
+
+        try:
+            checksum = readers.checksum(path)
+
+            if not self.claim(checksum):
+                return Result(path, SKIPPED, None, size, None, time.perf_counter() - start, None)
+
+            file = File(user=self.user, feed=self.feed, checksum=checksum)
+            store(file, path, move)
+            file.save()
+            file.analyse()
+            file.save()
+
+            if not file.accepted:
+                return Result(path, BLOCKED, file, size, None, time.perf_counter() - start, None)
+
+            if self.profile:
+                file.profile_columns()
+
+            rows = file.load_table() if self.load else None
+            file.save()
+            file.build_key_indexes()
+
+            for procedure in self.procedures:
+                procedure.run(file)
+
+            return Result(path, INGESTED, file, size, rows, time.perf_counter() - start, None)
+        except Exception as error:
+            logger.exception('Could not ingest %s', path)
+
+            # Forget the attempt so the file is retried next time rather than skipped as a duplicate.
+            with self.lock:
+                self.seen.discard(checksum)
+
+            if file is not None and move and file.data.name and not os.path.exists(path):
+                shutil.move(file.data.path, path)  # Put it back where it came from.
+
+            if file is not None:
+                discard(file)
+
+            return Result(path, FAILED, None, size, None, time.perf_counter() - start, str(error))
+
+    def _worker(self, path):
+        """
+        Ingest a file on a pool thread, closing the thread's own database connection afterwards.
+        """
+        try:
+            return self.ingest(path)
+        finally:
+            connection.close()
+
+    def run(self, paths, workers=None, callback=None):
+        """
+        Ingest many files with a pool of worker threads.
+
+        :param paths: lst[str], the files.
+        :param workers: int, number of threads, defaults to the number of CPUs.
+        :param callback: callable, called with each Result as it finishes.
+        :return: lst[Result], one per path, in the order they finished.
+        """
+        results = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            for future in concurrent.futures.as_completed([pool.submit(self._worker, path) for path in paths]):
+                result = future.result()
+                results.append(result)
+
+                if callback is not None:
+                    callback(result)
+
+        return results
+
+
+def summarise(results, elapsed):
+    """
+    Sum up an ingest.
+
+    :param results: lst[Result], the results.
+    :param elapsed: float, wall clock seconds the ingest took.
+    :return: dict, counts per status, bytes and rows ingested and throughput.
+    """
+    ingested = [result for result in results if result.status == INGESTED]
+    summary = collections.Counter(result.status for result in results)
+    size = sum(result.bytes for result in ingested)
+    rows = sum(result.rows or 0 for result in ingested)
+
+    return {'files': len(results),
+            'ingested': summary[INGESTED],
+            'skipped': summary[SKIPPED],
+            'blocked': summary[BLOCKED],
+            'failed': summary[FAILED],
+            'bytes': size,
+            'rows': rows,
+            'seconds': elapsed,
+            'files_per_sec': len(ingested) / elapsed if elapsed else None,
+            'mb_per_sec': size / 1024 / 1024 / elapsed if elapsed else None,
+            'rows_per_sec': rows / elapsed if elapsed else None}
@@ -0,0 +1,359 @@
+"""
+Find which uploads hold a given key, e.g. a customer or account id.
+
+Every column of a File named after a special Column gets a KeyIndex: a Bloom filter, kept in the database so most
+files can be ruled out without touching disk, and a sorted key file mapping each key to its row number and byte offset,
+which confirms a match with a binary search. A lookup reads the Bloom filters of the candidate files a batch at a time,
+newest first, and only opens the key files of the few which might hold the key.
+
+Keys are sorted RUN_KEYS at a time and the sorted runs spilled to disk and merged, so building the index of a large
+file never holds all its keys in memory.
+"""
+import hashlib
+import heapq
+import itertools
+import math
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+
+from django.apps import apps
+
+FALSE_POSITIVE_RATE = 0.01  # Fraction of lookups on a file without the key that still have to open its key file.
+
+MAX_RESULTS = 200
+
+RUN_KEYS = 100000  # Keys of a column sorted in memory at once, more are spilled to disk in sorted runs.
+
+SEARCH_BATCH = 100  # Bloom filters fetched per query when searching.
+
+_MAGIC = b'LKI1'
+_HEADER = struct.Struct('<4sQ')
+_ENTRY = struct.Struct('<QQq')  # Offset of the key in the key blob, row number, byte offset of the row or -1.
+_RUN_ENTRY = struct.Struct('<IQq')  # Length of the key, row number, byte offset of the row, in a sorted run.
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over str keys, with positions from double hashing one BLAKE2 digest.
+    """
+
+    def __init__(self, bits, hashes, data=None):
+        """
+        :param bits: int, size of the filter in bits.
+        :param hashes: int, bits set per key.
+        :param data: bytes, an existing filter, empty if None.
+        """
+        self.bits = bits
+        self.hashes = hashes
+        self.data = bytearray(data) if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def for_capacity(cls, count, rate=FALSE_POSITIVE_RATE):
+        """
+        Size a filter for a number of keys.
+
+        :param count: int, number of keys it will hold.
+        :param rate: float, wanted false positive rate.
+        :return: BloomFilter, an empty filter.
+        """
+        count = max(count, 1)
+        bits = max(int(math.ceil(-count * math.log(rate) / math.log(2) ** 2)), 64)
+        hashes = max(int(round(bits / count * math.log(2))), 1)
+
+        return cls(bits, hashes)
+
+    @staticmethod
+    def digest(key):
+        """
+        :param key: str, the key.
+        :return: tuple, the two hashes positions are made from, worked out once per key for any filter size.
+        """
+        return BloomFilter.split(hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest())
+
+    @staticmethod
+    def split(raw):
+        """
+        :param raw: bytes, a 16 byte hash of a key.
+        :return: tuple, the two hashes positions are made from.
+        """
+        return int.from_bytes(raw[:8], 'little'), int.from_bytes(raw[8:], 'little') | 1
+
+    def positions(self, digest):
+        """
+        :param digest: tuple, from digest().
+        :return: generator, the bit positions of a key.
+        """
+        first, second = digest
+
+        for idx in range(self.hashes):
+            yield (first + idx * second) % self.bits
+
+    def add(self, key):
+        self.add_digest(self.digest(key))
+
+    def add_digest(self, digest):
+        """
+        :param digest: tuple, from digest() or split() for the key.
+        """
+        for position in self.positions(digest):
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, digest):
+        """
+        :param digest: tuple, from digest() for the key.
+        :return: bool, False if the key is definitely not in the filter.
+        """
+        return all(self.data[position >> 3] & (1 << (position & 7)) for position in self.positions(digest))
+
+
+def write_keys(path, entries, digests=None):
+    """
+    Write a sorted key file, streaming the entries so they needn't all be in memory.
+
+    :param path: str, where to write it.
+    :param entries: iterable[tuple], (key, row, byte offset) triples, sorted by key.
+    :param digests: file, binary file the 16 byte hash of each distinct key is written to, for the Bloom filter.
+    :return: int, number of entries written.
+    """
+    count = blob_size = 0
+    last = None
+
+    # The index comes before the keys in the file, so the keys are held in a temporary file until the end.
+    with open(path, 'wb') as key_file, tempfile.TemporaryFile() as blob:
+        key_file.write(_HEADER.pack(_MAGIC, 0))
+
+        for key, row, offset in entries:
+            encoded = key.encode('utf-8')
+            key_file.write(_ENTRY.pack(blob_size, row, offset))
+            blob.write(encoded)
+            blob_size += len(encoded)
+            count += 1
+
+            if digests is not None and key != last:
+                digests.write(hashlib.blake2b(encoded, digest_size=16).digest())
+                last = key
+
+        blob.seek(0)
+        shutil.copyfileobj(blob, key_file)
+
+        key_file.seek(0)
+        key_file.write(_HEADER.pack(_MAGIC, count))
+
+    return count
+
+
+class SortedKeys(object):
+    """
+    Binary search over a key file written by write_keys, memory mapped so only the pages touched are read.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as key_file:
+            self.map = mmap.mmap(key_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count = _HEADER.unpack_from(self.map, 0)
+
+        if magic != _MAGIC:
+            raise ValueError('{} is not a key index'.format(path))
+
+        self.blob_start = _HEADER.size + self.count * _ENTRY.size
+
+    def entry(self, idx):
+        """
+        :param idx: int, position in sorted order.
+        :return: tuple, (key, row, byte offset).
+        """
+        start, row, offset = _ENTRY.unpack_from(self.map, _HEADER.size + idx * _ENTRY.size)
+
+        if idx + 1 < self.count:
+            end = _ENTRY.unpack_from(self.map, _HEADER.size + (idx + 1) * _ENTRY.size)[0]
+        else:
+            end = len(self.map) - self.blob_start
+
+        return self.map[self.blob_start + start:self.blob_start + end].decode('utf-8'), row, offset
+
+    def find(self, key):
+        """
+        :param key: str, the key.
+        :return: lst[tuple], (row, byte offset) of every row holding it.
+        """
+        low, high = 0, self.count
+
+        while low < high:
+            middle = (low + high) // 2
+
+            if self.entry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        found = []
+
+        while low < self.count:
+            entry_key, row, offset = self.entry(low)
+
+            if entry_key != key:
+                break
+
+            found.append((row, offset))
+            low += 1
+
+        return found
+
+    def close(self):
+        self.map.close()
+
+
+def write_run(directory, entries):
+    """
+    Sort some keys and spill them to disk.
+
+    :param directory: str, where to put the run.
+    :param entries: lst[tuple], (key, row, byte offset) triples, sorted in place.
+    :return: str, path of the run.
+    """
+    entries.sort()
+    handle, path = tempfile.mkstemp(suffix='.run', dir=directory)
+
+    with os.fdopen(handle, 'wb') as run_file:
+        for key, row, offset in entries:
+            encoded = key.encode('utf-8')
+            run_file.write(_RUN_ENTRY.pack(len(encoded), row, offset))
+            run_file.write(encoded)
+
+    return path
+
+
+def read_run(path):
+    """
+    :param path: str, a run written by write_run.
+    :return: generator, its (key, row, byte offset) triples in order.
+    """
+    with open(path, 'rb') as run_file:
+        while True:
+            head = run_file.read(_RUN_ENTRY.size)
+
+            if not head:
+                return
+
+            length, row, offset = _RUN_ENTRY.unpack(head)
+            yield run_file.read(length).decode('utf-8'), row, offset
+
+
+def scan(reader, positions, directory, run_keys=RUN_KEYS):
+    """
+    Collect the keys of some columns of a file into sorted runs on disk.
+
+    :param reader: FileReader, reader over the file.
+    :param positions: lst[int], column indexes to collect.
+    :param directory: str, where to put the runs.
+    :param run_keys: int, keys of a column held in memory before they are sorted and spilled.
+    :return: dict, column index to the paths of its runs, each sorted (key, row, byte offset), byte offset -1 if rows
+             can't be addressed.
+    """
+    keys = {position: [] for position in positions}
+    runs = {position: [] for position in positions}
+
+    if reader.byte_addressable():
+        rows = ((offset, reader.parse(record)) for offset, record in reader.records())
+    else:
+        rows = ((-1, row) for row in reader.rows())
+
+    for row_number, (offset, row) in enumerate(rows):
+        for position in positions:
+            if position < len(row) and row[position] != '':
+                keys[position].append((row[position], row_number, offset))
+
+                if len(keys[position]) >= run_keys:
+                    runs[position].append(write_run(directory, keys[position]))
+                    keys[position] = []
+
+    for position, entries in keys.items():
+        if entries or not runs[position]:
+            runs[position].append(write_run(directory, entries))
+
+    return runs
+
+
+def build(reader, positions, run_keys=RUN_KEYS):
+    """
+    Build the Bloom filter and sorted key file for each column.
+
+    :param reader: FileReader, reader over the file.
+    :param positions: lst[int], column indexes to index.
+    :param run_keys: int, keys of a column sorted in memory at once.
+    :return: dict, column index to (BloomFilter, path of a temporary key file, number of keys).
+    """
+    built = {}
+    directory = tempfile.mkdtemp(prefix='lionel-keys-')
+
+    try:
+        for position, paths in scan(reader, positions, directory, run_keys).items():
+            handle, path = tempfile.mkstemp(suffix='.idx')
+            os.close(handle)
+
+            # Distinct keys are counted as the runs are merged, the filter is sized and filled from their hashes after.
+            with tempfile.TemporaryFile() as digests:
+                count = write_keys(path, heapq.merge(*[read_run(run) for run in paths]), digests)
+                bloom = BloomFilter.for_capacity(digests.tell() // 16)
+                digests.seek(0)
+
+                for raw in iter(lambda: digests.read(16), b''):
+                    bloom.add_digest(BloomFilter.split(raw))
+
+            built[position] = (bloom, path, count)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return built
+
+
+def search(value, feed_ids, column_id=None, limit=MAX_RESULTS):
+    """
+    Find the rows of uploads holding a key.
+
+    :param value: str, the key.
+    :param feed_ids: iterable[int], feeds to search in.
+    :param column_id: int, only search columns indexed as this special column, None for all of them.
+    :param limit: int, most matches to return.
+    :return: lst[tuple], (KeyIndex, row, byte offset) of each match, newest uploads first.
+    """
+    model = apps.get_model('loader', 'KeyIndex')
+    indexes = model.objects.filter(file__feed__in=feed_ids, count__gt=0)
+
+    if column_id is not None:
+        indexes = indexes.filter(column_id=column_id)
+
+    # Only the small fields of every candidate, the Bloom filters are fetched a batch at a time and only the indexes
+    # they pass are fetched whole.
+    candidates = indexes.order_by('-file__upload_date', 'position').values_list('pk', 'bits', 'hashes').iterator()
+    digest = BloomFilter.digest(value)
+    matches = []
+
+    while True:
+        batch = list(itertools.islice(candidates, SEARCH_BATCH))
+
+        if not batch:
+            return matches
+
+        blooms = dict(model.objects.filter(pk__in=[pk for pk, _, _ in batch]).values_list('pk', 'bloom'))
+        passed = [pk for pk, bits, hashes in batch
+                  if pk in blooms and BloomFilter(bits, hashes, blooms[pk]).might_contain(digest)]
+        found = model.objects.select_related('file', 'file__feed', 'column').defer('bloom').in_bulk(passed)
+
+        for pk in passed:
+            if pk not in found:
+                continue
+
+            keys = SortedKeys(found[pk].keys.path)
+
+            try:
+                matches.extend((found[pk], row, offset) for row, offset in keys.find(value))
+            finally:
+                keys.close()
+
+            if len(matches) >= limit:
+                return matches[:limit]
@@ -0,0 +1,398 @@
+"""
+Load a File's rows into a database table.
+
+The table gets one column per file column, named from the header and typed from the inferred column types, widened
+where a value outside the sample they were inferred from doesn't fit, and rows are streamed in batches from the file's
+reader so the file never has to fit in memory.
+
+Big uncompressed files can be loaded over several connections at once: the file is split into byte ranges on row
+boundaries, each range is loaded into its own staging table by its own thread and connection, and the staging tables
+are then merged into the file's table in order. SQLite only has one writer at a time, so it always loads serially.
+"""
+import concurrent.futures
+import itertools
+import re
+
+from django.conf import settings
+from django.db import connections, transaction
+
+BATCH_SIZE = 5000  # Rows per executemany call.
+
+# Connections loading at once per database vendor, unless LIONEL_LOAD_PARALLELISM says otherwise.
+DEFAULT_PARALLELISM = {'postgresql': 4, 'oracle': 4, 'mysql': 2}
+
+MIN_RANGE_BYTES = 64 * 1024 ** 2  # Files are only split into ranges of at least this size.
+
+MAX_NAME_LENGTH = 30  # Oracle's identifier limit, the tightest of the backends we support.
+
+_VARCHAR = re.compile(r'^varchar2?\((\d+)\)$')
+
+
+def table_name(file):
+    """
+    Name the table a file is loaded into.
+
+    :param file: File obj, the file.
+    :return: str, the table name.
+    """
+    return 'lnl_file_{}'.format(file.pk)
+
+
+def column_names(header, width):
+    """
+    Turn a header into unique, database safe column names.
+
+    :param header: lst[str], the header row, may be empty.
+    :param width: int, the number of columns.
+    :return: lst[str], the column names.
+    """
+    names = []
+
+    for idx in range(width):
+        name = re.sub(r'\W+', '_', header[idx] if idx < len(header) else '').strip('_').lower()
+
+        if not name or name[0].isdigit():
+            name = 'col_{}'.format(idx) if not name else 'c_{}'.format(name)
+
+        name = name[:MAX_NAME_LENGTH]
+
+        while name in names:
+            suffix = '_{}'.format(idx)
+            name = name[:MAX_NAME_LENGTH - len(suffix)] + suffix
+
+        names.append(name)
+
+    return names
+
+
+def sql_type(col_type, vendor):
+    """
+    Map an inferred column type onto a type for a database vendor.
+
+    :param col_type: str or None, type from File.get_column_types, e.g. number, date or varchar2(10).
+    :param vendor: str, connection.vendor.
+    :return: str, the column type.
+    """
+    oracle = vendor == 'oracle'
+    match = _VARCHAR.match(col_type or '')
+
+    if col_type == 'number':
+        return 'NUMBER' if oracle else 'NUMERIC'
+    if col_type == 'date':
+        return 'DATE' if oracle else 'TIMESTAMP'
+    if match:
+        return '{}({})'.format('VARCHAR2' if oracle else 'VARCHAR', max(int(match.group(1)), 1))
+
+    return 'VARCHAR2(4000)' if oracle else 'TEXT'
+
+
+def fit_types(rows, types, batch_size=BATCH_SIZE):
+    """
+    Widen column types until every value in the file fits them.
+
+    The types stored on a file come from its sample, or its feed's template, so a value outside the sample may not fit:
+    a number or date column with a value that doesn't parse becomes text, a varchar too short for its longest value is
+    widened to fit it.
+
+    :param rows: iterable, every row of the file.
+    :param types: lst[str], the stored types in column order, None for text.
+    :param batch_size: int, rows checked at once.
+    :return: lst[str], types every value fits.
+    """
+    import pandas  # Deferred, most processes never need it.
+
+    types = list(types)
+
+    for batch in batches(rows, batch_size):
+        for position, col_type in enumerate(types):
+            if col_type is None:
+                continue
+
+            values = pandas.Series([row[position] for row in batch if position < len(row) and row[position] != ''],
+                                   dtype=object)
+
+            if values.empty:
+                continue
+
+            varchar = _VARCHAR.match(col_type)
+
+            if col_type == 'number':
+                misfit = pandas.to_numeric(values, errors='coerce').isnull().any()
+            elif col_type == 'date':
+                misfit = pandas.to_datetime(values, errors='coerce').isnull().any()
+            else:
+                misfit = False
+
+            if misfit:
+                types[position] = None
+            elif varchar and values.str.len().max() > int(varchar.group(1)):
+                types[position] = 'varchar2({})'.format(values.str.len().max())
+
+    return types
+
+
+def table_types(file, reader):
+    """
+    :param file: File obj, the file being loaded.
+    :param reader: FileReader, reader over it.
+    :return: lst[str], the types of its table's columns, its stored types widened to fit every row, see fit_types.
+    """
+    width = reader.width
+
+    return fit_types(reader.rows(), (file.get_column_types() + [None] * width)[:width])
+
+
+def clean_row(row, width):
+    """
+    Fit a row to the table width and turn empty strings into NULLs.
+
+    :param row: lst[str], the fields.
+    :param width: int, the number of columns.
+    :return: lst, the values to insert.
+    """
+    row = row[:width] + [None] * (width - len(row))
+
+    return [value if value != '' else None for value in row]
+
+
+def batches(rows, size):
+    """
+    Group an iterable of rows into lists.
+
+    :param rows: iterable, the rows.
+    :param size: int, rows per batch.
+    :return: generator, lists of at most size rows.
+    """
+    rows = iter(rows)
+
+    while True:
+        batch = list(itertools.islice(rows, size))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+def create_table(cursor, connection, table, names, types):
+    """
+    Create the table for a file, replacing any earlier load.
+
+    :param cursor: cursor, an open cursor.
+    :param connection: connection, the database connection.
+    :param table: str, the table name.
+    :param names: lst[str], column names.
+    :param types: lst[str], inferred column types.
+    """
+    quote = connection.ops.quote_name
+    columns = ', '.join('{} {}'.format(quote(name), sql_type(col_type, connection.vendor))
+                        for name, col_type in zip(names, types))
+
+    drop_table(table, connection.alias)
+    cursor.execute('CREATE TABLE {} ({})'.format(quote(table), columns))
+
+
+def insert_sql(connection, table, names):
+    """
+    :return: str, a parameterised INSERT for one row of the table.
+    """
+    quote = connection.ops.quote_name
+
+    return 'INSERT INTO {} ({}) VALUES ({})'.format(quote(table),
+                                                   ', '.join(quote(name) for name in names),
+                                                   ', '.join(['%s'] * len(names)))
+
+
+def drop_table(table, using='default'):
+    """
+    Drop a loaded table if it exists.
+
+    :param table: str, the table name.
+    :param using: str, database alias.
+    """
+    connection = connections[using]
+
+    if table in connection.introspection.table_names():
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE {}'.format(connection.ops.quote_name(table)))
+
+
+def load_file(file, using='default', batch_size=BATCH_SIZE, rows=None):
+    """
+    Load every row of a file into its table in one transaction.
+
+    :param file: File obj, the file to load, its table attribute is set to the table used.
+    :param using: str, database alias to load into.
+    :param batch_size: int, rows per executemany call.
+    :param rows: iterable, the rows to load if not all of the file's, e.g. only those that passed validation.
+    :return: int, the number of rows loaded.
+    """
+    connection = connections[using]
+    reader = file.reader()
+    width = reader.width
+
+    names = column_names(reader.header, width)
+    types = table_types(file, reader)
+    table = file.table or table_name(file)
+    loaded = 0
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        create_table(cursor, connection, table, names, types)
+        insert = insert_sql(connection, table, names)
+
+        for batch in batches(reader.rows() if rows is None else rows, batch_size):
+            cursor.executemany(insert, [clean_row(row, width) for row in batch])
+            loaded += len(batch)
+
+    file.table = table
+
+    return loaded
+
+
+def parallelism(using='default'):
+    """
+    How many connections may load at once into a database.
+
+    LIONEL_LOAD_PARALLELISM is either a number for every backend or a dict of vendor to number.
+
+    :param using: str, database alias.
+    :return: int, connections to load over, always 1 for SQLite.
+    """
+    vendor = connections[using].vendor
+
+    if vendor == 'sqlite':
+        return 1
+
+    configured = getattr(settings, 'LIONEL_LOAD_PARALLELISM', DEFAULT_PARALLELISM)
+
+    if isinstance(configured, dict):
+        configured = configured.get(vendor, 1)
+
+    return max(int(configured), 1)
+
+
+def load_range(reader, table, names, types, start, end, using='default', batch_size=BATCH_SIZE):
+    """
+    Load one byte range of a file into a staging table.
+
+    :param reader: FileReader, reader over the file.
+    :param table: str, the staging table.
+    :param names: lst[str], column names.
+    :param types: lst[str], inferred column types.
+    :param start: int, offset of the range's first row.
+    :param end: int, offset the range stops before.
+    :param using: str, database alias.
+    :param batch_size: int, rows per executemany call.
+    :return: int, the number of rows loaded.
+    """
+    connection = connections[using]
+    width = len(names)
+    loaded = 0
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        create_table(cursor, connection, table, names, types)
+        insert = insert_sql(connection, table, names)
+
+        for batch in batches(reader.range_rows(start, end), batch_size):
+            cursor.executemany(insert, [clean_row(row, width) for row in batch])
+            loaded += len(batch)
+
+    return loaded
+
+
+def _load_range_thread(reader, table, names, types, start, end, using, batch_size):
+    """
+    Load a range on a pool thread, see load_range, closing the thread's own connection afterwards.
+    """
+    try:
+        return load_range(reader, table, names, types, start, end, using, batch_size)
+    finally:
+        connections[using].close()
+
+
+def merge(table, staging, names, types, using='default'):
+    """
+    Create a file's table from its staging tables, in order.
+
+    :param table: str, the file's table.
+    :param staging: lst[str], the staging tables, in the order of their ranges.
+    :param names: lst[str], column names.
+    :param types: lst[str], inferred column types.
+    :param using: str, database alias.
+    """
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    columns = ', '.join(quote(name) for name in names)
+
+    with transaction.atomic(using=using), connection.cursor() as cursor:
+        create_table(cursor, connection, table, names, types)
+
+        for part in staging:
+            cursor.execute('INSERT INTO {} ({}) SELECT {} FROM {}'.format(quote(table), columns, columns, quote(part)))
+
+
+def load_ranges(file, ranges, using='default', batch_size=BATCH_SIZE, workers=1):
+    """
+    Load a file's byte ranges into staging tables, merge them into its table and drop them, whether or not it worked.
+
+    :param file: File obj, the file to load, its table attribute is set to the table used.
+    :param ranges: lst[tuple], (start, end) offsets of the ranges, from FileReader.split.
+    :param using: str, database alias to load into.
+    :param batch_size: int, rows per executemany call.
+    :param workers: int, connections to load the ranges over, 1 loads them one after another on this thread's.
+    :return: int, the number of rows loaded.
+    """
+    reader = file.reader()
+    width = reader.width
+    names = column_names(reader.header, width)
+    types = table_types(file, reader)
+    table = file.table or table_name(file)
+    staging = ['{}_p{}'.format(table[:MAX_NAME_LENGTH - 4], idx) for idx in range(len(ranges))]
+    jobs = [(reader, part, names, types, start, end, using, batch_size) for part, (start, end) in zip(staging, ranges)]
+
+    try:
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_load_range_thread, *job) for job in jobs]
+                loaded = sum(future.result() for future in futures)
+        else:
+            loaded = sum(load_range(*job) for job in jobs)
+
+        merge(table, staging, names, types, using)
+    finally:
+        for part in staging:
+            drop_table(part, using)
+
+    file.table = table
+
+    return loaded
+
+
+def load_parallel(file, using='default', batch_size=BATCH_SIZE, workers=None):
+    """
+    Load a file over several connections at once, see the module docstring.
+
+    Files that can't be split, because they are compressed or too small, and databases that only take one writer, even
+    if more workers are asked for, are loaded by load_file instead.
+
+    :param file: File obj, the file to load, its table attribute is set to the table used.
+    :param using: str, database alias to load into.
+    :param batch_size: int, rows per executemany call.
+    :param workers: int, connections to load over, parallelism() by default.
+    :return: int, the number of rows loaded.
+    """
+    workers = workers or parallelism(using)
+
+    if connections[using].vendor == 'sqlite':
+        workers = 1  # One writer at a time, whatever the caller asked for.
+    reader = file.reader()
+    ranges = None
+
+    if workers > 1 and reader.byte_addressable():
+        parts = min(workers, max(file.data.size // MIN_RANGE_BYTES, 1))
+        ranges = reader.split(parts) if parts > 1 else None
+
+    if not ranges or len(ranges) < 2:
+        return load_file(file, using=using, batch_size=batch_size)
+
+    return load_ranges(file, ranges, using=using, batch_size=batch_size, workers=workers)
@@ -0,0 +1,369 @@
+"""
+Concurrent load tests of the web endpoints.
+
+Simulated users log in, upload files of realistic sizes, preview them and submit procedures against a running server
+(HttpSession) or straight against the WSGI app in this process (ClientSession). Every request is timed into a Recorder
+which reports throughput, latency percentiles and error rates per endpoint.
+"""
+import http.cookiejar
+import itertools
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import resolve, reverse
+from django.test import Client
+
+from loader import bench, metrics
+
+# How often each simulated user picks each action, previews dominate real traffic.
+ACTION_WEIGHTS = (('preview', 6), ('upload', 2), ('procedure', 1))
+
+FILE_WIDTH = 10
+
+
+def file_rows(rand, median=1000, sigma=1.0, maximum=200000):
+    """
+    Draw a file size from a log-normal distribution, most uploads are small with a long tail of big ones.
+
+    :param rand: random.Random, source of randomness.
+    :param median: int, median number of rows.
+    :param sigma: float, spread of the distribution.
+    :param maximum: int, cap on the number of rows.
+    :return: int, rows in the file.
+    """
+    return max(1, min(int(rand.lognormvariate(math.log(median), sigma)), maximum))
+
+
+def file_pool(directory, count, median, sigma, maximum, seed=0):
+    """
+    Generate the files simulated users upload, held in memory so generating them isn't part of the test.
+
+    :param directory: str, scratch directory for generating the files.
+    :param count: int, number of distinct files.
+    :param median: int, median rows per file.
+    :param sigma: float, spread of the file sizes.
+    :param maximum: int, cap on rows per file.
+    :param seed: int, seed for reproducible files.
+    :return: lst[tuple], (file name, bytes) pairs.
+    """
+    rand = random.Random(seed)
+    pool = []
+
+    for idx in range(count):
+        name = 'load_{}.csv'.format(idx)
+        path = bench.generate_file('{}/{}'.format(directory, name), rows=file_rows(rand, median, sigma, maximum),
+                                   width=FILE_WIDTH, seed=seed + idx)
+
+        with open(path, 'rb') as data:
+            pool.append((name, data.read()))
+
+    return pool
+
+
+def encode_multipart(fields, files):
+    """
+    Encode a form as multipart/form-data.
+
+    :param fields: dict, plain form fields.
+    :param files: dict, field name to (file name, bytes).
+    :return: tuple, (body bytes, content type header).
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+
+    for name, value in fields.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+            boundary, name, value).encode('utf-8'))
+
+    for name, (filename, content) in files.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: text/csv\r\n\r\n'.format(boundary, name, filename).encode('utf-8'))
+        parts.append(content)
+        parts.append(b'\r\n')
+
+    parts.append('--{}--\r\n'.format(boundary).encode('utf-8'))
+
+    return b''.join(parts), 'multipart/form-data; boundary={}'.format(boundary)
+
+
+class HttpSession(object):
+    """
+    One simulated user talking to a server over HTTP, with its own cookies.
+    """
+
+    def __init__(self, base_url, timeout=60):
+        """
+        :param base_url: str, e.g. http://127.0.0.1:8000
+        :param timeout: float, seconds to wait for a response.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies))
+
+    def csrf_token(self):
+        """
+        :return: str, the CSRF token cookie, empty before the first page is fetched.
+        """
+        for cookie in self.cookies:
+            if cookie.name == settings.CSRF_COOKIE_NAME:
+                return cookie.value
+
+        return ''
+
+    def request(self, path, data=None, files=None):
+        """
+        Make a request, following redirects.
+
+        :param path: str, path on the server.
+        :param data: dict, form fields, the request is a POST if given.
+        :param files: dict, files to upload, field name to (file name, bytes).
+        :return: tuple, (status code, final path).
+        """
+        url = self.base_url + path
+        headers = {}
+        body = None
+
+        if data is not None:
+            data = dict(data, csrfmiddlewaretoken=self.csrf_token())
+            headers['Referer'] = url
+
+            if files:
+                body, headers['Content-Type'] = encode_multipart(data, files)
+            else:
+                body = urllib.parse.urlencode(data).encode('utf-8')
+                headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        try:
+            with self.opener.open(urllib.request.Request(url, body, headers), timeout=self.timeout) as response:
+                response.read()
+                return response.status, urllib.parse.urlparse(response.geturl()).path
+        except urllib.error.HTTPError as error:
+            return error.code, path
+
+
+class ClientSession(object):
+    """
+    One simulated user calling the WSGI app in this process through Django's test client.
+    """
+
+    def __init__(self):
+        self.client = Client()
+
+    def request(self, path, data=None, files=None):
+        """
+        Make a request, following redirects.
+
+        :param path: str, path in the app.
+        :param data: dict, form fields, the request is a POST if given.
+        :param files: dict, files to upload, field name to (file name, bytes).
+        :return: tuple, (status code, final path).
+        """
+        if data is None:
+            response = self.client.get(path, follow=True)
+        else:
+            data = dict(data)
+
+            for name, (filename, content) in (files or {}).items():
+                data[name] = SimpleUploadedFile(filename, content, content_type='text/csv')
+
+            response = self.client.post(path, data, follow=True)
+
+        final = response.redirect_chain[-1][0] if response.redirect_chain else path
+
+        return response.status_code, urllib.parse.urlparse(final).path
+
+
+class Recorder(object):
+    """
+    Thread safe store of request timings.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def add(self, endpoint, duration, ok):
+        """
+        :param endpoint: str, name of the endpoint.
+        :param duration: float, seconds the request took.
+        :param ok: bool, did it succeed?
+        """
+        with self.lock:
+            self.timings.setdefault(endpoint, []).append((duration, ok))
+
+    def report(self, elapsed):
+        """
+        Summarise the timings.
+
+        :param elapsed: float, wall clock seconds the test ran for.
+        :return: dict, per endpoint count, errors, error rate, throughput and latency percentiles.
+        """
+        report = {}
+
+        with self.lock:
+            for endpoint, timings in sorted(self.timings.items()):
+                durations = sorted(duration for duration, _ in timings)
+                errors = sum(1 for _, ok in timings if not ok)
+
+                report[endpoint] = {'count': len(timings),
+                                    'errors': errors,
+                                    'error_rate': errors / len(timings),
+                                    'throughput': len(timings) / elapsed if elapsed else None,
+                                    'mean': sum(durations) / len(durations),
+                                    'max': durations[-1]}
+                report[endpoint].update(('p{}'.format(int(quantile * 100)), metrics.percentile(durations, quantile))
+                                        for quantile in metrics.QUANTILES)
+
+        return report
+
+
+class SimulatedUser(object):
+    """
+    A user working through a random mix of uploads, previews and procedure runs.
+    """
+
+    def __init__(self, session, recorder, username, password, feed_pk, procedure_pk, pool, seed=0):
+        """
+        :param session: HttpSession or ClientSession, how requests are made.
+        :param recorder: Recorder, where timings go.
+        :param username: str, user to log in as.
+        :param password: str, their password.
+        :param feed_pk: int, feed to upload to.
+        :param procedure_pk: int or None, procedure to submit, None to skip procedure runs.
+        :param pool: lst[tuple], files to upload as (file name, bytes).
+        :param seed: int, seed for this user's choices.
+        """
+        self.session = session
+        self.recorder = recorder
+        self.username = username
+        self.password = password
+        self.feed_pk = feed_pk
+        self.procedure_pk = procedure_pk
+        self.pool = pool
+        self.rand = random.Random(seed)
+        self.files = []
+
+        actions = [(action, weight) for action, weight in ACTION_WEIGHTS
+                   if action != 'procedure' or procedure_pk is not None]
+        self.actions = [action for action, _ in actions]
+        self.cumulative = list(itertools.accumulate(weight for _, weight in actions))
+
+    def timed(self, endpoint, path, data=None, files=None, expect=None):
+        """
+        Make a timed request.
+
+        :param endpoint: str, name to record it under.
+        :param path: str, request path.
+        :param data: dict, POST fields.
+        :param files: dict, files to upload.
+        :param expect: str, URL name the request should end up on, anything else is an error.
+        :return: str or None, final path of a successful request.
+        """
+        start = time.perf_counter()
+
+        try:
+            status, final = self.session.request(path, data, files)
+            ok = status < 400 and (expect is None or resolve(final).url_name == expect)
+        except Exception:
+            final, ok = None, False
+
+        self.recorder.add(endpoint, time.perf_counter() - start, ok)
+
+        return final if ok else None
+
+    def login(self):
+        """
+        :return: bool, did the login work?
+        """
+        login_path = reverse('loader:login_to_app')
+        self.session.request(login_path)  # Picks up the CSRF cookie.
+
+        return self.timed('login', login_path, {'username': self.username, 'password': self.password},
+                          expect='user_home') is not None
+
+    def upload(self):
+        """
+        Upload a file from the pool, remembering it for later previews.
+        """
+        name, content = self.rand.choice(self.pool)
+        final = self.timed('upload', reverse('loader:load_file'), {'feed': self.feed_pk}, {'data': (name, content)},
+                           expect='view_file')
+
+        if final:
+            self.files.append(resolve(final).kwargs['pk'])
+
+    def preview(self):
+        """
+        Preview the head or the sample of one of our files.
+        """
+        view = self.rand.choice(('head', 'sample'))
+        self.timed('preview', '{}?view={}'.format(reverse('loader:view_file', args=[self.rand.choice(self.files)]),
+                                                  view))
+
+    def procedure(self):
+        """
+        Submit the procedure against one of our files.
+        """
+        path = reverse('loader:view_file', args=[self.rand.choice(self.files)])
+        self.timed('procedure', path, {'procedure': self.procedure_pk})
+
+    def run(self, deadline, max_requests=None):
+        """
+        Log in then keep making requests until the deadline.
+
+        :param deadline: float, time.perf_counter() value to stop at.
+        :param max_requests: int, stop after this many requests, None for no limit.
+        """
+        if not self.login():
+            return
+
+        for count in itertools.count():
+            if time.perf_counter() >= deadline or (max_requests is not None and count >= max_requests):
+                return
+
+            if not self.files:
+                action = 'upload'
+            else:
+                pick = self.rand.uniform(0, self.cumulative[-1])
+                action = next(action for action, limit in zip(self.actions, self.cumulative) if pick <= limit)
+
+            getattr(self, action)()
+
+
+def run(make_session, accounts, feed_pk, procedure_pk, pool, duration, max_requests=None, seed=0):
+    """
+    Run one load test with a thread per simulated user.
+
+    :param make_session: callable, returns a new HttpSession or ClientSession.
+    :param accounts: lst[tuple], (username, password) of each simulated user.
+    :param feed_pk: int, feed to upload to.
+    :param procedure_pk: int or None, procedure to submit.
+    :param pool: lst[tuple], files to upload.
+    :param duration: float, seconds to run for.
+    :param max_requests: int, requests per user after logging in, None for no limit.
+    :param seed: int, seed for the users' choices.
+    :return: dict, the Recorder report.
+    """
+    recorder = Recorder()
+    start = time.perf_counter()
+    deadline = start + duration
+
+    users = [SimulatedUser(make_session(), recorder, username, password, feed_pk, procedure_pk, pool, seed + idx)
+             for idx, (username, password) in enumerate(accounts)]
+    threads = [threading.Thread(target=user.run, args=(deadline, max_requests), daemon=True) for user in users]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return recorder.report(time.perf_counter() - start)
@@ -0,0 +1,63 @@
+import glob
+import os
+import random
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from loader import sniffer
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), 'test_corpus')
+
+
+def synthetic_sample(width, size=sniffer.SAMPLE_SIZE, seed=0):
+    """
+    Build a delimited sample with rows of the given width, filling up to size bytes.
+
+    :param width: int, number of columns in each row.
+    :param size: int, number of bytes to generate.
+    :param seed: int, seed so the sample is reproducible.
+    :return: bytes, the sample.
+    """
+    rand = random.Random(seed)
+    header = ','.join('col_{}'.format(idx) for idx in range(width)) + '\n'
+    lines = [header]
+    length = len(header)
+
+    while length < size:
+        line = ','.join(str(rand.randint(0, 10 ** 6)) for _ in range(width)) + '\n'
+        lines.append(line)
+        length += len(line)
+
+    return ''.join(lines).encode('utf-8')[:size]
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the bounded dialect detector against csv.Sniffer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=20, help='Timing runs per sample.')
+        parser.add_argument('--widths', type=int, nargs='*', default=[5, 50, 500],
+                            help='Column counts of the synthetic 64KB samples.')
+
+    def handle(self, *args, **options):
+        samples = [(os.path.basename(path), sniffer.read_sample(path))
+                   for path in sorted(glob.glob(os.path.join(CORPUS_DIR, '*')))
+                   if not path.endswith('.json')]
+        samples += [('synthetic_{}_cols'.format(width), synthetic_sample(width)) for width in options['widths']]
+
+        self.stdout.write('{:<24}{:>14}{:>14}{:>10}'.format('sample', 'detect (us)', 'Sniffer (us)', 'speedup'))
+
+        for name, sample in samples:
+            ours = min(timeit.repeat(lambda: sniffer.detect(sample), number=1, repeat=options['repeat']))
+
+            try:
+                theirs = min(timeit.repeat(lambda: sniffer.csv_sniffer(sample), number=1, repeat=options['repeat']))
+            except Exception:  # csv.Sniffer gives up on plenty of valid files.
+                theirs = None
+
+            self.stdout.write('{:<24}{:>14.1f}{:>14}{:>10}'.format(
+                name,
+                ours * 1e6,
+                '{:.1f}'.format(theirs * 1e6) if theirs else 'failed',
+                '{:.1f}x'.format(theirs / ours) if theirs else '-'))
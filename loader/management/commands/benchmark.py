@@ -0,0 +1,268 @@
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files import File as DjangoFile
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+
+from loader import bench, loading
+from loader.models import Feed, File, Procedure
+from loader.views import FileView
+
+STAGES = ('import', 'sniff', 'sample', 'preview_cold', 'preview_warm', 'profile', 'keys', 'load', 'dispatch')
+
+NOOP_PROCEDURE = b'import sys\nsys.stdout.write(sys.argv[1][:10])\n'
+
+
+class Command(BaseCommand):
+    help = ('Time every stage of the pipeline over a synthetic feed file and optionally compare the results with a '
+            'stored baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='Data rows in the generated file.')
+        parser.add_argument('--width', type=int, default=10, help='Columns in the generated file.')
+        parser.add_argument('--types', nargs='*', default=list(bench.TYPES), choices=bench.TYPES,
+                            help='Column types to cycle through.')
+        parser.add_argument('--quoting', default='minimal', choices=sorted(bench.QUOTING))
+        parser.add_argument('--delimiter', default=',')
+        parser.add_argument('--encoding', default='utf-8')
+        parser.add_argument('--compression', default='none', choices=sorted(bench.COMPRESSIONS))
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=3, help='Timing runs per stage, the best run is kept.')
+        parser.add_argument('--stages', nargs='*', default=list(STAGES), choices=STAGES)
+        parser.add_argument('--output', help='Write the JSON results here as well as to stdout.')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare against.')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Fraction a stage may be slower than the baseline before it counts as a regression.')
+
+    def handle(self, *args, **options):
+        workdir = tempfile.mkdtemp(prefix='lionel-bench-')
+
+        try:
+            path = bench.generate_file(os.path.join(workdir, 'bench.csv'),
+                                       rows=options['rows'],
+                                       width=options['width'],
+                                       types=tuple(options['types']),
+                                       quoting=options['quoting'],
+                                       delimiter=options['delimiter'],
+                                       encoding=options['encoding'],
+                                       compression=options['compression'],
+                                       seed=options['seed'])
+
+            # Uploads, previews and metrics written by the run all go to throwaway places.
+            with override_settings(MEDIA_ROOT=os.path.join(workdir, 'media'), LIONEL_METRICS=False):
+                with transaction.atomic():
+                    stages = self.run_stages(path, options)
+                    transaction.set_rollback(True)
+
+            results = {'meta': {'rows': options['rows'],
+                                'width': options['width'],
+                                'types': options['types'],
+                                'quoting': options['quoting'],
+                                'delimiter': options['delimiter'],
+                                'encoding': options['encoding'],
+                                'compression': options['compression'],
+                                'seed': options['seed'],
+                                'repeat': options['repeat'],
+                                'bytes': os.path.getsize(path),
+                                'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'time': time.time()},
+                       'stages': stages}
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        output = json.dumps(results, indent=2, sort_keys=True)
+        self.stdout.write(output)
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output)
+
+        if options['baseline']:
+            self.compare(results, options['baseline'], options['tolerance'])
+
+    def time_stage(self, work, repeat, setup=None):
+        """
+        Time a stage several times.
+
+        :param work: callable, the stage, it may return the number of rows it handled.
+        :param repeat: int, number of runs.
+        :param setup: callable, run untimed before each run.
+        :return: dict, best and mean seconds, rows and rows per second of the best run.
+        """
+        durations = []
+        rows = None
+
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+
+            start = time.perf_counter()
+            rows = work()
+            durations.append(time.perf_counter() - start)
+
+        best = min(durations)
+
+        return {'best': best,
+                'mean': sum(durations) / len(durations),
+                'rows': rows,
+                'rows_per_sec': rows / best if rows and best else None}
+
+    def time_imports(self, repeat):
+        """
+        Time a worker's cold start imports several times, see bench.import_report.
+
+        :param repeat: int, number of runs.
+        :return: dict, best and mean seconds spent importing, best wall clock and the heaviest imports of the best run.
+        """
+        reports = [bench.import_report(cwd=getattr(settings, 'BASE_DIR', None)) for _ in range(repeat)]
+        best = min(reports, key=lambda report: report['total'])
+
+        return {'best': best['total'],
+                'mean': sum(report['total'] for report in reports) / len(reports),
+                'rows': None,
+                'rows_per_sec': None,
+                'wall': min(report['wall'] for report in reports),
+                'heaviest': best['heaviest']}
+
+    def run_stages(self, path, options):
+        """
+        Upload the generated file and time each requested stage against it.
+
+        :param path: str, the generated file.
+        :param options: dict, command options.
+        :return: dict, timings keyed by stage name.
+        """
+        user = User.objects.create_user('lionel_benchmark', 'benchmark@example.com', 'benchmark')
+        feed = Feed.objects.create(name='lionel_benchmark')
+        feed.users.add(user)
+
+        file = File(user=user, feed=feed)
+
+        with open(path, 'rb') as data:
+            file.data.save(os.path.basename(path), DjangoFile(data), save=False)
+
+        file.save()
+        file.get_table_info()
+        file.save()
+
+        wanted = options['stages']
+        repeat = options['repeat']
+        rows = options['rows']
+        stages = {}
+
+        if 'import' in wanted:
+            stages['import'] = self.time_imports(repeat)
+
+        if 'sniff' in wanted:
+            stages['sniff'] = self.time_stage(lambda: file.get_table_info() and None, repeat)
+
+        if 'sample' in wanted or 'preview_cold' in wanted or 'preview_warm' in wanted:
+            file.take_sample()
+            file.infer_types()
+            file.save()
+
+            if 'sample' in wanted:
+                stages['sample'] = self.time_stage(lambda: file.take_sample() or rows, repeat)
+
+        if 'preview_cold' in wanted or 'preview_warm' in wanted:
+            request = RequestFactory().get('/files/{}/'.format(file.pk))
+            request.user = user
+            view = FileView.as_view()
+
+            def preview():
+                response = view(request, pk=file.pk)
+
+                if response.status_code != 200:
+                    raise CommandError('Preview returned {}'.format(response.status_code))
+
+            if 'preview_cold' in wanted:
+                stages['preview_cold'] = self.time_stage(preview, repeat, setup=cache.clear)
+            if 'preview_warm' in wanted:
+                preview()
+                stages['preview_warm'] = self.time_stage(preview, repeat)
+
+        if 'profile' in wanted or 'keys' in wanted:
+            def profile():
+                file.get_dataframe()
+                file.get_column_info()
+                return rows
+
+            if 'profile' in wanted:
+                stages['profile'] = self.time_stage(profile, repeat)
+            else:
+                profile()
+
+        if 'keys' in wanted:
+            def keys():
+                file.get_table_size()
+                file.possible_pk_cols()
+                return rows
+
+            stages['keys'] = self.time_stage(keys, repeat)
+
+        if 'load' in wanted:
+            stages['load'] = self.time_stage(lambda: loading.load_file(file), repeat)
+            loading.drop_table(file.table)
+
+        if 'dispatch' in wanted:
+            procedure = Procedure(language='Python', name='benchmark', comments='No-op benchmark procedure.',
+                                  user=user)
+            procedure.procedure.save('benchmark.py', ContentFile(NOOP_PROCEDURE))
+
+            # Procedures are run by their storage name, which is relative to MEDIA_ROOT.
+            cwd = os.getcwd()
+            os.chdir(settings.MEDIA_ROOT)
+
+            try:
+                stages['dispatch'] = self.time_stage(lambda: procedure.run(file) and None, repeat)
+            finally:
+                os.chdir(cwd)
+
+        return stages
+
+    def compare(self, results, baseline_path, tolerance):
+        """
+        Compare results with a baseline, raising if any stage got slower than the tolerance allows.
+
+        :param results: dict, this run's results.
+        :param baseline_path: str, path to an earlier run's JSON results.
+        :param tolerance: float, allowed fractional slowdown.
+        """
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        for key in ('rows', 'width', 'types', 'quoting', 'encoding', 'compression'):
+            if baseline['meta'].get(key) != results['meta'][key]:
+                self.stderr.write('Warning: baseline {} was {!r}, this run used {!r}.'.format(
+                    key, baseline['meta'].get(key), results['meta'][key]))
+
+        regressions = []
+
+        self.stderr.write('{:<14}{:>14}{:>14}{:>10}'.format('stage', 'baseline (s)', 'now (s)', 'change'))
+
+        for name, timing in sorted(results['stages'].items()):
+            before = baseline['stages'].get(name)
+
+            if not before:
+                continue
+
+            change = timing['best'] / before['best'] - 1 if before['best'] else 0
+            self.stderr.write('{:<14}{:>14.4f}{:>14.4f}{:>+9.1%}'.format(name, before['best'], timing['best'], change))
+
+            if change > tolerance:
+                regressions.append(name)
+
+        if regressions:
+            raise CommandError('Slower than the baseline by more than {:.0%}: {}'.format(tolerance,
+                                                                                       ', '.join(regressions)))
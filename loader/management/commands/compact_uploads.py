@@ -0,0 +1,45 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from loader import compaction
+from loader.models import Feed
+
+
+class Command(BaseCommand):
+    help = ("Recompress uploads older than their feed's compress_after days and remove those older than its "
+            "prune_after days, reporting the bytes reclaimed.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--feed', action='append', default=[],
+                            help='Only apply the policy of this feed, may be repeated.')
+        parser.add_argument('--dry-run', action='store_true', help='Report what would be done without doing it.')
+
+    def handle(self, *args, **options):
+        feeds = Feed.objects.exclude(compress_after=None, prune_after=None).order_by('name')
+
+        if options['feed']:
+            feeds = feeds.filter(name__in=options['feed'])
+
+            missing = set(options['feed']) - set(feeds.values_list('name', flat=True))
+
+            if missing:
+                raise CommandError('No retention policy on: {}.'.format(', '.join(sorted(missing))))
+
+        report = {'feeds': {}, 'dry_run': options['dry_run']}
+
+        for feed in feeds:
+            outcomes = []
+
+            for outcome in compaction.apply(feed, dry_run=options['dry_run']):
+                self.stderr.write('{:<10}{:>14}{:>14}  {}'.format(
+                    outcome.action, outcome.before, '-' if outcome.after is None else outcome.after,
+                    outcome.file.data.name))
+                outcomes.append(outcome)
+
+            report['feeds'][feed.name] = compaction.summarise(outcomes)
+
+        report['total'] = {key: sum(summary[key] for summary in report['feeds'].values())
+                           for key in compaction.summarise([])}
+
+        self.stdout.write(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,69 @@
+import json
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from loader import ingest
+from loader.models import Feed, Procedure
+
+
+class Command(BaseCommand):
+    help = ('Ingest every file in directories or glob patterns into a feed in parallel, skipping content the feed '
+            'already has.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Directories, files or glob patterns to ingest.')
+        parser.add_argument('--feed', required=True, help='Name of the feed the files belong to.')
+        parser.add_argument('--user', required=True, help='Username the files are recorded as uploaded by.')
+        parser.add_argument('--procedure', action='append', default=[],
+                            help='Name of a procedure to run on each loaded file, may be repeated.')
+        parser.add_argument('--workers', type=int, help='Worker threads, defaults to the number of CPUs.')
+        parser.add_argument('--recursive', action='store_true', help='Descend into subdirectories.')
+        parser.add_argument('--no-profile', action='store_true', help='Skip profiling every column.')
+        parser.add_argument('--no-load', action='store_true', help='Store and analyse files without loading them.')
+
+    def handle(self, *args, **options):
+        try:
+            feed = Feed.objects.get(name=options['feed'])
+            user = User.objects.get(username=options['user'])
+        except (Feed.DoesNotExist, User.DoesNotExist) as error:
+            raise CommandError(error)
+
+        if not feed.has_user(user):
+            raise CommandError('{} is not a member of the {} feed.'.format(user, feed))
+
+        procedures = []
+
+        for name in options['procedure']:
+            procedure = Procedure.objects.filter(name=name).first()
+
+            if procedure is None:
+                raise CommandError('No procedure called {}.'.format(name))
+
+            procedures.append(procedure)
+
+        paths = ingest.find_files(options['paths'], recursive=options['recursive'])
+
+        if not paths:
+            raise CommandError('No files found.')
+
+        ingester = ingest.Ingester(feed, user, procedures, profile=not options['no_profile'],
+                                   load=not options['no_load'])
+
+        def report(result):
+            message = '{:<9}{:>8.2f}s  {}'.format(result.status, result.seconds, result.path)
+
+            if result.error:
+                message += '  ({})'.format(result.error)
+
+            self.stderr.write(message)
+
+        start = time.perf_counter()
+        results = ingester.run(paths, workers=options['workers'], callback=report)
+        summary = ingest.summarise(results, time.perf_counter() - start)
+
+        self.stdout.write(json.dumps(summary, indent=2, sort_keys=True))
+
+        if summary['failed']:
+            raise CommandError('{} of {} files failed.'.format(summary['failed'], summary['files']))
@@ -0,0 +1,23 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from loader.models import ApiToken
+
+
+class Command(BaseCommand):
+    help = 'Issue an API token for a user, printing its key. The key is only ever shown this once.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username', help='User the token acts as.')
+        parser.add_argument('--name', default='api', help='What the token is for.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['username'])
+        except User.DoesNotExist as error:
+            raise CommandError(error)
+
+        token, key = ApiToken.issue(user, options['name'])
+
+        self.stderr.write('Issued token {} for {}'.format(token.name, user))
+        self.stdout.write(key)
@@ -0,0 +1,113 @@
+import functools
+import json
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+
+from loader import loadtest
+from loader.models import Feed, Procedure
+
+NOOP_PROCEDURE = b'import sys\nsys.stdout.write(sys.argv[1][:10])\n'
+
+
+class Command(BaseCommand):
+    help = ('Drive logins, uploads, previews and procedure runs from many concurrent simulated users and report '
+            'throughput, latency percentiles and error rates per endpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='Base URL of a running server, e.g. http://127.0.0.1:8000. Without it '
+                                          'requests go straight to the WSGI app in this process.')
+        parser.add_argument('--users', type=int, nargs='*', default=[1, 2, 4, 8, 16],
+                            help='Concurrency levels to step through, one run per level.')
+        parser.add_argument('--duration', type=float, default=30, help='Seconds to run each level for.')
+        parser.add_argument('--requests', type=int, help='Stop each user after this many requests.')
+        parser.add_argument('--files', type=int, default=20, help='Distinct files in the upload pool.')
+        parser.add_argument('--median-rows', type=int, default=1000, help='Median rows of an uploaded file.')
+        parser.add_argument('--sigma', type=float, default=1.0, help='Spread of the log-normal file sizes.')
+        parser.add_argument('--max-rows', type=int, default=200000, help='Largest file in rows.')
+        parser.add_argument('--password', default='loadtest', help='Password of the load test accounts.')
+        parser.add_argument('--no-procedures', action='store_true', help='Skip procedure submissions.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Write the JSON results here as well as to stdout.')
+
+    def setup(self, count, password, procedures):
+        """
+        Create, or reuse, the accounts, feed and procedure the simulated users work with.
+
+        The server under test has to share this database.
+
+        :param count: int, number of accounts needed.
+        :param password: str, password for the accounts.
+        :param procedures: bool, create a procedure to submit?
+        :return: tuple, (accounts as (username, password), feed pk, procedure pk or None).
+        """
+        feed, _ = Feed.objects.get_or_create(name='loadtest')
+        accounts = []
+
+        for idx in range(count):
+            username = 'loadtest_{}'.format(idx)
+            user = User.objects.filter(username=username).first()
+
+            if user is None:
+                user = User.objects.create_user(username, '{}@example.com'.format(username), password)
+            else:
+                user.set_password(password)
+                user.save()
+
+            feed.users.add(user)
+            accounts.append((username, password))
+
+        if not procedures:
+            return accounts, feed.pk, None
+
+        procedure = Procedure.objects.filter(name='loadtest').first()
+
+        if procedure is None:
+            procedure = Procedure(language='Python', name='loadtest', comments='No-op load test procedure.',
+                                  user=User.objects.get(username='loadtest_0'))
+            procedure.procedure.save('loadtest.py', ContentFile(NOOP_PROCEDURE))
+
+        return accounts, feed.pk, procedure.pk
+
+    def handle(self, *args, **options):
+        if not options['users'] or min(options['users']) < 1:
+            raise CommandError('--users needs at least one level of one or more users.')
+
+        accounts, feed_pk, procedure_pk = self.setup(max(options['users']), options['password'],
+                                                     not options['no_procedures'])
+
+        if options['url']:
+            make_session = functools.partial(loadtest.HttpSession, options['url'])
+        else:
+            make_session = loadtest.ClientSession
+
+        workdir = tempfile.mkdtemp(prefix='lionel-loadtest-')
+
+        try:
+            pool = loadtest.file_pool(workdir, options['files'], options['median_rows'], options['sigma'],
+                                      options['max_rows'], options['seed'])
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        results = []
+
+        for users in options['users']:
+            report = loadtest.run(make_session, accounts[:users], feed_pk, procedure_pk, pool,
+                                  options['duration'], options['requests'], options['seed'])
+            results.append({'users': users, 'endpoints': report})
+
+            for endpoint, stats in report.items():
+                self.stderr.write('{:>4} users {:<10}{:>8.1f} req/s  p50 {:>7.3f}s  p95 {:>7.3f}s  p99 {:>7.3f}s  '
+                                  'errors {:>6.1%}'.format(users, endpoint, stats['throughput'], stats['p50'],
+                                                           stats['p95'], stats['p99'], stats['error_rate']))
+
+        output = json.dumps({'url': options['url'], 'files': [len(content) for _, content in pool],
+                             'levels': results}, indent=2, sort_keys=True)
+        self.stdout.write(output)
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                output_file.write(output)
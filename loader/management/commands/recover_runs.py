@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from loader import runs
+from loader.models import ProcedureRun
+
+
+class Command(BaseCommand):
+    help = ('Carry out the procedure runs left queued, and fail those left running, by processes which have stopped. '
+            'Run it after a restart.')
+
+    def handle(self, *args, **options):
+        queued, failed = runs.recover(ProcedureRun, execute=True)
+
+        self.stdout.write('{} queued runs carried out, {} failed.'.format(queued, failed))
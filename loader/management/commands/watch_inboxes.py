@@ -0,0 +1,77 @@
+import concurrent.futures
+import os
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from loader import inbox, ingest
+from loader.models import Feed
+
+
+class Command(BaseCommand):
+    help = 'Watch the inbox directory of every feed that has one and ingest files as they arrive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', required=True, help='Username the files are recorded as uploaded by.')
+        parser.add_argument('--feed', action='append', default=[], help='Only watch these feeds, may be repeated.')
+        parser.add_argument('--workers', type=int, default=2, help='Files ingested at once.')
+        parser.add_argument('--backlog', type=int, help='Files allowed to queue for a worker.')
+        parser.add_argument('--settle', type=float, default=5, help='Seconds a file must stop growing before it is '
+                                                                     'taken, unless it has a .done marker.')
+        parser.add_argument('--interval', type=float, default=2, help='Seconds between rescans of the inboxes.')
+        parser.add_argument('--poll', action='store_true', help='Poll even where inotify is available.')
+        parser.add_argument('--once', action='store_true', help='Ingest the complete files waiting now and exit.')
+        parser.add_argument('--no-profile', action='store_true', help='Skip profiling every column.')
+        parser.add_argument('--no-load', action='store_true', help='Store and analyse files without loading them.')
+
+    def handle(self, *args, **options):
+        try:
+            user = User.objects.get(username=options['user'])
+        except User.DoesNotExist as error:
+            raise CommandError(error)
+
+        feeds = Feed.objects.exclude(inbox='')
+
+        if options['feed']:
+            feeds = feeds.filter(name__in=options['feed'])
+
+        ingesters = {}
+
+        for feed in feeds:
+            if not feed.has_user(user):
+                raise CommandError('{} is not a member of the {} feed.'.format(user, feed))
+
+            if not inbox.allowed_inbox(feed.inbox):
+                self.stderr.write('Skipping the {} feed, its inbox {} is not under LIONEL_INBOX_ROOTS.'.format(
+                    feed, feed.inbox))
+                continue
+
+            ingesters[os.path.abspath(feed.inbox)] = ingest.Ingester(feed, user, profile=not options['no_profile'],
+                                                                     load=not options['no_load'])
+
+        if not ingesters:
+            raise CommandError('No feeds have an inbox under LIONEL_INBOX_ROOTS.')
+
+        watcher = inbox.Watcher(ingesters, workers=options['workers'], backlog=options['backlog'],
+                                settle=options['settle'], interval=options['interval'], poll=options['poll'])
+
+        self.stderr.write('Watching {} inboxes with {}.'.format(len(ingesters), type(watcher.notifier).__name__))
+
+        if options['once']:
+            # A file has to be seen twice to know it has stopped growing, unless it has a marker.
+            watcher.scan()
+            time.sleep(options['settle'])
+            futures = watcher.run_once()
+
+            for future in concurrent.futures.as_completed(futures):
+                result = future.result()
+                self.stdout.write('{:<9}{:>8.2f}s  {}'.format(result.status, result.seconds, result.path))
+
+            watcher.close()
+            return
+
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            self.stderr.write('Stopped, waiting for files being ingested to finish.')
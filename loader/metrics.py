@@ -0,0 +1,258 @@
+"""
+Timing and counters for each stage of the pipeline.
+
+Wrap a piece of work in stage() (or a File method in timed()) and a StageMetric row is stored with its duration, the
+bytes and rows it handled and the peak RSS of the process. summarise() turns recent rows into per feed, per stage
+percentiles for the admin dashboard and totals() sums every row ever recorded, both aggregate in the database. They are
+served together in the Prometheus text format, the totals as counters which only ever go up, as rate() expects.
+"""
+import datetime
+import functools
+import logging
+import math
+import resource
+import sys
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.db.models import Case, Count, IntegerField, Max, Sum, When
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+WINDOW = 60 * 60 * 24  # Seconds of history the aggregates cover.
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# ru_maxrss is in kilobytes on Linux but bytes on macOS.
+_RSS_SCALE = 1 if sys.platform == 'darwin' else 1024
+
+
+def enabled():
+    """
+    :return: bool, should metrics be recorded? Set LIONEL_METRICS = False to turn them off.
+    """
+    return getattr(settings, 'LIONEL_METRICS', True)
+
+
+def peak_rss():
+    """
+    :return: int, the high-water mark of this process's resident memory in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_SCALE
+
+
+class stage(object):
+    """
+    Context manager recording how long a stage took.
+
+    Set bytes and rows on the object inside the block to record how much work was done:
+
+        with metrics.stage('load', file=file) as timer:
+            timer.rows = load(file)
+    """
+
+    def __init__(self, name, file=None, procedure=None, feed=None):
+        """
+        :param name: str, name of the stage, e.g. sniff or procedure.
+        :param file: File obj, the file being worked on, if any.
+        :param procedure: Procedure obj, the procedure being run, if any.
+        :param feed: Feed obj, the feed, taken from the file if not given.
+        """
+        self.name = name
+        self.file = file
+        self.procedure = procedure
+        self.feed = feed
+        self.bytes = None
+        self.rows = None
+        self.duration = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.perf_counter() - self._start
+
+        if enabled():
+            self.record(success=exc_type is None)
+
+        return False
+
+    def record(self, success=True):
+        """
+        Store the measurement, a failure to store is logged rather than breaking the work being measured.
+
+        :param success: bool, did the stage finish without raising?
+        """
+        feed = self.feed
+
+        if feed is None and self.file is not None:
+            feed = self.file.feed
+
+        try:
+            apps.get_model('loader', 'StageMetric').objects.create(
+                stage=self.name,
+                file=self.file if self.file is not None and self.file.pk else None,
+                procedure=self.procedure,
+                feed=feed,
+                duration=self.duration,
+                bytes=self.bytes,
+                rows=self.rows,
+                peak_rss=peak_rss(),
+                success=success)
+        except Exception:
+            logger.exception('Could not record metrics for stage %s', self.name)
+
+
+def timed(name):
+    """
+    Decorate a File method so every call is recorded as a stage against that file.
+
+    :param name: str, name of the stage.
+    :return: callable, the decorator.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(file, *args, **kwargs):
+            with stage(name, file=file):
+                return method(file, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def rank(count, quantile):
+    """
+    :param count: int, how many values there are.
+    :param quantile: float, between 0 and 1.
+    :return: int, index of the nearest rank percentile in the sorted values.
+    """
+    return min(max(int(math.ceil(quantile * count)) - 1, 0), count - 1)
+
+
+def percentile(values, quantile):
+    """
+    Nearest rank percentile of an already sorted list.
+
+    :param values: lst[float], sorted values.
+    :param quantile: float, between 0 and 1.
+    :return: float, the percentile.
+    """
+    return values[rank(len(values), quantile)]
+
+
+def _aggregate(measurements):
+    """
+    Group stage metrics per feed and stage, summed in the database.
+
+    :param measurements: QuerySet, StageMetric rows.
+    :return: QuerySet, a dict per (feed, stage) with count, sum, rows, bytes, failures and peak_rss.
+    """
+    failed = Case(When(success=False, then=1), default=0, output_field=IntegerField())
+
+    return (measurements.values('feed', 'feed__name', 'stage')
+            .annotate(count=Count('pk'), sum=Sum('duration'), rows=Sum('rows'), bytes=Sum('bytes'),
+                      failures=Sum(failed), peak_rss=Max('peak_rss'))
+            .order_by('feed__name', 'stage'))
+
+
+def _summary(group):
+    """
+    :param group: dict, a row of _aggregate.
+    :return: dict, the summary of one feed and stage, None sums as 0.
+    """
+    return {'feed': group['feed__name'] or '',
+            'stage': group['stage'],
+            'count': group['count'],
+            'sum': group['sum'] or 0,
+            'rows': group['rows'] or 0,
+            'bytes': group['bytes'] or 0,
+            'failures': group['failures'] or 0,
+            'peak_rss': group['peak_rss'] or 0}
+
+
+def summarise(window=WINDOW):
+    """
+    Aggregate recent stage metrics per feed and stage.
+
+    Only the percentiles need the durations themselves, each is fetched by its rank, one value per query.
+
+    :param window: int, seconds of history to include.
+    :return: lst[dict], one summary per (feed, stage) with count, sum, quantiles, rows, bytes, failures and peak RSS.
+    """
+    since = timezone.now() - datetime.timedelta(seconds=window)
+    recent = apps.get_model('loader', 'StageMetric').objects.filter(started__gte=since)
+    summaries = []
+
+    for group in _aggregate(recent):
+        durations = (recent.filter(feed=group['feed'], stage=group['stage'])
+                     .order_by('duration').values_list('duration', flat=True))
+
+        summary = _summary(group)
+        summary['quantiles'] = [(quantile, durations[rank(group['count'], quantile)]) for quantile in QUANTILES]
+        summaries.append(summary)
+
+    return summaries
+
+
+def totals():
+    """
+    Aggregate every stage metric ever recorded per feed and stage.
+
+    :return: lst[dict], one summary per (feed, stage) with count, sum, rows, bytes and failures.
+    """
+    return [_summary(group) for group in _aggregate(apps.get_model('loader', 'StageMetric').objects.all())]
+
+
+def _labels(**labels):
+    """
+    Format Prometheus labels, escaping values as the exposition format requires.
+
+    :param labels: dict, label names and values.
+    :return: str, the label set including braces.
+    """
+    escaped = ('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in sorted(labels.items()))
+
+    return '{' + ','.join(escaped) + '}'
+
+
+def prometheus_text(summaries, running_totals):
+    """
+    Render metrics in the Prometheus text exposition format.
+
+    Durations are a summary, its quantiles over the recent window, its sum and count over all time. Rows, bytes and
+    failures are counters over all time and the peak RSS is a gauge over the window.
+
+    :param summaries: lst[dict], as returned by summarise.
+    :param running_totals: lst[dict], as returned by totals.
+    :return: str, the exposition.
+    """
+    lines = ['# HELP lionel_stage_duration_seconds Time spent in each pipeline stage.',
+             '# TYPE lionel_stage_duration_seconds summary']
+
+    for summary in summaries:
+        for quantile, value in summary['quantiles']:
+            lines.append('lionel_stage_duration_seconds{} {:.6f}'.format(
+                _labels(feed=summary['feed'], stage=summary['stage'], quantile=quantile), value))
+
+    for total in running_totals:
+        labels = _labels(feed=total['feed'], stage=total['stage'])
+        lines.append('lionel_stage_duration_seconds_sum{} {:.6f}'.format(labels, total['sum']))
+        lines.append('lionel_stage_duration_seconds_count{} {}'.format(labels, total['count']))
+
+    for metric, key, kind, help_text, source in (
+            ('lionel_stage_rows_total', 'rows', 'counter', 'Rows handled.', running_totals),
+            ('lionel_stage_bytes_total', 'bytes', 'counter', 'Bytes handled.', running_totals),
+            ('lionel_stage_failures_total', 'failures', 'counter', 'Stages which raised.', running_totals),
+            ('lionel_stage_peak_rss_bytes', 'peak_rss', 'gauge',
+             'Highest process RSS seen at the end of a stage in the window.', summaries)):
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} {}'.format(metric, kind))
+
+        for summary in source:
+            lines.append('{}{} {}'.format(metric, _labels(feed=summary['feed'], stage=summary['stage']),
+                                          summary[key]))
+
+    return '\n'.join(lines) + '\n'
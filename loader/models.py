@@ -1,13 +1,23 @@
 import csv
 import datetime
+import hashlib
 import json
 import os
-import pandas
+import re
+import secrets
+import shutil
+import tempfile
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files import File as DjangoFile
+from django.core.validators import MinValueValidator
 from django.db import models, connection
+from django.utils import timezone
 
-from loader import plugins
+from loader import (admission, compaction, dedup, drift, keyindex, loading, metrics, plugins, profiling, readers,
+                    results, sampling, scheduler, sniffer, validation)
 
 
 def feed_directory_path(instance, filename):
@@ -26,6 +36,19 @@ def feed_directory_path(instance, filename):
                         filename)
 
 
+def reject_directory_path(instance, filename):
+    """
+    Function to return an upload path for reject files, beside the feed's uploads.
+
+    :param instance: File model instance.
+    :param filename: str, name of the reject file.
+    :return: str, complete filepath and name for the reject file.
+    """
+    return os.path.join('rejects',
+                        instance.feed.name,
+                        filename)
+
+
 def proc_directory_path(instance, filename):
     """
     Function to return an upload path for new files.
@@ -58,6 +81,139 @@ class Feed(models.Model):
 
     name = models.CharField(max_length=50, unique=True, null=False)
 
+    #####################
+    #    Schema Info    #
+    #####################
+
+    # The last accepted layout of files on this feed. This doubles as the feed's format template, new files which
+    # match it take its dialect, encoding and column types without being sniffed or profiled again.
+    # Only ever written by set_schema, a hand edited layout that isn't valid JSON would break every later upload.
+    schema = models.TextField(null=True, blank=True, editable=False)
+
+    block_on_drift = models.BooleanField(default=False)
+
+    #####################
+    #    Intake Info    #
+    #####################
+
+    # Directory upstream systems drop files into, watched by the watch_inboxes command.
+    inbox = models.CharField(max_length=255, blank=True)
+
+    #####################
+    #     Load Info     #
+    #####################
+
+    DEDUP_CHOICES = (('', 'Keep every row'),
+                     (dedup.KEY, 'Drop rows repeating a key'),
+                     (dedup.ROW, 'Drop repeated rows'))
+
+    DEDUP_KEEP_CHOICES = ((dedup.FIRST, 'First'),
+                          (dedup.LAST, 'Last'))
+
+    # Duplicates are dropped as files are loaded, see loader.dedup. The key is made of a file's special columns.
+    dedup = models.CharField(max_length=3, blank=True, default='', choices=DEDUP_CHOICES)
+
+    dedup_keep = models.CharField(max_length=5, default=DEDUP_KEEP_CHOICES[0][0], choices=DEDUP_KEEP_CHOICES)
+
+    #####################
+    #  Retention Info   #
+    #####################
+
+    # Uploads are recompressed after compress_after days and removed with everything derived from them after
+    # prune_after days, by the compact_uploads command. Blank means never.
+    compress_after = models.PositiveIntegerField(null=True, blank=True)
+
+    compression = models.CharField(max_length=4, default='xz', choices=compaction.CODEC_CHOICES)
+
+    prune_after = models.PositiveIntegerField(null=True, blank=True)
+
+    #####################
+    #  Scheduling Info  #
+    #####################
+
+    # Procedure runs on this feed take their turn against other feeds' by priority, then in proportion to weight, see
+    # loader.scheduler. max_runs caps how many go at once, blank means no cap. It is at least 1, a 0 saved without
+    # validation fails the feed's runs straight away.
+    priority = models.SmallIntegerField(default=0, help_text='Runs of higher priority feeds start first.')
+
+    weight = models.PositiveSmallIntegerField(default=1, help_text='Share of turns against feeds of the same priority.')
+
+    max_runs = models.PositiveSmallIntegerField(null=True, blank=True, validators=[MinValueValidator(1)])
+
+    # Limits on each run's process, blank takes the LIONEL_RUN_CPU_SECONDS, LIONEL_RUN_MEMORY and
+    # LIONEL_RUN_WALL_SECONDS settings.
+    cpu_limit = models.PositiveIntegerField(null=True, blank=True, help_text='CPU seconds.')
+
+    memory_limit = models.PositiveIntegerField(null=True, blank=True, help_text='Megabytes.')
+
+    wall_limit = models.PositiveIntegerField(null=True, blank=True, help_text='Wall clock seconds.')
+
+    #####################
+    #  Membership Info  #
+    #####################
+
+    MEMBERSHIP_KEY = 'loader:user_feeds:{}'  # Cache key for the feed ids a user belongs to.
+
+    @classmethod
+    def user_feed_ids(cls, user):
+        """
+        Return the ids of every feed a user belongs to, cached until their memberships change.
+
+        :param user: User, the user.
+        :return: frozenset[int], the feed ids.
+        """
+        key = cls.MEMBERSHIP_KEY.format(user.pk)
+        feed_ids = cache.get(key)
+
+        if feed_ids is None:
+            feed_ids = frozenset(cls.users.through.objects.filter(user_id=user.pk).values_list('feed_id', flat=True))
+            cache.set(key, feed_ids, None)
+
+        return feed_ids
+
+    @classmethod
+    def clear_membership_cache(cls, user_ids):
+        """
+        Forget the cached feed ids of some users.
+
+        :param user_ids: iterable[int], the users whose memberships changed.
+        """
+        cache.delete_many([cls.MEMBERSHIP_KEY.format(user_id) for user_id in user_ids])
+
+    def has_user(self, user):
+        """
+        Is a user allowed to use this feed?
+
+        Answered from the user's cached feed ids, loading them with a single query the first time.
+
+        :param user: User, the user to check.
+        :return: bool, is the user a member?
+        """
+        # Anonymous users have no pk, unlike is_authenticated this reads the same on every Django version.
+        if user.pk is None:
+            return False
+
+        return self.pk in Feed.user_feed_ids(user)
+
+    def get_schema(self):
+        """
+        Return the last accepted schema for this feed.
+
+        :return: dict, the schema or an empty dict if nothing has been accepted yet.
+        """
+        if self.schema:
+            return json.loads(self.schema)
+
+        return {}
+
+    def set_schema(self, schema):
+        """
+        Store a schema as the accepted layout for this feed.
+
+        :param schema: dict, schema as built by File.build_schema.
+        """
+        self.schema = json.dumps(schema)
+
     def __str__(self):
         """
         Return name of feed for when it is represented.
@@ -81,6 +237,40 @@ class Column(models.Model):
     col_type = models.CharField(max_length=30)
     comment = models.CharField(max_length=400, null=True)
 
+    ####################
+    # Validation Rules #
+    ####################
+
+    # Every row of a file column named after this one is checked against these as it is loaded, see loader.validation.
+    # col_type is checked too when it is number, date or varchar2(n).
+
+    required = models.BooleanField(default=False)  # Must every row have a value?
+    min_value = models.FloatField(null=True, blank=True)
+    max_value = models.FloatField(null=True, blank=True)
+    pattern = models.CharField(max_length=200, blank=True)  # Regular expression the whole value must match.
+    allowed = models.TextField(blank=True)  # One allowed value per line, anything goes if empty.
+
+    def get_allowed(self):
+        """
+        Return the allowed values as a list.
+
+        :return: lst[str], the values, empty if any value is allowed.
+        """
+        return [value for value in self.allowed.splitlines() if value]
+
+    def clean(self):
+        """
+        Make sure the pattern compiles and the range is the right way round.
+        """
+        if self.pattern:
+            try:
+                re.compile(self.pattern)
+            except re.error as error:
+                raise ValidationError({'pattern': 'Not a valid regular expression: {}'.format(error)})
+
+        if self.min_value is not None and self.max_value is not None and self.min_value > self.max_value:
+            raise ValidationError('The minimum value is above the maximum.')
+
     def __str__(self):
         """
         Return name of column for when it is represented.
@@ -115,6 +305,9 @@ class File(models.Model):
 
     delimiter = models.CharField(null=True, max_length=1, default=',')
     terminator = models.CharField(null=True, max_length=4, default='\n')
+    encoding = models.CharField(max_length=20, default='utf-8-sig')
+
+    checksum = models.CharField(max_length=64, blank=True, db_index=True)  # SHA-256 of the upload, to spot repeats.
 
     #####################
     #   Database Info   #
@@ -122,8 +315,33 @@ class File(models.Model):
 
     table = models.CharField(max_length=30, blank=True)
 
+    rejects = models.FileField(upload_to=reject_directory_path, blank=True)  # Rows that failed validation on load.
+
+    rejected = models.IntegerField(default=0)
+
+    duplicates = models.FileField(upload_to=reject_directory_path, blank=True)  # Rows dropped as duplicates on load.
+
+    duplicated = models.IntegerField(default=0)
+
     columns = models.TextField(null=True, blank=True)
 
+    column_types = models.TextField(null=True, blank=True)
+
+    sample = models.TextField(null=True, blank=True)  # Reservoir sample of rows, taken at upload.
+
+    #####################
+    #    Schema Info    #
+    #####################
+
+    schema = models.TextField(null=True, blank=True)  # Layout as detected at upload.
+
+    accepted = models.BooleanField(default=True)  # False while blocked by schema drift.
+
+    class Meta:
+        # Listings are filtered by feed or user and paged newest first.
+        index_together = [('feed', 'upload_date'),
+                          ('user', 'upload_date')]
+
     def get_columns(self):
         """
         Return file column headers as a list.
@@ -145,79 +363,430 @@ class File(models.Model):
 
         self.columns = json.dumps(lst)
 
-    def get_first_lines(self, num=10):
+    def get_column_types(self):
+        """
+        Return the sql friendly type of each column as a list.
+
+        :return: list, types in column order, empty if they haven't been inferred.
+        """
+        if self.column_types:
+            return json.loads(self.column_types)
+
+        return []
+
+    def set_column_types(self, lst):
+        """
+        Take a list of column types and store them.
+
+        :param lst: lst, the sql friendly type of each column.
+        """
+        self.column_types = json.dumps(lst)
+
+    def set_checksum(self):
+        """
+        Hash the stored upload so the same content isn't ingested twice.
+
+        :return: str, the checksum.
+        """
+        self.checksum = readers.checksum(self.data.path)
+
+        return self.checksum
+
+    def reader(self, **kwargs):
+        """
+        Return a reader over this file using its stored dialect.
+
+        The default reader is kept on the instance so its header and page index are only worked out once.
+
+        :param kwargs: dict, overrides for the reader settings, e.g. a different encoding.
+        :return: FileReader, the reader.
+        """
+        if kwargs:
+            return readers.FileReader.for_file(self, **kwargs)
+
+        settings = (self.data.name, self.delimiter, self.encoding, self.has_header, self.terminator)
+
+        if getattr(self, '_reader', None) is None or self._reader_settings != settings:
+            self._reader = readers.FileReader.for_file(self)
+            self._reader_settings = settings
+
+        return self._reader
+
+    @metrics.timed('sample')
+    def take_sample(self, size=sampling.SAMPLE_ROWS, strata=sampling.STRATA):
+        """
+        Take a reservoir sample of the file's rows in a single pass and store it.
+
+        :param size: int, the most rows to keep.
+        :param strata: int, number of byte ranges to spread the sample over.
+        :return: lst[tuple], (row number, fields) pairs in file order.
+        """
+        rows = sampling.sample_rows(self.reader(), size=size, strata=strata, seed=self.pk)
+
+        self.sample = json.dumps(rows)
+
+        return rows
+
+    def get_sample(self):
+        """
+        Return the stored sample of rows.
+
+        :return: lst[lst], [row number, fields] pairs in file order, empty if no sample has been taken.
+        """
+        if self.sample:
+            return json.loads(self.sample)
+
+        return []
+
+    @metrics.timed('infer')
+    def infer_types(self):
+        """
+        Infer the sql friendly type of each column from the stored sample rather than the whole file.
+
+        :return: lst[str], the types in column order.
+        """
+        reader = self.reader()
+        names = reader.header or list(range(reader.width))
+
+        import pandas  # Deferred, most processes never need it.
+
+        rows = [values for _, values in self.get_sample() if len(values) == len(names)]
+        sample_df = pandas.DataFrame(rows, columns=names).replace('', float('nan'))
+
+        for col in names:
+            try:
+                sample_df[col] = pandas.to_numeric(sample_df[col])
+            except (ValueError, TypeError):
+                pass
+
+        column_types = [self.get_datatype_of_column(col, sample_df) for col in names]
+        self.set_column_types(column_types)
+
+        return column_types
+
+    def get_first_lines(self, num=10, encoding=None):
         """
         Open the file and return the first few lines decided by num.
 
+        Files with fewer lines than num just return every line they have.
+
         :param num: int, the number of lines to be returned.
+        :param encoding: str, encoding to read with, defaults to the encoding of the file.
         :return: lst[str], the list of lines to be returned.
         """
-        with open(self.data.name) as data_file:
-            data = [next(data_file) for _ in range(num)]
+        return self.reader(encoding=encoding or self.encoding).lines(num)
+
+    TEMPLATE_CHECK_LINES = 5  # How many lines to read when checking a file against its feed's template.
+
+    def matches_template(self, template):
+        """
+        Cheaply check whether this file is laid out the same as a feed template.
 
-        return data
+        Only the first few lines are read, they must decode with the template encoding, split into the template width
+        and, when the template has a header, start with the same header.
+
+        :param template: dict, the feed schema to check against.
+        :return: bool, does the file match?
+        """
+        try:
+            lines = self.get_first_lines(self.TEMPLATE_CHECK_LINES, encoding=template.get('encoding'))
+        except (UnicodeDecodeError, LookupError):
+            return False
 
+        rows = list(csv.reader(lines, delimiter=template['delimiter']))
+
+        if not rows or any(len(row) != template['width'] for row in rows):
+            return False
+
+        if template['has_header'] and rows[0] != template['columns']:
+            return False
+
+        return True
+
+    def apply_template(self, template):
+        """
+        Take the dialect, encoding and column types from a feed template.
+
+        :param template: dict, the feed schema to copy from.
+        """
+        self.delimiter = template['delimiter']
+        self.has_header = template['has_header']
+        self.terminator = template.get('terminator', self.terminator)
+        self.encoding = template.get('encoding', self.encoding)
+
+        if template.get('types'):
+            self.set_column_types(template['types'])
+
+    def sample_fits_types(self, types):
+        """
+        Check every value in the stored sample still fits its column's type, e.g. the types of a feed template.
+
+        :param types: lst[str], the types in column order.
+        :return: bool, do all of the sampled values fit?
+        """
+        import pandas  # Deferred, most processes never need it.
+
+        rows = [values for _, values in self.get_sample() if len(values) == len(types)]
+
+        for position, col_type in enumerate(types):
+            values = pandas.Series([row[position] for row in rows], dtype=object)
+            values = values[values != '']
+            varchar = re.match(r'^varchar2?\((\d+)\)$', col_type or '')
+
+            if col_type == 'number':
+                misfits = pandas.to_numeric(values, errors='coerce').isnull()
+            elif col_type == 'date':
+                misfits = pandas.to_datetime(values, errors='coerce').isnull()
+            elif varchar:
+                misfits = values.str.len() > int(varchar.group(1))
+            else:
+                continue
+
+            if misfits.any():
+                return False
+
+        return True
+
+    @metrics.timed('sniff')
     def get_table_info(self):
         """
         Do some initial sniffing to understand the format of a file.
+
+        If the feed has learnt a template and this file matches it we take the template and skip sniffing entirely.
+
+        :return: bool, True if the feed template was used.
         """
-        dialect = csv.Sniffer().sniff(''.join(self.get_first_lines()))
+        template = self.feed.get_schema()
+
+        if template and self.matches_template(template):
+            self.apply_template(template)
+            return True
+
+        with self.reader().open_binary() as data_file:
+            dialect = sniffer.sniff_file(data_file)
 
         self.delimiter = dialect.delimiter
 
         self.terminator = dialect.lineterminator
 
-        self.has_header = csv.Sniffer().has_header(''.join(self.get_first_lines()))
-        
+        self.encoding = dialect.encoding
+
+        self.has_header = dialect.has_header
+
+        return False
+
+    def build_schema(self):
+        """
+        Build the schema of this file from its dialect, first row and any known column types.
+
+        Only the first line is read so this is cheap regardless of the file size.
+
+        :return: dict, the schema of this file.
+        """
+        first_row = self.reader().first_row
+
+        schema = {'delimiter': self.delimiter,
+                  'terminator': self.terminator,
+                  'encoding': self.encoding,
+                  'has_header': self.has_header,
+                  'width': len(first_row),
+                  'columns': first_row if self.has_header else [],
+                  'types': self.get_column_types()}
+
+        self.schema = json.dumps(schema)
+
+        return schema
+
+    def get_schema(self):
+        """
+        Return the schema stored for this file.
+
+        :return: dict, the schema or an empty dict if it hasn't been built.
+        """
+        if self.schema:
+            return json.loads(self.schema)
+
+        return {}
+
+    @metrics.timed('drift')
+    def check_drift(self):
+        """
+        Compare this file against the last accepted schema of its feed.
+
+        The first file on a feed sets the schema. After that any difference is recorded as a SchemaDrift,
+        if the feed blocks on drift the file is left unaccepted until someone approves it.
+
+        :return: SchemaDrift or None, the drift record if the layout changed.
+        """
+        schema = self.get_schema() or self.build_schema()
+        accepted_schema = self.feed.get_schema()
+
+        changes = drift.compare_schemas(accepted_schema, schema) if accepted_schema else []
+
+        if changes:
+            blocked = self.feed.block_on_drift
+            self.accepted = not blocked
+            record = SchemaDrift.objects.create(feed=self.feed,
+                                                file=self,
+                                                changes=json.dumps(changes),
+                                                blocked=blocked)
+        else:
+            record = None
+
+        if self.accepted:
+            self.feed.set_schema(schema)
+            self.feed.save()
+
+        return record
+
+    def analyse(self):
+        """
+        Work out everything we need to know about a new upload before any heavy work is done.
+
+        The dialect comes from the feed template or a sniff and a sample is taken for previews. Column types are
+        inferred from that sample, unless the template gave us types every sampled value still fits, so a column
+        whose values changed type is seen as drift. Finally the layout is checked for drift.
+
+        :return: SchemaDrift or None, the drift record if the layout changed.
+        """
+        from_template = self.get_table_info()
+
+        self.take_sample()
+
+        types = self.get_column_types() if from_template else []
+
+        if not types or not self.sample_fits_types(types):
+            self.infer_types()
+
+        return self.check_drift()
+
+    def accept(self):
+        """
+        Accept this file's layout as the new schema for its feed.
+        """
+        self.accepted = True
+        self.save()
+
+        self.feed.set_schema(self.get_schema())
+        self.feed.save()
+
+    @metrics.timed('dataframe')
     def get_dataframe(self):
         '''
         Insert the file into a dataframe so we can anaylse it
         '''
-        if self.has_header == True:
-            skip = 1
-        else:
-            skip = 0
-        self.df = pandas.read_csv( self.data.name
-                                 , delimiter = self.delimiter
-                                 , lineterminator = self.terminator
-                                 , header = None
-                                 , names = self.columns
-                                 , skiprows = skip)
-                                 
-    def get_datatype_of_column(self, col):
+        self.df = self.reader().dataframe()
+
+    def get_datatype_of_column(self, col, df=None):
         '''
-        This tells us the sql friendly datatype of the column
+        This tells us the sql friendly datatype of the column, from self.df unless another frame is given
         '''
-        if self.df[col].dtype in ('float64', 'int64'):
+        if df is None:
+            df = self.df
+        if df[col].dtype in ('float64', 'int64'):
             return 'number'
-        if self.df[col].dtype == 'object':
+        if df[col].dtype == 'object':
+            import pandas
+
             try:
-                self.df[col] = pandas.to_datetime(self.df[col])
+                df[col] = pandas.to_datetime(df[col])
                 return 'date'
             except ValueError:
-                l_col_len = self.df[col].str.len().max()
+                l_col_len = df[col].str.len().max()
                 return 'varchar2(' + str(l_col_len) + ')'
         
+    @metrics.timed('profile')
     def get_column_info(self):
         '''
         Get some information on the columns so we can determine datatypes and 
         a primary key for loading the table 
         '''
-        column_types = [self.get_datatype_of_column(e) for e in self.columns]
-        no_of_uniques = [self.df[e].nunique() for e in self.columns]
+        columns = list(self.df.columns)
+        # Types learnt from the feed template are trusted rather than inferred again.
+        column_types = self.get_column_types() or [self.get_datatype_of_column(e) for e in columns]
+        self.set_column_types(column_types)
+        no_of_uniques = [self.df[e].nunique() for e in columns]
         number_of_nulls = list(self.df.isnull().sum())
-        # TODO Rob: Uncommented as we use column_pos in next row
-        column_pos = list(range(0, len(self.columns) +1))
-        column_info_dict = dict(zip(self.columns, zip(column_pos, column_types, no_of_uniques, number_of_nulls)))
-        self.column_info = zip(self.columns, column_types, no_of_uniques, number_of_nulls) 
-        
+        # A list rather than a zip so it can be walked more than once.
+        self.column_info = list(zip(columns, column_types, no_of_uniques, number_of_nulls))
+
     def get_table_size(self):
         '''
         Get height and width of table 
         '''
         self.table_size = self.df.shape
 
-    def possible_pk_cols(self, e):
+    # Distinct values held at once, between all columns, while profiling in chunks.
+    CHUNKED_UNIQUE_LIMIT = 10 ** 6
+
+    @metrics.timed('profile')
+    def get_column_info_chunked(self, size=readers.CHUNK_SIZE, unique_limit=CHUNKED_UNIQUE_LIMIT):
+        """
+        Profile the file a chunk at a time, for files too big to hold in one DataFrame.
+
+        Gives the same column_info and table_size as get_column_info and get_table_size, except that exact unique
+        counts are only kept while a column is still entirely unique and its share of unique_limit holds its values, any
+        other column gets None.
+
+        :param size: int, rows per chunk.
+        :param unique_limit: int, distinct values held at once between all the columns.
+        """
+        columns = None
+        column_types = self.get_column_types()
+        nulls = None
+        seen = None
+        rows = 0
+
+        for chunk in self.reader().chunks(size):
+            if columns is None:
+                columns = list(chunk.columns)
+                column_types = column_types or [self.get_datatype_of_column(e, df=chunk) for e in columns]
+                nulls = [0] * len(columns)
+                seen = [set() for _ in columns]
+                cap = max(unique_limit // max(len(columns), 1), 1)
+
+            rows += len(chunk)
+
+            for idx, count in enumerate(chunk.isnull().sum()):
+                nulls[idx] += int(count)
+
+            for idx, col in enumerate(columns):
+                if seen[idx] is None:
+                    continue
+
+                values = chunk[col].dropna()
+                before = len(seen[idx])
+                seen[idx].update(values)
+
+                # Once a value repeats the column can't be a key, stop holding its values. A column past its share is
+                # given up on too, so the sets never outgrow the limit by more than a chunk.
+                if len(seen[idx]) - before < len(values) or len(seen[idx]) > cap:
+                    seen[idx] = None
+
+        columns = columns or []
+        self.set_column_types(column_types or [])
+        uniques = [len(values) if values is not None else None for values in seen or []]
+        self.column_info = list(zip(columns, column_types or [], uniques, nulls or []))
+        self.table_size = (rows, len(columns))
+
+    def profile_columns(self):
+        """
+        Profile the file's columns, within the node's memory budget, see loader.admission.
+
+        Files whose DataFrame wouldn't fit are profiled in chunks instead of waiting for the memory.
+        """
+        with admission.admit('profile', admission.estimate(self, 'profile'),
+                             fallback=admission.estimate(self, 'chunked')) as ticket:
+            if ticket.downgraded:
+                self.get_column_info_chunked()
+                return
+
+            self.get_dataframe()
+            self.get_column_info()
+            self.get_table_size()
+            del self.df
+
+    def possible_pk_cols(self):
         '''
         We want to find the selection of columns that are not null, and whose product is greater
         than the number of rows in the table
@@ -228,9 +797,7 @@ class File(models.Model):
         of rows in the table then that column is unique and can be the primary key.
         If so, we choose the column closest to the left. 
         '''
-        # TODO Rob: I just added this e to parameters don't know what it's for
-        # TODO Rob: Saved unique_cols for later user, correct? see line 247
-        self.unique_cols = [ a for a,b,c,d in self.column_info if e == self.table_size[0] ]
+        self.unique_cols = [ a for a,b,c,d in self.column_info if c == self.table_size[0] and a in not_null_cols ]
         if len(self.unique_cols) != 0:
             self.pk = self.unique_cols[0]
         else:
@@ -238,8 +805,8 @@ class File(models.Model):
             If no single column can be a primary key then we need to find a combination of columns
             that can be unique
             '''
-            pass 
-        
+            self.pk = None
+
     def are_cols_pk(self, cols):
         '''
         We check if a list of columns could possibly be a primary key
@@ -252,6 +819,133 @@ class File(models.Model):
         else:
             return False   
 
+    def key_columns(self):
+        """
+        Find the columns holding special column keys, matched by name against the column names given on the file
+        page, or the header if none have been given.
+
+        :return: lst[tuple], (position, Column) pairs.
+        """
+        names = self.get_columns() or self.reader().header
+        special = {column.name.lower(): column for column in Column.objects.all()}
+
+        return [(position, special[name.lower()]) for position, name in enumerate(names)
+                if name and name.lower() in special]
+
+    @metrics.timed('index')
+    def build_key_indexes(self):
+        """
+        Index the keys of every special column so lookups can find this file, replacing any earlier indexes.
+
+        :return: lst[KeyIndex], the new indexes.
+        """
+        columns = dict(self.key_columns())
+
+        with admission.admit('index', admission.estimate(self, 'index')):
+            built = keyindex.build(self.reader(), list(columns))
+
+        indexes = []
+
+        for old in self.keyindex_set.all():
+            old.keys.delete(save=False)
+            old.delete()
+
+        for position, (bloom, path, count) in built.items():
+            index = KeyIndex(file=self, column=columns[position], position=position, bloom=bytes(bloom.data),
+                             bits=bloom.bits, hashes=bloom.hashes, count=count)
+
+            try:
+                with open(path, 'rb') as key_file:
+                    index.keys.save('{}_{}.idx'.format(self.pk, position), DjangoFile(key_file), save=False)
+            finally:
+                os.remove(path)
+
+            index.save()
+            indexes.append(index)
+
+        return indexes
+
+    def load_table(self, using='default'):
+        """
+        Load the file's rows into its database table, see loader.loading.
+
+        :param using: str, database alias to load into.
+        :return: int, the number of rows loaded.
+        """
+        # Every connection loading at once holds a batch.
+        size = admission.estimate(self, 'load') * loading.parallelism(using)
+
+        with admission.admit('load', size), metrics.stage('load', file=self) as timer:
+            timer.rows = self.load_checked(using)
+            timer.bytes = self.data.size
+
+        return timer.rows
+
+    def load_checked(self, using='default'):
+        """
+        Load the file's rows through validation and deduplication, where its columns and feed ask for them.
+
+        Rows that fail validation go to the file's reject file, duplicates dropped go to its duplicate report.
+
+        :param using: str, database alias to load into.
+        :return: int, the number of rows loaded.
+        """
+        reader = self.reader()
+        delimiter = reader.delimiter or ','
+        validator = validation.Validator.for_file(self)
+        deduplicator = dedup.Deduplicator.for_file(self)
+        quarantine = report = None
+
+        if not validator and not deduplicator:
+            # Nothing has to see the rows in order, so they can go in over several connections at once.
+            loaded = loading.load_parallel(self, using=using)
+
+            self.rejected = self.keep_report(self.rejects, None, None, 'rejects')
+            self.duplicated = self.keep_report(self.duplicates, None, None, 'duplicates')
+
+            return loaded
+
+        with tempfile.NamedTemporaryFile('w+', encoding='utf-8', newline='', suffix='.csv') as reject_file, \
+                tempfile.NamedTemporaryFile('w+', encoding='utf-8', newline='', suffix='.csv') as duplicate_file:
+            rows = enumerate(reader.rows())
+
+            if validator:
+                quarantine = validation.Quarantine(reject_file, reader.header, delimiter)
+                rows = validation.checked_rows(rows, validator, quarantine)
+
+            if deduplicator:
+                report = dedup.Report(duplicate_file, reader.header, delimiter)
+                rows = deduplicator.unique(rows, report)
+
+            loaded = loading.load_file(self, using=using, rows=(row for _, row in rows))
+
+            self.rejected = self.keep_report(self.rejects, reject_file, quarantine, 'rejects')
+            self.duplicated = self.keep_report(self.duplicates, duplicate_file, report, 'duplicates')
+
+        return loaded
+
+    def keep_report(self, field, stream, report, suffix):
+        """
+        Store a report of the rows dropped from a load in place of the last one.
+
+        :param field: FieldFile, where the report is kept.
+        :param stream: file obj, the report written so far.
+        :param report: Quarantine or Report or None, what was written, None if the stage didn't run.
+        :param suffix: str, added to the file's name to name the report.
+        :return: int, the number of rows in the report.
+        """
+        if field:
+            field.delete(save=False)
+
+        if report is None or not report.count:
+            return 0
+
+        stream.seek(0)
+        field.save('{}_{}.csv'.format(os.path.splitext(os.path.basename(self.data.name))[0], suffix),
+                   DjangoFile(stream), save=False)
+
+        return report.count
+
     def open_cursor(self):
         """
         Return a cursor to the database
@@ -269,6 +963,225 @@ class File(models.Model):
         return os.path.split(self.data.name)[-1]
 
 
+class SchemaDrift(models.Model):
+    """
+    Record of an upload whose layout differed from the accepted schema of its feed.
+    """
+
+    #####################
+    #  Relational Info  #
+    #####################
+
+    feed = models.ForeignKey(Feed)
+    file = models.ForeignKey(File)
+
+    #####################
+    #    Drift Info     #
+    #####################
+
+    detected = models.DateTimeField(auto_now_add=True)
+
+    changes = models.TextField()
+
+    blocked = models.BooleanField(default=False)
+
+    def get_changes(self):
+        """
+        Return the changes found as a list.
+
+        :return: lst[dict], changes as given by drift.compare_schemas.
+        """
+        return json.loads(self.changes)
+
+    def describe(self):
+        """
+        Return readable descriptions of every change.
+
+        :return: lst[str], one sentence per change.
+        """
+        return [drift.describe(change) for change in self.get_changes()]
+
+    def __str__(self):
+        """
+        Name the file and how much changed.
+
+        :return: str, identifying string for this drift.
+        """
+        return '{}: {} change(s)'.format(self.file, len(self.get_changes()))
+
+
+class StageMetric(models.Model):
+    """
+    Timing and counters for one run of a pipeline stage, see loader.metrics.
+    """
+
+    #####################
+    #  Relational Info  #
+    #####################
+
+    feed = models.ForeignKey(Feed, null=True, blank=True, on_delete=models.SET_NULL)
+    file = models.ForeignKey(File, null=True, blank=True, on_delete=models.SET_NULL)
+    procedure = models.ForeignKey('Procedure', null=True, blank=True, on_delete=models.SET_NULL)
+
+    #####################
+    #   Measurements    #
+    #####################
+
+    stage = models.CharField(max_length=30)
+    started = models.DateTimeField(auto_now_add=True)
+    duration = models.FloatField()  # Seconds.
+
+    bytes = models.BigIntegerField(null=True, blank=True)
+    rows = models.BigIntegerField(null=True, blank=True)
+    peak_rss = models.BigIntegerField(null=True, blank=True)  # Process high-water mark in bytes.
+
+    success = models.BooleanField(default=True)
+
+    class Meta:
+        index_together = [('started', 'feed', 'stage')]
+
+    def __str__(self):
+        """
+        Name the stage and how long it took.
+
+        :return: str, identifying string for this measurement.
+        """
+        return '{} {:.3f}s'.format(self.stage, self.duration)
+
+
+def index_directory_path(instance, filename):
+    """
+    Function to return an upload path for key index files, kept beside each other per feed.
+
+    :param instance: KeyIndex model instance.
+    :param filename: str, name of the key file.
+    :return: str, complete filepath and name for the key file.
+    """
+    return os.path.join('indexes',
+                        instance.file.feed.name,
+                        filename)
+
+
+class KeyIndex(models.Model):
+    """
+    Bloom filter and sorted key file for one special column of one file, see loader.keyindex.
+    """
+
+    #####################
+    #  Relational Info  #
+    #####################
+
+    file = models.ForeignKey(File)
+    column = models.ForeignKey(Column)
+
+    #####################
+    #    Index Info     #
+    #####################
+
+    position = models.PositiveIntegerField()  # Index of the column in the file.
+
+    bloom = models.BinaryField()
+    bits = models.PositiveIntegerField()
+    hashes = models.PositiveSmallIntegerField()
+
+    keys = models.FileField(upload_to=index_directory_path)
+    count = models.PositiveIntegerField()
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('file', 'position')]
+
+    def __str__(self):
+        """
+        Name the file and column.
+
+        :return: str, identifying string for this index.
+        """
+        return '{}: {}'.format(self.file, self.column)
+
+
+def profile_directory_path(instance, filename):
+    """
+    Function to return an upload path for profile captures, grouped by the day they were taken.
+
+    :param instance: ProfileCapture model instance.
+    :param filename: str, name of the stats file.
+    :return: str, complete filepath and name for the stats file.
+    """
+    return os.path.join('profiles',
+                        datetime.datetime.now().strftime('%Y-%m-%d'),
+                        filename)
+
+
+class ProfileSwitch(models.Model):
+    """
+    Ask for matching requests and procedure runs to be profiled, see loader.profiling.
+
+    Every criterion given has to match, those left blank match anything.
+    """
+
+    #####################
+    #   Match Criteria  #
+    #####################
+
+    user = models.ForeignKey(User, null=True, blank=True, related_name='profile_switches')
+    feed = models.ForeignKey(Feed, null=True, blank=True)
+    url_pattern = models.CharField(max_length=200, blank=True, help_text='Regular expression matched against the path.')
+
+    #####################
+    #   Switch State    #
+    #####################
+
+    active = models.BooleanField(default=True)
+    remaining = models.PositiveIntegerField(default=10, help_text='Captures left before the switch stops matching.')
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        """
+        Describe what the switch matches.
+
+        :return: str, the criteria of this switch.
+        """
+        criteria = [str(value) for value in (self.user, self.feed, self.url_pattern) if value]
+
+        return 'Profile {}'.format(', '.join(criteria) or 'everything')
+
+
+class ProfileCapture(models.Model):
+    """
+    The cProfile and tracemalloc results of one profiled request or procedure run.
+    """
+
+    #####################
+    #  Relational Info  #
+    #####################
+
+    switch = models.ForeignKey(ProfileSwitch, null=True, blank=True, on_delete=models.SET_NULL)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.SET_NULL)
+    feed = models.ForeignKey(Feed, null=True, blank=True, on_delete=models.SET_NULL)
+
+    #####################
+    #   Capture Info    #
+    #####################
+
+    target = models.CharField(max_length=200)
+    created = models.DateTimeField(auto_now_add=True)
+    duration = models.FloatField()
+
+    stats = models.FileField(upload_to=profile_directory_path)  # pstats dump, load with pstats or snakeviz.
+    report = models.TextField(blank=True)  # Top functions by cumulative time.
+    allocations = models.TextField(blank=True)  # Top allocation sites by size.
+
+    def __str__(self):
+        """
+        Name what was profiled and when.
+
+        :return: str, identifying string for this capture.
+        """
+        return '{} at {}'.format(self.target, self.created)
+
+
 class Procedure(models.Model):
     """
     Model to hold a runnable procedure for a file.
@@ -278,11 +1191,8 @@ class Procedure(models.Model):
     #   Language Info   #
     #####################
 
-    LANGUAGE_CHOICES = ((plugin.LANGUAGE, plugin.LANGUAGE) for plugin in plugins.PLUGINS)
-
-    LANGUAGE_EXTENSIONS = {plugin.LANGUAGE: plugin.EXTENSION for plugin in plugins.PLUGINS}
-
-    LANGUAGE_INTERPRETER = {plugin.LANGUAGE: plugin for plugin in plugins.PLUGINS}
+    # Interpreters are looked up through loader.plugins and only imported when a procedure is run.
+    LANGUAGE_CHOICES = plugins.Choices()
 
     language = models.CharField(max_length=10,
                                 choices=LANGUAGE_CHOICES)
@@ -299,12 +1209,21 @@ class Procedure(models.Model):
 
     user = models.ForeignKey(User)  # Store whoever designed the procedure so we can track ownership.
 
-    def run(self, file, *args):
+    # Does the same input always give the same output? Only then are results cached, see loader.results.
+    deterministic = models.BooleanField(default=False)
+
+    def run(self, file, *args, force=False):
         """
-        Call up a subprocess to run our procedures.
+        Call up a subprocess to run our procedures, once it is the feed's turn and within the feed's limits.
+
+        Deterministic procedures are answered from the result cache when they have already been run on the same
+        content with the same arguments.
 
         :param file: File obj, the file we are running this on.
         :param args: tuple, list of arguments to add onto the call
+        :param force: bool, run even if a cached result exists, replacing it.
+        :return: RunResult, stdout lines, exit code, directory of output files, kept only for cached results, and
+                 whether it came from the cache.
         """
 
         file_args = {'table': file.table,
@@ -315,7 +1234,39 @@ class Procedure(models.Model):
 
         json_args = json.dumps(file_args, separators=(',', ':'))
 
-        self.LANGUAGE_INTERPRETER[self.language].run(self, json_args, *args)
+        key = results.result_key(self, file, json_args, args) if self.deterministic else None
+
+        if key is not None and not force:
+            cached = results.lookup(key)
+
+            if cached is not None:
+                return cached
+
+        run_dir = results.new_run_dir()
+
+        try:
+            # Wait for the feed's turn before reserving memory, so runs waiting their turn hold none.
+            with scheduler.shared().slot(file.feed), \
+                    admission.admit('procedure', admission.estimate(file, 'procedure')), \
+                    metrics.stage('procedure', file=file, procedure=self), \
+                    profiling.capture('procedure: {}'.format(self.name), user=file.user, feed=file.feed) as session:
+                extra = {'output_dir': run_dir, 'limits': scheduler.limits(file.feed)}
+
+                if session:
+                    extra['profile_path'] = session.child_stats_path
+
+                interpreter = plugins.get(self.language)
+                output, exit_code = interpreter.run(self, json_args, *args, **extra) or ([], None)
+
+            if key is not None and exit_code == 0:
+                if force:
+                    shutil.rmtree(results.entry_path(key), ignore_errors=True)
+
+                return results.store(key, output, exit_code, run_dir)
+        finally:
+            results.discard_run_dir(run_dir)  # Only a stored result keeps its output files.
+
+        return results.RunResult(output, exit_code, None, key, False)
 
     def __str__(self):
         """
@@ -324,4 +1275,181 @@ class Procedure(models.Model):
         :return: str, the script name and it's description
         """
 
-        return self.procedure.name + '\n\nDescription:\n' + self.comments
\ No newline at end of file
+        return self.procedure.name + '\n\nDescription:\n' + self.comments
+
+
+class ProcedureRun(models.Model):
+    """
+    One run of a procedure on a file, queued through the API and carried out in the background, see loader.runs.
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    STATUS_CHOICES = ((QUEUED, 'Queued'),
+                      (RUNNING, 'Running'),
+                      (DONE, 'Done'),
+                      (FAILED, 'Failed'))
+
+    OUTPUT_LIMIT = 64 * 1024  # Characters of stdout kept, the end of it.
+
+    #####################
+    #  Relational Info  #
+    #####################
+
+    procedure = models.ForeignKey(Procedure)
+    file = models.ForeignKey(File)
+    user = models.ForeignKey(User)  # Who asked for the run.
+
+    #####################
+    #     Run Info      #
+    #####################
+
+    args = models.TextField(default='[]')  # JSON list of extra arguments for the procedure.
+
+    force = models.BooleanField(default=False)  # Run even if a cached result exists.
+
+    status = models.CharField(max_length=7, default=QUEUED, choices=STATUS_CHOICES, db_index=True)
+
+    queued = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    #####################
+    #    Result Info    #
+    #####################
+
+    exit_code = models.IntegerField(null=True, blank=True)
+
+    cached = models.BooleanField(default=False)
+
+    output = models.TextField(blank=True)
+
+    artifacts = models.CharField(max_length=255, blank=True)  # Files the run wrote, kept for cached results.
+
+    error = models.TextField(blank=True)
+
+    def get_args(self):
+        """
+        :return: lst[str], the extra arguments.
+        """
+        return json.loads(self.args or '[]')
+
+    def execute(self):
+        """
+        Carry out the run, unless someone else already has.
+
+        :return: bool, True if this call ran it.
+        """
+        claimed = ProcedureRun.objects.filter(pk=self.pk, status=self.QUEUED).update(status=self.RUNNING,
+                                                                                     started=timezone.now())
+
+        if not claimed:
+            return False
+
+        try:
+            result = self.procedure.run(self.file, *self.get_args(), force=self.force)
+        except Exception as error:
+            self.status = self.FAILED
+            self.error = str(error) or error.__class__.__name__
+        else:
+            output = ''.join(line.decode('utf-8', 'replace') if isinstance(line, bytes) else line
+                             for line in result.output)
+
+            self.exit_code = result.exit_code
+            self.cached = result.cached
+            self.output = output[-self.OUTPUT_LIMIT:]
+            self.artifacts = result.artifacts or ''
+            self.status = self.DONE if result.exit_code == 0 else self.FAILED
+
+        self.finished = timezone.now()
+        self.save(update_fields=['status', 'exit_code', 'cached', 'output', 'artifacts', 'error', 'finished'])
+
+        return True
+
+    def __str__(self):
+        """
+        Name the procedure, file and how the run went.
+
+        :return: str, identifying string for this run.
+        """
+        return '{} on {}: {}'.format(self.procedure.name, self.file, self.status)
+
+
+class ApiToken(models.Model):
+    """
+    A key scripts authenticate to the JSON API with, see loader.api.
+
+    Only a hash of the key is stored, the key itself is shown once, when the issue_token command makes it.
+    """
+
+    TOUCH_INTERVAL = datetime.timedelta(minutes=1)  # last_used is only written this often.
+
+    #####################
+    #  Relational Info  #
+    #####################
+
+    user = models.ForeignKey(User, related_name='api_tokens')
+
+    #####################
+    #    Token Info     #
+    #####################
+
+    name = models.CharField(max_length=50)
+
+    digest = models.CharField(max_length=64, unique=True)  # SHA-256 of the key.
+
+    active = models.BooleanField(default=True)
+
+    created = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(null=True, blank=True)
+
+    @staticmethod
+    def hash_key(key):
+        """
+        :param key: str, a token key.
+        :return: str, its SHA-256 hex digest.
+        """
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def issue(cls, user, name):
+        """
+        Make a new token.
+
+        :param user: User obj, who the token acts as.
+        :param name: str, what the token is for.
+        :return: tuple, (ApiToken, its key), the key can't be recovered later.
+        """
+        key = secrets.token_urlsafe(32)
+
+        return cls.objects.create(user=user, name=name, digest=cls.hash_key(key)), key
+
+    @classmethod
+    def authenticate(cls, key):
+        """
+        :param key: str, a token key.
+        :return: User obj or None, the active user of the active token with that key.
+        """
+        token = cls.objects.select_related('user').filter(digest=cls.hash_key(key), active=True,
+                                                          user__is_active=True).first()
+
+        if token is None:
+            return None
+
+        now = timezone.now()
+
+        if token.last_used is None or now - token.last_used > cls.TOUCH_INTERVAL:
+            cls.objects.filter(pk=token.pk).update(last_used=now)
+
+        return token.user
+
+    def __str__(self):
+        """
+        Name the token and its user.
+
+        :return: str, identifying string for this token.
+        """
+        return '{} ({})'.format(self.name, self.user)
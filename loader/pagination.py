@@ -0,0 +1,106 @@
+"""
+Keyset (cursor) pagination.
+
+Offset pagination has to count and skip every earlier row, which gets slower the deeper you go. Instead each page
+remembers the ordering values of its last row and the next page starts from there, which an index on the ordering
+fields answers directly however far into the listing we are.
+"""
+import base64
+import json
+
+from django.db.models import Q
+
+PER_PAGE = 50
+
+
+def _default(value):
+    """
+    Serialise dates at full precision, DjangoJSONEncoder drops microseconds which would skip rows.
+
+    :param value: object, a value json can't serialise itself.
+    :return: str, the value as a string.
+    """
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+
+    return str(value)
+
+
+def encode_cursor(values):
+    """
+    Turn the ordering values of a row into an opaque cursor for a URL.
+
+    :param values: lst, the values of the ordering fields.
+    :return: str, the cursor.
+    """
+    return base64.urlsafe_b64encode(json.dumps(values, default=_default).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Turn a cursor back into ordering values.
+
+    :param cursor: str, a cursor from encode_cursor.
+    :return: lst or None, the values, None if the cursor is missing or mangled.
+    """
+    if not cursor:
+        return None
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError):
+        return None
+
+    return values if isinstance(values, list) else None
+
+
+def _after(fields, values):
+    """
+    Build the filter for rows that come after a given row in the ordering.
+
+    For ordering ('-a', '-b') this is a < x OR (a = x AND b < y).
+
+    :param fields: tuple[str], ordering fields, '-' prefixed for descending.
+    :param values: lst, the ordering values of the last row seen.
+    :return: Q, the filter.
+    """
+    condition = Q()
+    equal = {}
+
+    for field, value in zip(fields, values):
+        name = field.lstrip('-')
+        lookup = '{}__{}'.format(name, 'lt' if field.startswith('-') else 'gt')
+
+        condition |= Q(**dict(equal, **{lookup: value}))
+        equal[name] = value
+
+    return condition
+
+
+def keyset_page(queryset, fields, cursor=None, per_page=PER_PAGE):
+    """
+    Fetch one page of a queryset ordered by fields, starting after a cursor.
+
+    The last field should be unique (usually pk) so rows are never skipped or repeated.
+
+    :param queryset: QuerySet, the rows to page through.
+    :param fields: tuple[str], ordering fields, '-' prefixed for descending.
+    :param cursor: str, cursor from the previous page, None for the first page.
+    :param per_page: int, rows per page.
+    :return: tuple, (list of rows, cursor for the next page or None if this is the last page)
+    """
+    values = decode_cursor(cursor)
+    queryset = queryset.order_by(*fields)
+
+    if values is not None and len(values) == len(fields):
+        queryset = queryset.filter(_after(fields, values))
+
+    rows = list(queryset[:per_page + 1])
+
+    if len(rows) <= per_page:
+        return rows, None
+
+    rows = rows[:per_page]
+    last = rows[-1]
+
+    return rows, encode_cursor([getattr(last, field.lstrip('-')) for field in fields])
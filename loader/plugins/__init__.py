@@ -1,31 +1,108 @@
-import glob
+"""
+Interpreters for the languages procedures can be written in.
+
+Plugins are listed in a manifest rather than found by importing every module in this package, so nothing is imported
+until a procedure in that language is actually run. Other packages add languages through the lionel.interpreters entry
+point group, named after the language and pointing at the Interpreter subclass, e.g.
+
+    entry_points={'lionel.interpreters': ['R = lionel_r.interpreter:RInterpreter']}
+
+The entry points are only looked up the first time the list of languages is needed.
+"""
 import importlib
-import inspect
-import os
 
 from ._interpreter import Interpreter
 
+ENTRY_POINT_GROUP = 'lionel.interpreters'
+
+# Language to (file extension, module:class) of the interpreters shipped with Lionel.
+MANIFEST = {'Bash': ('.sh', 'loader.plugins.bash_interpreter:BashInterpreter'),
+            'Python': ('.py', 'loader.plugins.python_interpreter:PythonInterpreter')}
+
+_manifest = None
+_loaded = {}
+
+
+def _entry_points():
+    """
+    :return: dict, language to module:class of interpreters registered by installed packages.
+    """
+    try:
+        from importlib import metadata
+    except ImportError:  # Before Python 3.8.
+        try:
+            import pkg_resources
+        except ImportError:
+            return {}
+
+        return {point.name: '{}:{}'.format(point.module_name, '.'.join(point.attrs))
+                for point in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)}
+
+    points = metadata.entry_points()
+
+    if hasattr(points, 'select'):
+        points = points.select(group=ENTRY_POINT_GROUP)
+    else:
+        points = points.get(ENTRY_POINT_GROUP, [])
+
+    return {point.name: point.value for point in points}
+
+
+def manifest():
+    """
+    :return: dict, language to (file extension or None until loaded, module:class) of every known interpreter.
+    """
+    global _manifest
+
+    if _manifest is None:
+        found = {language: (None, target) for language, target in _entry_points().items()}
+        found.update(MANIFEST)  # The shipped interpreters can't be replaced.
+        _manifest = found
+
+    return _manifest
+
+
+def languages():
+    """
+    :return: lst[str], every language procedures can be written in, sorted.
+    """
+    return sorted(manifest())
+
 
-def is_valid_plugin(plugin):
+def get(language):
     """
-    Ensure a plugin is valid - i.e. it is a file and doesn't start with _ (e.g. __init__).
+    Import the interpreter for a language, the first time it is asked for.
 
-    :param plugin: str, filepath to a package.
-    :return: bool, is it valid?
+    :param language: str, the language.
+    :return: class, its Interpreter subclass.
     """
-    return os.path.isfile(plugin) and not os.path.basename(plugin).startswith('_')
+    if language not in _loaded:
+        module_name, _, class_name = manifest()[language][1].partition(':')
+        plugin = importlib.import_module(module_name)
 
-_PACKAGE_DIR = 'loader.plugins'  # We are always going to be seeing this file from 2 directories up.
+        for attribute in class_name.split('.'):
+            plugin = getattr(plugin, attribute)
 
-# Get the valid packages
-_PACKAGES_TO_IMPORT = [package for package in glob.glob(os.path.dirname(__file__) + '/*.py') if is_valid_plugin(package)]
+        if not (isinstance(plugin, type) and issubclass(plugin, Interpreter)):
+            raise TypeError('{} is not an Interpreter.'.format(manifest()[language][1]))
 
-# import them all.
-_PACKAGES = [importlib.import_module('.' + os.path.basename(package)[:-3], _PACKAGE_DIR) for package in _PACKAGES_TO_IMPORT]
+        _loaded[language] = plugin
 
-PLUGINS = []
+    return _loaded[language]
+
+
+def extension(language):
+    """
+    :param language: str, the language.
+    :return: str, the file extension of its programs, from the manifest or the interpreter itself.
+    """
+    return manifest()[language][0] or get(language).EXTENSION
+
+
+class Choices(object):
+    """
+    The languages as field choices, worked out when first iterated rather than when the model class is made.
+    """
 
-for package in _PACKAGES:
-    for value in package.__dict__.values():  # loop through all the packages items and grab intepreters.
-        if inspect.isclass(value) and issubclass(value, Interpreter) and value is not Interpreter:
-            PLUGINS.append(value)
\ No newline at end of file
+    def __iter__(self):
+        return iter([(language, language) for language in languages()])
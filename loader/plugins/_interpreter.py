@@ -1,4 +1,7 @@
 import abc
+import resource
+import subprocess
+import threading
 
 
 class Interpreter:
@@ -24,5 +27,77 @@ class Interpreter:
 
         :param file: str, filepath to the procedure to run.
         :param args: list of arguments to attach to the procedure.
+        :param kwargs: dict, optional profile_path, output_dir and limits, see PythonInterpreter.
+        :return: tuple, (lines of stdout, exit code).
         """
         pass
+
+
+def _apply_limits(pid, limits):
+    """
+    Set a child process's CPU time and memory limits from this process.
+
+    They are set once the child has started rather than in it between fork and exec, where only async signal safe
+    calls are safe with other threads running. That leaves a short window, between the child starting and this call,
+    in which it runs without them.
+
+    :param pid: int, the child's process id.
+    :param limits: Limits, see loader.scheduler, None or a None field for no limit.
+    """
+    if limits is None:
+        return
+
+    try:
+        if limits.cpu is not None:
+            # The soft limit sends SIGXCPU, the hard limit a second later SIGKILL.
+            resource.prlimit(pid, resource.RLIMIT_CPU, (limits.cpu, limits.cpu + 1))
+
+        if limits.memory is not None:
+            resource.prlimit(pid, resource.RLIMIT_AS, (limits.memory, limits.memory))
+    except ProcessLookupError:
+        pass  # It has already finished.
+
+
+def run_process(command, env=None, limits=None):
+    """
+    Run a procedure's process, collecting its output, within the run's resource limits.
+
+    :param command: lst[str], the command line.
+    :param env: dict, the environment, None to inherit ours.
+    :param limits: Limits, CPU seconds, bytes of memory and wall clock seconds the process may use, see
+                   loader.scheduler.
+    :return: tuple, (lines of stdout from the process, its exit code), negative if it was killed by a signal.
+    """
+    running = subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+
+    try:
+        _apply_limits(running.pid, limits)
+    except BaseException:
+        running.kill()  # Never left going without its limits.
+        running.wait()
+        running.stdout.close()
+        raise
+
+    # Reading stdout blocks, so the wall clock limit is kept by a timer which kills the process.
+    timer = None
+
+    if limits is not None and limits.wall is not None:
+        timer = threading.Timer(limits.wall, running.kill)
+        timer.daemon = True
+        timer.start()
+
+    output = []
+
+    try:
+        while True:  # While this is running give out the output.
+            outp = running.stdout.readline()
+            if not outp:
+                break
+            output.append(outp)
+
+        return output, running.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+        running.stdout.close()
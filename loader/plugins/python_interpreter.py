@@ -1,6 +1,7 @@
-import subprocess
+import os
+import sys
 
-from ._interpreter import Interpreter
+from ._interpreter import Interpreter, run_process
 
 
 class PythonInterpreter(Interpreter):
@@ -11,25 +12,22 @@ class PythonInterpreter(Interpreter):
     EXTENSION = '.py'
 
     @staticmethod
-    def run(proc, *args):
+    def run(proc, *args, **kwargs):
         """
         Run a python script with the given args.
 
         :param proc: Procedure obj, the procedure we are running.
         :param args: list of arguments to pass to the command line.
-        :return: str, stdoutput from the process.
+        :param kwargs: dict, profile_path asks for the script to be run under cProfile, writing its stats there,
+                       output_dir is passed to the script as LIONEL_OUTPUT_DIR for any files it writes, limits caps
+                       the CPU time, memory and wall clock time the script may use.
+        :return: tuple, (lines of stdout from the process, its exit code).
         """
+        profile = ['-m', 'cProfile', '-o', kwargs['profile_path']] if kwargs.get('profile_path') else []
 
-        process = ['python', proc.procedure.name] + list(args)
+        # The stored name is relative to MEDIA_ROOT, the path works from any working directory.
+        process = [sys.executable] + profile + [proc.procedure.path] + list(args)
 
-        running = subprocess.Popen(process, stdout=subprocess.PIPE)
+        env = dict(os.environ, LIONEL_OUTPUT_DIR=kwargs['output_dir']) if kwargs.get('output_dir') else None
 
-        output = []
-
-        while True:  # While this is running give out the output.
-            outp = running.stdout.readline()
-            if not outp:
-                break
-            output.append(outp)
-
-        return output
\ No newline at end of file
+        return run_process(process, env, kwargs.get('limits'))
@@ -0,0 +1,282 @@
+"""
+On demand cProfile and tracemalloc captures.
+
+Staff turn on a ProfileSwitch in the admin for a user, a feed, a URL pattern or any mix of them. Matching requests and
+procedure runs are then wrapped in cProfile and tracemalloc and the results stored as a ProfileCapture, until the
+switch runs out of captures. With no switches on the only cost is one cache lookup.
+
+Captures nest: work profiled inside a capture on the same thread, e.g. a procedure run from a profiled request, joins
+the capture already going rather than starting its own profiler. tracemalloc is shared by every capture in the process,
+so it is only stopped when the last one finishes.
+"""
+import contextlib
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from django.apps import apps
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+SWITCHES_KEY = 'loader:profile_switches'
+
+TRACEMALLOC_FRAMES = 5  # Stack depth kept per allocation, deeper is more useful but slower.
+
+REPORT_LINES = 50  # Functions and allocation sites kept in the text reports.
+
+_local = threading.local()  # The session capturing on each thread, if any.
+
+_tracing_lock = threading.Lock()
+_tracers = 0  # Captures in progress relying on tracemalloc.
+_started_tracing = False  # Did a capture turn tracemalloc on, rather than whoever started the process?
+
+
+def active_switches():
+    """
+    Return the switches which are on, cached until any switch is saved or deleted.
+
+    :return: lst[dict], the switches as dicts of pk, user_id, feed_id and url_pattern.
+    """
+    switches = cache.get(SWITCHES_KEY)
+
+    if switches is None:
+        switches = list(apps.get_model('loader', 'ProfileSwitch').objects
+                        .filter(active=True, remaining__gt=0)
+                        .values('pk', 'user_id', 'feed_id', 'url_pattern'))
+        cache.set(SWITCHES_KEY, switches, None)
+
+    return switches
+
+
+def matching_switch(user=None, feed=None, path=None):
+    """
+    Find the first active switch matching a piece of work.
+
+    Every criterion set on a switch has to match, criteria left empty match anything.
+
+    :param user: User, who the work is for.
+    :param feed: Feed, the feed the work concerns.
+    :param path: str, the request path, None for work outside a request.
+    :return: int or None, pk of the switch.
+    """
+    for switch in active_switches():
+        if switch['user_id'] and (user is None or switch['user_id'] != user.pk):
+            continue
+        if switch['feed_id'] and (feed is None or switch['feed_id'] != feed.pk):
+            continue
+        if switch['url_pattern'] and (path is None or not re.search(switch['url_pattern'], path)):
+            continue
+
+        return switch['pk']
+
+    return None
+
+
+class Session(object):
+    """
+    A capture in progress.
+
+    Work done in a child process can be profiled too, write its stats to child_stats_path (e.g. with python -m cProfile
+    -o) and they are merged into the capture.
+    """
+
+    def __init__(self, switch_pk, target):
+        self.switch_pk = switch_pk
+        self.target = target
+        self.profiler = cProfile.Profile()
+
+        handle, self.child_stats_path = tempfile.mkstemp(suffix='.pstats')
+        os.close(handle)
+        os.remove(self.child_stats_path)  # Only merged if the child actually writes it.
+
+    def stats(self):
+        """
+        :return: pstats.Stats, our profile plus any child profile.
+        """
+        stats = pstats.Stats(self.profiler)
+
+        if os.path.exists(self.child_stats_path):
+            try:
+                stats.add(self.child_stats_path)
+            finally:
+                os.remove(self.child_stats_path)
+
+        return stats
+
+
+def _stats_report(stats):
+    """
+    :param stats: pstats.Stats, the profile.
+    :return: str, the top functions by cumulative time.
+    """
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+
+    return output.getvalue()
+
+
+def _allocation_report(snapshot):
+    """
+    :param snapshot: tracemalloc.Snapshot or None, allocations made during the capture.
+    :return: str, the top allocation sites by size.
+    """
+    if snapshot is None:
+        return ''
+
+    lines = []
+
+    for stat in snapshot.statistics('lineno')[:REPORT_LINES]:
+        lines.append('{:>12} B {:>8} blocks  {}'.format(stat.size, stat.count, stat.traceback))
+
+    return '\n'.join(lines)
+
+
+def _start_tracing():
+    """
+    Count a capture relying on tracemalloc, turning it on for the first.
+    """
+    global _tracers, _started_tracing
+
+    with _tracing_lock:
+        if _tracers == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            _started_tracing = True
+
+        _tracers += 1
+
+
+def _stop_tracing():
+    """
+    Snapshot the allocations for a finished capture, turning tracemalloc off after the last.
+
+    :return: tracemalloc.Snapshot or None, None if tracemalloc was turned off behind our back.
+    """
+    global _tracers, _started_tracing
+
+    with _tracing_lock:
+        try:
+            return tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        finally:
+            _tracers -= 1
+
+            if _tracers == 0 and _started_tracing:
+                tracemalloc.stop()
+                _started_tracing = False
+
+
+@contextlib.contextmanager
+def capture(target, user=None, feed=None, path=None):
+    """
+    Profile a block of work if an active switch matches it.
+
+    :param target: str, what is being profiled, e.g. the request path or procedure name.
+    :param user: User, who the work is for.
+    :param feed: Feed, the feed the work concerns.
+    :param path: str, the request path, None for work outside a request.
+    :return: context manager yielding a Session, the one already going on this thread if any, or None when not
+             profiling.
+    """
+    current = getattr(_local, 'session', None)
+
+    if current is not None:
+        yield current
+        return
+
+    switch_pk = matching_switch(user=user, feed=feed, path=path)
+
+    if switch_pk is None:
+        yield None
+        return
+
+    session = Session(switch_pk, target)
+
+    try:
+        session.profiler.enable()
+    except ValueError:  # Python 3.12 on allows one profiler at a time in the whole process.
+        logger.warning('Not profiling %s, another profile is being captured', target)
+        yield None
+        return
+
+    _start_tracing()
+    _local.session = session
+    start = time.perf_counter()
+
+    try:
+        yield session
+    finally:
+        session.profiler.disable()
+        duration = time.perf_counter() - start
+        _local.session = None
+
+        try:
+            _store(session, duration, _stop_tracing(), user, feed)
+        except Exception:
+            logger.exception('Could not store the profile of %s', target)
+
+
+def _store(session, duration, snapshot, user, feed):
+    """
+    Save a finished capture and count it against its switch.
+    """
+    ProfileSwitch = apps.get_model('loader', 'ProfileSwitch')
+    ProfileCapture = apps.get_model('loader', 'ProfileCapture')
+
+    stats = session.stats()
+
+    handle, dump_path = tempfile.mkstemp(suffix='.pstats')
+    os.close(handle)
+
+    try:
+        stats.dump_stats(dump_path)
+
+        with open(dump_path, 'rb') as dump_file:
+            dump = dump_file.read()
+    finally:
+        os.remove(dump_path)
+
+    profile = ProfileCapture(switch_id=session.switch_pk,
+                             target=session.target[:200],
+                             user=user if user is not None and user.pk else None,
+                             feed=feed,
+                             duration=duration,
+                             report=_stats_report(stats),
+                             allocations=_allocation_report(snapshot))
+    profile.stats.save('{}.pstats'.format(int(time.time() * 1000)), ContentFile(dump), save=False)
+    profile.save()
+
+    ProfileSwitch.objects.filter(pk=session.switch_pk).update(remaining=F('remaining') - 1)
+    cache.delete(SWITCHES_KEY)
+
+
+class ProfiledViewMixin(object):
+    """
+    Profile requests to a view whenever a switch matches them.
+
+    Views can override get_profile_feed to let switches match on the feed being worked on.
+    """
+
+    def get_profile_feed(self, request, *args, **kwargs):
+        """
+        :return: Feed or None, the feed this request concerns.
+        """
+        return None
+
+    def dispatch(self, request, *args, **kwargs):
+        if not active_switches():
+            return super(ProfiledViewMixin, self).dispatch(request, *args, **kwargs)
+
+        user = request.user if request.user.pk is not None else None
+
+        with capture(request.path, user=user, feed=self.get_profile_feed(request, *args, **kwargs), path=request.path):
+            return super(ProfiledViewMixin, self).dispatch(request, *args, **kwargs)
@@ -0,0 +1,488 @@
+"""
+One shared way of reading an uploaded file.
+
+Everything that needs the contents of a File (sniffing, previews, profiling, loading) goes through FileReader so
+decompression, encoding, dialect and header handling are applied once and the same way everywhere.
+"""
+import bz2
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import lzma
+import os
+
+BUFFER_SIZE = 1024 * 1024  # Read buffer for the underlying binary stream.
+
+PAGE_SIZE = 10  # Rows per page of a preview.
+
+CHUNK_SIZE = 100000  # Rows per DataFrame chunk.
+
+
+def zstd_open(path, mode='rb'):
+    """
+    Open a Zstandard file, zstd needs the optional zstandard package.
+
+    :param path: str, path to the file.
+    :param mode: str, file mode.
+    :return: file obj, the decompressing stream.
+    """
+    import zstandard
+
+    return zstandard.open(path, mode)
+
+
+# Magic numbers at the start of compressed files, and how to open them.
+COMPRESSIONS = ((b'\x1f\x8b', gzip.open),
+                (b'BZh', bz2.open),
+                (b'\xfd7zXZ\x00', lzma.open),
+                (b'\x28\xb5\x2f\xfd', zstd_open))
+
+# Encodings where a quote byte is always a quote character, so row boundaries can be found on the raw bytes.
+_BYTE_SAFE_PREFIXES = ('utf-8', 'utf8', 'ascii', 'latin', 'iso-8859', 'cp125')
+
+
+def open_binary(path):
+    """
+    Open a file for binary reading, transparently decompressing it.
+
+    :param path: str, path to the file.
+    :return: file obj, buffered binary stream of the uncompressed data.
+    """
+    with open(path, 'rb') as raw:
+        magic = raw.read(6)
+
+    for prefix, opener in COMPRESSIONS:
+        if magic.startswith(prefix):
+            return io.BufferedReader(opener(path, 'rb'), BUFFER_SIZE)
+
+    return open(path, 'rb', buffering=BUFFER_SIZE)
+
+
+def is_compressed(path):
+    """
+    Is the file at path compressed?
+
+    :param path: str, path to the file.
+    :return: bool, True if it is in one of the known compressed formats.
+    """
+    with open(path, 'rb') as raw:
+        magic = raw.read(6)
+
+    return any(magic.startswith(prefix) for prefix, _ in COMPRESSIONS)
+
+
+def checksum(path):
+    """
+    Hash the raw bytes of a file, as stored, so identical uploads can be recognised.
+
+    :param path: str, path to the file.
+    :return: str, hex SHA-256 of the file.
+    """
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as raw:
+        for block in iter(functools.partial(raw.read, BUFFER_SIZE), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=256)
+def _row_offsets(path, size, mtime, page_size, has_header, quotechar):
+    """
+    Find the byte offset of the start of every page of rows.
+
+    Cached per process on the file's path, size and mtime, uploaded files don't change so each file is only ever
+    scanned once.
+
+    :param path: str, path to an uncompressed file.
+    :param size: int, size of the file, only used for the cache key.
+    :param mtime: float, modification time of the file, only used for the cache key.
+    :param page_size: int, rows per page.
+    :param has_header: bool, skip the first row?
+    :param quotechar: str, quote character, newlines inside quotes don't end a row.
+    :return: tuple[int], offset of the first row of each page.
+    """
+    quote = quotechar.encode('ascii')
+    offsets = []
+    offset = 0
+    row = -1 if has_header else 0
+    in_quotes = False
+
+    with open(path, 'rb', buffering=BUFFER_SIZE) as data_file:
+        for line in data_file:
+            if not in_quotes:
+                if row >= 0 and row % page_size == 0:
+                    offsets.append(offset)
+                row += 1
+
+            if line.count(quote) % 2:
+                in_quotes = not in_quotes
+
+            offset += len(line)
+
+    return tuple(offsets)
+
+
+class FileReader(object):
+    """
+    Read a delimited file as rows, DataFrame chunks or pages.
+    """
+
+    def __init__(self, path, delimiter=',', quotechar='"', encoding='utf-8-sig', has_header=True, page_size=PAGE_SIZE,
+                 terminator=None):
+        """
+        :param path: str, path to the file on disk.
+        :param delimiter: str, field delimiter.
+        :param quotechar: str, quote character.
+        :param encoding: str, text encoding of the file.
+        :param has_header: bool, is the first row a header?
+        :param page_size: int, rows per page for page().
+        :param terminator: str, line terminator as sniffed, None if not known, taken to end in a newline.
+        """
+        self.path = path
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.encoding = encoding
+        self.has_header = has_header
+        self.page_size = page_size
+        self.terminator = terminator
+
+        self._first_row = None
+
+    @classmethod
+    def for_file(cls, file, **kwargs):
+        """
+        Build a reader using the dialect stored on a File.
+
+        :param file: File obj, the file to read.
+        :param kwargs: dict, overrides for any of the reader settings.
+        :return: FileReader, the reader.
+        """
+        settings = {'delimiter': file.delimiter or ',',
+                    'encoding': file.encoding,
+                    'has_header': file.has_header,
+                    'terminator': file.terminator}
+        settings.update(kwargs)
+
+        return cls(file.data.path, **settings)
+
+    def open_binary(self):
+        """
+        :return: file obj, binary stream of the uncompressed file.
+        """
+        return open_binary(self.path)
+
+    def open_text(self):
+        """
+        :return: file obj, decoded text stream of the file, newlines are left for csv to handle.
+        """
+        return io.TextIOWrapper(self.open_binary(), encoding=self.encoding, newline='')
+
+    def _reader(self, text):
+        """
+        :param text: file obj, text stream.
+        :return: csv.reader, reader over the stream with our dialect.
+        """
+        return csv.reader(text, delimiter=self.delimiter, quotechar=self.quotechar)
+
+    def lines(self, num):
+        """
+        Return the first few raw lines of the file.
+
+        :param num: int, maximum number of lines.
+        :return: lst[str], the lines, fewer than num if the file is short.
+        """
+        with io.TextIOWrapper(self.open_binary(), encoding=self.encoding) as text:
+            return list(itertools.islice(text, num))
+
+    @property
+    def first_row(self):
+        """
+        :return: lst[str], the first row of the file, empty if the file is empty.
+        """
+        if self._first_row is None:
+            with self.open_text() as text:
+                self._first_row = next(self._reader(text), [])
+
+        return self._first_row
+
+    @property
+    def header(self):
+        """
+        :return: lst[str], the header row, empty if the file has none.
+        """
+        return self.first_row if self.has_header else []
+
+    @property
+    def width(self):
+        """
+        :return: int, the number of columns in the first row.
+        """
+        return len(self.first_row)
+
+    def rows(self, start=0, stop=None):
+        """
+        Iterate over the data rows of the file, the header is never included.
+
+        :param start: int, index of the first data row to return.
+        :param stop: int, index to stop before, None to read to the end.
+        :return: generator, lists of fields.
+        """
+        with self.open_text() as text:
+            reader = self._reader(text)
+
+            if self.has_header:
+                next(reader, None)
+
+            for row in itertools.islice(reader, start, stop):
+                yield row
+
+    def byte_addressable(self):
+        """
+        Can rows be found by their byte offsets in the file on disk?
+
+        Rows are found on disk by the newlines ending them, so a file whose lines end in a carriage return alone is only
+        ever read through the csv module, which understands every terminator.
+
+        :return: bool, True for uncompressed files in an encoding where quotes and newlines are single bytes, with
+                 lines ending in a newline.
+        """
+        return (self.encoding.lower().replace('_', '-').startswith(_BYTE_SAFE_PREFIXES) and self.terminator != '\r' and
+                not is_compressed(self.path))
+
+    def records(self):
+        """
+        Iterate over the raw data records of the file without parsing them.
+
+        Only valid when byte_addressable() is True, a record is one or more lines, more if a quoted field holds a
+        newline.
+
+        :return: generator, tuples of (byte offset, bytes of the record).
+        """
+        quote = self.quotechar.encode('ascii')
+        offset = 0
+        start = 0
+        record = []
+        in_quotes = False
+        skip = self.has_header
+
+        with open(self.path, 'rb', buffering=BUFFER_SIZE) as data_file:
+            for line in data_file:
+                record.append(line)
+
+                if line.count(quote) % 2:
+                    in_quotes = not in_quotes
+
+                offset += len(line)
+
+                if not in_quotes:
+                    if skip:
+                        skip = False
+                    else:
+                        yield start, b''.join(record)
+
+                    record = []
+                    start = offset
+
+        if record:
+            yield start, b''.join(record)
+
+    def parse(self, record):
+        """
+        Parse a raw record as returned by records().
+
+        :param record: bytes, the record.
+        :return: lst[str], its fields.
+        """
+        return next(self._reader(io.StringIO(record.decode(self.encoding), newline='')), [])
+
+    def split(self, parts):
+        """
+        Split the data rows into byte ranges of about equal size, each starting and ending on a row boundary.
+
+        Quote characters are counted up to each split point, so a newline inside a quoted field is never taken for the
+        end of a row. Counting is done on whole blocks, the only bytes looked at one row at a time are those between a
+        target point and the next row boundary.
+
+        :param parts: int, ranges wanted.
+        :return: lst[tuple] or None, (start, end) byte offsets, None if rows can't be read from an offset.
+        """
+        if not self.byte_addressable():
+            return None
+
+        first = next(self.records(), None)
+
+        if first is None:
+            return []
+
+        quote = self.quotechar.encode('ascii')
+        size = os.path.getsize(self.path)
+        start = first[0]
+        points = [start]
+        position = 0
+        quotes = 0
+
+        with open(self.path, 'rb', buffering=BUFFER_SIZE) as data_file:
+            for part in range(1, parts):
+                target = max(start + (size - start) * part // parts, position)
+
+                while position < target:
+                    block = data_file.read(min(BUFFER_SIZE, target - position))
+                    quotes += block.count(quote)
+                    position += len(block)
+
+                boundary = None
+
+                while boundary is None:
+                    block = data_file.read(BUFFER_SIZE)
+
+                    if not block:
+                        boundary = size
+                        break
+
+                    idx = 0
+
+                    while boundary is None:
+                        newline = block.find(b'\n', idx)
+
+                        if newline < 0:
+                            quotes += block.count(quote, idx)
+                            position += len(block)
+                            break
+
+                        quotes += block.count(quote, idx, newline)
+                        idx = newline + 1
+
+                        if quotes % 2 == 0:
+                            boundary = position + idx
+
+                position = boundary
+                data_file.seek(position)
+
+                if boundary > points[-1]:
+                    points.append(boundary)
+
+        points.append(size)
+
+        return [(low, high) for low, high in zip(points, points[1:]) if high > low]
+
+    def range_rows(self, start, end):
+        """
+        Iterate over the rows in a byte range from split().
+
+        :param start: int, offset of the first row.
+        :param end: int, offset to stop before.
+        :return: generator, lists of fields.
+        """
+        def lines():
+            position = start
+
+            with open(self.path, 'rb', buffering=BUFFER_SIZE) as data_file:
+                data_file.seek(start)
+
+                for line in data_file:
+                    if position >= end:
+                        return
+
+                    position += len(line)
+                    yield line.decode(self.encoding)
+
+        for row in self._reader(lines()):
+            yield row
+
+    def _offsets(self):
+        """
+        :return: tuple[int] or None, byte offsets of each page, None if the file can't be read from an offset.
+        """
+        if not self.byte_addressable():
+            return None
+
+        stat = os.stat(self.path)
+
+        return _row_offsets(self.path, stat.st_size, stat.st_mtime, self.page_size, self.has_header, self.quotechar)
+
+    def page(self, number):
+        """
+        Return one page of data rows.
+
+        Uncompressed files seek straight to the page using a cached offset index, others have to read up to it.
+
+        :param number: int, zero based page number.
+        :return: lst[lst[str]], the rows on the page, empty past the end of the file.
+        """
+        offsets = self._offsets()
+
+        if offsets is None:
+            start = number * self.page_size
+            return list(self.rows(start, start + self.page_size))
+
+        if number >= len(offsets):
+            return []
+
+        binary = open(self.path, 'rb', buffering=BUFFER_SIZE)
+        binary.seek(offsets[number])
+
+        with io.TextIOWrapper(binary, encoding=self.encoding, newline='') as text:
+            return list(itertools.islice(self._reader(text), self.page_size))
+
+    def page_count(self):
+        """
+        :return: int or None, number of pages in the file, None if it isn't known without a full read.
+        """
+        offsets = self._offsets()
+
+        return None if offsets is None else len(offsets)
+
+    def _read_csv(self, text, **kwargs):
+        """
+        Call pandas.read_csv over a decoded stream with our dialect.
+
+        :param text: file obj, text stream of the file.
+        :param kwargs: dict, extra arguments for read_csv.
+        :return: DataFrame or TextFileReader, as read_csv returns.
+        """
+        import pandas  # Deferred so processes that never build a DataFrame don't pay for importing it.
+
+        names = self.header or list(range(self.width))
+
+        return pandas.read_csv(text,
+                               sep=self.delimiter,
+                               quotechar=self.quotechar,
+                               header=None,
+                               names=names,
+                               skiprows=1 if self.has_header else 0,
+                               **kwargs)
+
+    def dataframe(self):
+        """
+        Read the whole file into a DataFrame.
+
+        :return: DataFrame, the file's data with the header as column names.
+        """
+        with self.open_text() as text:
+            return self._read_csv(text)
+
+    def chunks(self, size=CHUNK_SIZE):
+        """
+        Read the file in DataFrame chunks so it never has to fit in memory at once.
+
+        :param size: int, rows per chunk.
+        :return: generator, DataFrames of at most size rows.
+        """
+        with self.open_text() as text:
+            for chunk in self._read_csv(text, chunksize=size):
+                yield chunk
+
+    def arrays(self, size=CHUNK_SIZE):
+        """
+        Read the file in NumPy chunks.
+
+        :param size: int, rows per chunk.
+        :return: generator, 2d object arrays of at most size rows.
+        """
+        for chunk in self.chunks(size):
+            yield chunk.values
@@ -0,0 +1,244 @@
+"""
+On disk cache of procedure results.
+
+A deterministic procedure run on the same input always gives the same output, so its stdout, exit code and any files
+it writes to its output directory are kept, keyed on a hash of the procedure file, the input file and the arguments.
+The next identical run is answered from the cache without starting a subprocess. The cache is bounded in size, the
+least recently used entries are removed first.
+
+Each run writes its output files into a run directory of its own. A cached run's directory becomes the entry's
+artifacts, any other run's is removed once the run is over. Eviction never touches the directory of a run still going.
+"""
+import collections
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+from loader import readers
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 1024 ** 3  # Bytes the cache may hold unless LIONEL_RESULT_CACHE_SIZE says otherwise.
+
+RunResult = collections.namedtuple('RunResult', ['output', 'exit_code', 'artifacts', 'key', 'cached'])
+
+# Run directories left this long, by a process that died part way through a run, are removed by evict.
+STALE_RUN_SECONDS = 24 * 60 * 60
+
+_ENTRIES = 'entries'
+_RUNS = 'runs'
+
+_active = set()  # Run directories of runs going in this process.
+_active_lock = threading.Lock()
+
+
+def cache_dir():
+    """
+    :return: str, the cache's root directory, LIONEL_RESULT_CACHE_DIR or results/ under MEDIA_ROOT.
+    """
+    return getattr(settings, 'LIONEL_RESULT_CACHE_DIR', None) or os.path.join(settings.MEDIA_ROOT, 'results')
+
+
+def max_size():
+    """
+    :return: int, bytes the cache may hold.
+    """
+    return getattr(settings, 'LIONEL_RESULT_CACHE_SIZE', DEFAULT_SIZE)
+
+
+def result_key(procedure, file, json_args, args):
+    """
+    Hash everything a procedure's result depends on.
+
+    :param procedure: Procedure obj, the procedure.
+    :param file: File obj, the input file.
+    :param json_args: str, the JSON arguments the procedure is given.
+    :param args: tuple, extra command line arguments.
+    :return: str, hex key of the result.
+    """
+    digest = hashlib.sha256()
+
+    for part in (procedure.language,
+                 readers.checksum(procedure.procedure.path),
+                 file.checksum or file.set_checksum(),
+                 json_args,
+                 json.dumps([str(arg) for arg in args])):
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+def entry_path(key):
+    """
+    :param key: str, result key.
+    :return: str, directory holding the cached result.
+    """
+    return os.path.join(cache_dir(), _ENTRIES, key[:2], key)
+
+
+def lookup(key):
+    """
+    Fetch a cached result, marking it as recently used.
+
+    :param key: str, result key.
+    :return: RunResult or None, None on a miss.
+    """
+    path = entry_path(key)
+
+    try:
+        with open(os.path.join(path, 'meta.json')) as meta_file:
+            meta = json.load(meta_file)
+
+        with open(os.path.join(path, 'stdout'), 'rb') as output_file:
+            output = output_file.read().splitlines(True)
+    except (OSError, ValueError):
+        return None
+
+    os.utime(path)
+
+    return RunResult(output, meta['exit_code'], os.path.join(path, 'artifacts'), key, True)
+
+
+def new_run_dir():
+    """
+    :return: str, a fresh directory for a run's output files, kept from eviction until the run is done with it.
+    """
+    runs = os.path.join(cache_dir(), _RUNS)
+    os.makedirs(runs, exist_ok=True)
+    run_dir = tempfile.mkdtemp(dir=runs)
+
+    with _active_lock:
+        _active.add(run_dir)
+
+    return run_dir
+
+
+def discard_run_dir(run_dir):
+    """
+    Remove a run's directory once its result has been stored or isn't to be kept.
+
+    :param run_dir: str, from new_run_dir.
+    """
+    with _active_lock:
+        _active.discard(run_dir)
+
+    shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def store(key, output, exit_code, run_dir):
+    """
+    Cache a run's result, its output files are moved out of run_dir into the entry.
+
+    :param key: str, result key.
+    :param output: lst[bytes], the lines written to stdout.
+    :param exit_code: int, the process's exit code.
+    :param run_dir: str, the run's output directory.
+    :return: RunResult, the result as now cached.
+    """
+    path = entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Build the entry beside its final place and rename it in, so a reader never sees half an entry.
+    building = tempfile.mkdtemp(dir=os.path.dirname(path))
+
+    with open(os.path.join(building, 'stdout'), 'wb') as output_file:
+        output_file.writelines(output)
+
+    os.rename(run_dir, os.path.join(building, 'artifacts'))
+    discard_run_dir(run_dir)
+
+    with open(os.path.join(building, 'meta.json'), 'w') as meta_file:
+        json.dump({'exit_code': exit_code, 'created': time.time()}, meta_file)
+
+    try:
+        os.rename(building, path)
+    except OSError:  # Someone else cached the same result first.
+        shutil.rmtree(building, ignore_errors=True)
+
+    evict()
+
+    return RunResult(output, exit_code, os.path.join(path, 'artifacts'), key, False)
+
+
+def _size(path):
+    """
+    :return: int, total bytes of the files under path.
+    """
+    total = 0
+
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+
+    return total
+
+
+def evict(limit=None):
+    """
+    Remove run directories left behind by dead processes, then least recently used entries until the cache fits its
+    size limit.
+
+    :param limit: int, bytes to fit in, defaults to max_size().
+    :return: int, the number of directories removed.
+    """
+    limit = max_size() if limit is None else limit
+    root = cache_dir()
+    stale = time.time() - STALE_RUN_SECONDS
+    found = []
+    removed = 0
+
+    with _active_lock:
+        active = set(_active)
+
+    # Runs in other processes can't be told from dead ones but by age.
+    for name in _listdir(os.path.join(root, _RUNS)):
+        path = os.path.join(root, _RUNS, name)
+
+        try:
+            if path not in active and os.stat(path).st_mtime < stale:
+                shutil.rmtree(path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass
+
+    for prefix in _listdir(os.path.join(root, _ENTRIES)):
+        for name in _listdir(os.path.join(root, _ENTRIES, prefix)):
+            path = os.path.join(root, _ENTRIES, prefix, name)
+
+            try:
+                found.append((os.stat(path).st_mtime, _size(path), path))
+            except OSError:
+                pass
+
+    total = sum(size for _, size, _ in found)
+
+    for _, size, path in sorted(found):
+        if total <= limit:
+            break
+
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+
+    return removed
+
+
+def _listdir(path):
+    """
+    :return: lst[str], names in a directory, empty if it doesn't exist.
+    """
+    try:
+        return os.listdir(path)
+    except FileNotFoundError:
+        return []
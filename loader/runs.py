@@ -0,0 +1,125 @@
+"""
+Carry out queued procedure runs in the background.
+
+Runs asked for through the API are recorded as ProcedureRun rows and handed to the scheduler, see loader.scheduler,
+whose threads carry them out in their turn, so the request answers as soon as they are queued. With
+LIONEL_RUN_WORKERS at 0 they are run in the request itself.
+
+The queue only lives in memory, so runs queued or going in a process which stops are left behind in the table. Each
+process recovers them the first time it queues or reports on runs, and the recover_runs command does the same: queued
+runs are queued again, or carried out by the command, runs which have been going longer than their wall clock limit
+allows are failed. A run already taken by a live process is never carried out twice, as carrying it out claims it
+first.
+"""
+import datetime
+import functools
+import logging
+import threading
+
+from django.db import connection
+from django.utils import timezone
+
+from loader import scheduler
+
+logger = logging.getLogger(__name__)
+
+STALE_SECONDS = 24 * 60 * 60  # A run going this long without a wall clock limit is taken to be lost.
+
+GRACE_SECONDS = 60  # Allowed past a run's wall clock limit before it is taken to be lost.
+
+LOST = 'Lost when the process carrying it out stopped.'
+
+_recovered = False
+_recover_lock = threading.Lock()
+
+
+def _execute(model, pk):
+    """
+    Carry out one run on a scheduler thread, closing the thread's own database connection afterwards.
+
+    :param model: class, ProcedureRun.
+    :param pk: int, pk of the run.
+    """
+    try:
+        run = model.objects.select_related('procedure', 'file__feed', 'file__user').get(pk=pk)
+        run.execute()
+    except Exception:
+        logger.exception('Procedure run %s failed', pk)
+    finally:
+        connection.close()
+
+
+def submit(run):
+    """
+    Queue a run to be carried out.
+
+    :param run: ProcedureRun obj, a saved run.
+    """
+    if scheduler.workers() < 1:
+        run.execute()
+        return
+
+    try:
+        scheduler.shared().submit(run.file.feed, functools.partial(_execute, type(run), run.pk))
+    except scheduler.SchedulerError as error:
+        type(run).objects.filter(pk=run.pk, status=run.QUEUED).update(status=run.FAILED, error=str(error),
+                                                                      finished=timezone.now())
+
+
+def recover(model, now=None, execute=False):
+    """
+    Queue again the runs left queued, and fail those left going, by processes which have stopped.
+
+    :param model: class, ProcedureRun.
+    :param now: datetime, the time to measure how long runs have been going from, now by default.
+    :param execute: bool, carry the queued runs out here and now rather than queue them, for processes which won't
+                    stay up to see them through.
+    :return: tuple, (runs queued again, runs failed).
+    """
+    now = now or timezone.now()
+    failed = 0
+
+    for run in model.objects.select_related('file__feed').filter(status=model.RUNNING):
+        wall = scheduler.limits(run.file.feed).wall
+        allowed = wall + GRACE_SECONDS if wall is not None else STALE_SECONDS
+
+        if run.started is None or run.started < now - datetime.timedelta(seconds=allowed):
+            failed += model.objects.filter(pk=run.pk, status=model.RUNNING).update(status=model.FAILED, error=LOST,
+                                                                                 finished=now)
+
+    queued = list(model.objects.select_related('procedure', 'file__feed', 'file__user').filter(status=model.QUEUED)
+                  .order_by('queued'))
+
+    for run in queued:
+        if execute:
+            run.execute()
+        else:
+            submit(run)
+
+    if queued or failed:
+        logger.warning('Recovered procedure runs: %s queued again, %s failed', len(queued), failed)
+
+    return len(queued), failed
+
+
+def recover_once(model):
+    """
+    Recover runs left behind, the first time this process is called on to.
+
+    Only runs carried out by the scheduler's threads are recovered this way, with LIONEL_RUN_WORKERS at 0 they would
+    be carried out in whichever request came first, use the recover_runs command.
+
+    :param model: class, ProcedureRun.
+    """
+    global _recovered
+
+    with _recover_lock:
+        if _recovered or scheduler.workers() < 1:
+            return
+
+        _recovered = True
+
+    try:
+        recover(model)
+    except Exception:
+        logger.exception('Could not recover procedure runs')
@@ -0,0 +1,120 @@
+"""
+Single pass reservoir sampling of a file's rows.
+
+Sorted extracts make the first few rows a poor guide to the rest of a file, so previews and type inference use a
+uniform sample instead. Reservoirs can be stratified by byte position so every part of the file is represented.
+"""
+import itertools
+import math
+import os
+import random
+
+SAMPLE_ROWS = 1000  # Rows kept in a sample.
+
+STRATA = 10  # Byte ranges the file is split into, each gets an equal share of the sample.
+
+
+class Reservoir(object):
+    """
+    Keep a uniform random sample of at most size items from a stream of unknown length.
+
+    Uses Li's Algorithm L which jumps straight to the next item to keep, so after the reservoir fills only a
+    logarithmic number of random draws are made.
+    """
+
+    def __init__(self, size, rand=None):
+        """
+        :param size: int, the most items to keep.
+        :param rand: random.Random, source of randomness, so samples can be reproduced.
+        """
+        self.size = size
+        self.rand = rand or random.Random()
+        self.items = []
+        self.seen = 0
+
+        self._weight = 1.0
+        self._next = None
+
+    def _uniform(self):
+        """
+        :return: float, a random number in (0, 1], safe to take the log of.
+        """
+        return 1.0 - self.rand.random()
+
+    def _advance(self):
+        """
+        Work out the index of the next item to keep.
+        """
+        self._weight *= math.exp(math.log(self._uniform()) / self.size)
+
+        if self._weight >= 1.0:  # Only possible for size 0, where nothing is ever kept.
+            self._next = float('inf')
+        else:
+            self._next += int(math.log(self._uniform()) / math.log(1.0 - self._weight)) + 1
+
+    def add(self, item):
+        """
+        Offer an item to the reservoir.
+
+        :param item: object, the item.
+        """
+        index = self.seen
+        self.seen += 1
+
+        if index < self.size:
+            self.items.append(item)
+
+            if self.seen == self.size:
+                self._next = index
+                self._advance()
+        elif index == self._next:
+            self.items[self.rand.randrange(self.size)] = item
+            self._advance()
+
+
+def _split(size, parts):
+    """
+    Split size into parts integers which differ by at most one.
+
+    :param size: int, the total.
+    :param parts: int, how many parts.
+    :return: lst[int], the parts.
+    """
+    share, extra = divmod(size, parts)
+
+    return [share + (1 if idx < extra else 0) for idx in range(parts)]
+
+
+def sample_rows(reader, size=SAMPLE_ROWS, strata=STRATA, seed=None):
+    """
+    Take a uniform sample of the data rows of a file in a single pass.
+
+    When the reader can address rows by byte offset the file is split into strata by position and only the rows kept
+    are ever parsed. Otherwise every row is parsed and one reservoir is used.
+
+    :param reader: FileReader, reader over the file.
+    :param size: int, the most rows to return.
+    :param strata: int, number of byte ranges to spread the sample over, 1 to turn stratification off.
+    :param seed: int, seed for a reproducible sample.
+    :return: lst[tuple], (row number, fields) pairs in file order.
+    """
+    rand = random.Random(seed)
+
+    if not reader.byte_addressable():
+        reservoir = Reservoir(size, rand)
+
+        for item in enumerate(reader.rows()):
+            reservoir.add(item)
+
+        return sorted(reservoir.items)
+
+    total = os.path.getsize(reader.path) or 1
+    strata = max(1, min(strata, size))
+    reservoirs = [Reservoir(share, rand) for share in _split(size, strata)]
+
+    for row, (offset, record) in enumerate(reader.records()):
+        reservoirs[min(offset * strata // total, strata - 1)].add((row, record))
+
+    kept = sorted(itertools.chain.from_iterable(reservoir.items for reservoir in reservoirs))
+
+    return [(row, reader.parse(record)) for row, record in kept]
@@ -0,0 +1,270 @@
+"""
+Fair scheduling of procedure runs between feeds.
+
+Every procedure run in a process, from the API's background workers or run straight from a view, waits its turn in one
+queue. A feed's priority comes first: while a run of a higher priority feed is waiting, no lower priority run starts.
+Between feeds of the same priority runs start in weighted fair queuing order. Each run is stamped with a virtual finish
+time, the later of the virtual clock and its feed's last stamp plus one over the feed's weight, and the smallest stamp
+goes next, so a feed with twice the weight gets twice the turns however many runs the others have queued. Feeds can
+cap how many of their runs go at once, and LIONEL_RUN_WORKERS caps all of them together. Runs on a feed capped at 0,
+which could never go, fail straight away, and a run still waiting for its turn after LIONEL_RUN_QUEUE_TIMEOUT fails.
+
+Each run is also given CPU time, memory and wall clock limits, from its feed or the LIONEL_RUN_* settings, which the
+interpreter applies to the procedure's process.
+"""
+import collections
+import contextlib
+import itertools
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 4
+
+DEFAULT_TIMEOUT = 300  # Seconds a run may wait for its turn, unless LIONEL_RUN_QUEUE_TIMEOUT says otherwise.
+
+# CPU seconds, bytes of memory and wall clock seconds a run's process may use, None for no limit.
+Limits = collections.namedtuple('Limits', ['cpu', 'memory', 'wall'])
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+class SchedulerError(Exception):
+    """
+    A run could not get its turn.
+    """
+
+
+def workers():
+    """
+    :return: int, runs that may go at once, and threads carrying out queued runs, LIONEL_RUN_WORKERS.
+    """
+    return int(getattr(settings, 'LIONEL_RUN_WORKERS', DEFAULT_WORKERS))
+
+
+def limits(feed):
+    """
+    :param feed: Feed obj, the feed a run is on.
+    :return: Limits, the feed's limits, falling back to LIONEL_RUN_CPU_SECONDS, LIONEL_RUN_MEMORY and
+             LIONEL_RUN_WALL_SECONDS for those it leaves blank.
+    """
+    memory = feed.memory_limit * 1024 ** 2 if feed.memory_limit is not None else None
+
+    return Limits(feed.cpu_limit if feed.cpu_limit is not None else getattr(settings, 'LIONEL_RUN_CPU_SECONDS', None),
+                  memory if memory is not None else getattr(settings, 'LIONEL_RUN_MEMORY', None),
+                  feed.wall_limit if feed.wall_limit is not None else getattr(settings, 'LIONEL_RUN_WALL_SECONDS',
+                                                                              None))
+
+
+class Ticket(object):
+    """
+    A run's place in the queue.
+    """
+
+    def __init__(self, feed, tag, sequence, job=None):
+        """
+        :param feed: Feed obj, the run's feed, its scheduling fields are read once, here.
+        :param tag: float, the run's virtual finish time.
+        :param sequence: int, order the ticket was issued in, breaks ties.
+        :param job: callable, what to run for queued runs, None for a caller waiting for its own turn.
+        """
+        self.feed_id = feed.pk
+        self.priority = feed.priority
+        self.quota = feed.max_runs
+        self.tag = tag
+        self.sequence = sequence
+        self.job = job
+
+    def order(self):
+        """
+        :return: tuple, sorts the ticket to go next first.
+        """
+        return -self.priority, self.tag, self.sequence
+
+
+class Scheduler(object):
+    """
+    The queue of runs waiting to start, and the count of those going.
+    """
+
+    def __init__(self, slots):
+        """
+        :param slots: int, runs that may go at once.
+        """
+        self.slots = max(slots, 1)
+        self.condition = threading.Condition()
+        self.waiting = []
+        self.running = collections.Counter()  # Feed id to its runs going.
+        self.total = 0
+        self.clock = 0.0  # Virtual time, the stamp of the last run started.
+        self.last = {}  # Feed id to the stamp of its last run queued.
+        self.sequence = itertools.count()
+        self.local = threading.local()
+        self.threads = []
+
+    def enqueue(self, feed, job=None):
+        """
+        Queue a run.
+
+        :param feed: Feed obj, the run's feed.
+        :param job: callable, what to run, see Ticket.
+        :return: Ticket, its place in the queue.
+        """
+        if feed.max_runs == 0:
+            raise SchedulerError('Runs on feed {} can never start, its max runs is 0.'.format(feed.pk))
+
+        with self.condition:
+            tag = max(self.clock, self.last.get(feed.pk, 0.0)) + 1.0 / max(feed.weight, 1)
+            self.last[feed.pk] = tag
+
+            ticket = Ticket(feed, tag, next(self.sequence), job)
+            self.waiting.append(ticket)
+            self.condition.notify_all()
+
+        return ticket
+
+    def next_ticket(self):
+        """
+        Call holding the condition.
+
+        :return: Ticket or None, the waiting run to start next, None if none can start now.
+        """
+        if self.total >= self.slots:
+            return None
+
+        eligible = [ticket for ticket in self.waiting
+                    if ticket.quota is None or self.running[ticket.feed_id] < ticket.quota]
+
+        return min(eligible, key=Ticket.order, default=None)
+
+    def start(self, ticket):
+        """
+        Call holding the condition, move a ticket from waiting to running.
+
+        :param ticket: Ticket, from next_ticket.
+        """
+        self.waiting.remove(ticket)
+        self.running[ticket.feed_id] += 1
+        self.total += 1
+        self.clock = max(self.clock, ticket.tag)
+        self.condition.notify_all()  # Another run may be next now.
+
+    def finish(self, ticket):
+        """
+        :param ticket: Ticket, a run which has finished.
+        """
+        with self.condition:
+            self.running[ticket.feed_id] -= 1
+            self.total -= 1
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, feed, timeout=None):
+        """
+        Wait for a run's turn, holding its place while it goes.
+
+        A thread already holding a slot, i.e. a queued run being carried out, goes straight on.
+
+        :param feed: Feed obj, the run's feed.
+        :param timeout: float, seconds to wait, LIONEL_RUN_QUEUE_TIMEOUT by default.
+        :return: context manager.
+        """
+        if getattr(self.local, 'ticket', None) is not None:
+            yield self.local.ticket
+            return
+
+        if timeout is None:
+            timeout = getattr(settings, 'LIONEL_RUN_QUEUE_TIMEOUT', DEFAULT_TIMEOUT)
+
+        ticket = self.enqueue(feed)
+        deadline = time.monotonic() + timeout
+
+        with self.condition:
+            while self.next_ticket() is not ticket:
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    self.waiting.remove(ticket)
+                    self.condition.notify_all()  # It may have been holding back lower priority runs.
+                    raise SchedulerError('No turn for a run on feed {} after {}s.'.format(feed.pk, timeout))
+
+                self.condition.wait(remaining)
+
+            self.start(ticket)
+
+        self.local.ticket = ticket
+
+        try:
+            yield ticket
+        finally:
+            self.local.ticket = None
+            self.finish(ticket)
+
+    def submit(self, feed, job):
+        """
+        Queue a job to be carried out by the scheduler's threads in its turn.
+
+        :param feed: Feed obj, the run's feed.
+        :param job: callable, the run.
+        :return: Ticket, its place in the queue.
+        """
+        self.ensure_threads()
+
+        return self.enqueue(feed, job)
+
+    def ensure_threads(self):
+        """
+        Start a thread per slot, the first time a job is queued.
+
+        There are as many threads as slots, so whenever a slot is free a thread is too.
+        """
+        with self.condition:
+            if self.threads:
+                return
+
+            for idx in range(self.slots):
+                thread = threading.Thread(target=self.work, name='lionel-run-{}'.format(idx), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def work(self):
+        """
+        Carry out queued jobs as their turns come, forever.
+        """
+        while True:
+            with self.condition:
+                ticket = self.next_ticket()
+
+                while ticket is None or ticket.job is None:  # Other waiters take their own turns.
+                    self.condition.wait()
+                    ticket = self.next_ticket()
+
+                self.start(ticket)
+
+            self.local.ticket = ticket
+
+            try:
+                ticket.job()
+            except Exception:
+                logger.exception('Queued run on feed %s failed', ticket.feed_id)
+            finally:
+                self.local.ticket = None
+                self.finish(ticket)
+
+
+def shared():
+    """
+    :return: Scheduler, the one every run in this process goes through, made the first time it is needed.
+    """
+    global _shared
+
+    with _shared_lock:
+        if _shared is None:
+            _shared = Scheduler(workers())
+
+    return _shared
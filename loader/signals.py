@@ -0,0 +1,61 @@
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from loader import caching, profiling
+from loader.models import Column, Feed, Procedure, ProfileSwitch, SchemaDrift
+
+
+@receiver([post_save, post_delete], sender=Column)
+def clear_special_columns(sender, **kwargs):
+    """
+    Drop the cached special column choices when a Column changes.
+    """
+    cache.delete(caching.SPECIAL_COLUMNS_KEY)
+
+
+@receiver([post_save, post_delete], sender=Procedure)
+def clear_procedures(sender, **kwargs):
+    """
+    Drop the cached procedure choices when a Procedure changes.
+    """
+    cache.delete(caching.PROCEDURES_KEY)
+
+
+@receiver([post_save, post_delete], sender=SchemaDrift)
+def clear_file_drift(sender, instance, **kwargs):
+    """
+    Drop the cached drift of a file when one of its drift records changes.
+    """
+    cache.delete(caching.DRIFT_KEY.format(instance.file_id))
+
+
+@receiver(m2m_changed, sender=Feed.users.through)
+def clear_feed_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drop cached feed ids for every user whose feed memberships change, from either side of the relation.
+    """
+    if action == 'pre_clear' and not reverse:
+        # The users are about to be lost, so find them while we can.
+        Feed.clear_membership_cache(instance.users.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            Feed.clear_membership_cache([instance.pk])
+        elif pk_set:
+            Feed.clear_membership_cache(pk_set)
+
+
+@receiver(pre_delete, sender=Feed)
+def clear_deleted_feed_membership(sender, instance, **kwargs):
+    """
+    Drop cached feed ids for the users of a feed being deleted.
+    """
+    Feed.clear_membership_cache(instance.users.values_list('pk', flat=True))
+
+
+@receiver([post_save, post_delete], sender=ProfileSwitch)
+def clear_profile_switches(sender, **kwargs):
+    """
+    Drop the cached active profile switches when one changes.
+    """
+    cache.delete(profiling.SWITCHES_KEY)
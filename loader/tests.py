@@ -1,15 +1,89 @@
+import csv
 import datetime
+import gzip
 from io import StringIO
 import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
 from sqlite3 import IntegrityError
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
 from django.db.utils import IntegrityError
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils import timezone
 
+from loader import (admission, bench, caching, compaction, dedup, drift, exports, inbox, ingest, keyindex, loading,
+                    loadtest, metrics, pagination, plugins, profiling, readers, results, runs, sampling, scheduler,
+                    sniffer, validation)
 from loader.forms import FileForm
-from loader.models import File, Feed, Column, feed_directory_path
+from loader.plugins._interpreter import run_process
+from loader.views import FEED_FIELDS
+from loader.models import (ApiToken, File, Feed, Column, KeyIndex, Procedure, ProcedureRun, ProfileCapture,
+                           ProfileSwitch, SchemaDrift, StageMetric, feed_directory_path)
+
+
+class FeedFixtureMixin(object):
+    """
+    A media directory with the settings pointed at it, and a user who is a member of a feed, for test cases which
+    store files.
+
+    Test cases name the user and feed with name, and may add settings and feed fields with extra_settings and
+    feed_fields.
+    """
+    name = None
+
+    def extra_settings(self):
+        """
+        :return: dict, settings to override as well as the media root, metrics and admission ledger.
+        """
+        return {}
+
+    def feed_fields(self):
+        """
+        :return: dict, fields of the feed besides its name.
+        """
+        return {}
+
+    def setUp(self):
+        """
+        Need a media directory, a user and a feed they are a member of.
+
+        The admission ledger is kept out of the media directory, so tests can check what was stored there.
+
+        :return: None
+        """
+        self.media = tempfile.mkdtemp()
+        self.ledger = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media, LIONEL_METRICS=False,
+                                          LIONEL_ADMISSION_LEDGER=os.path.join(self.ledger, 'ledger.json'),
+                                          **self.extra_settings())
+        self.settings.enable()
+
+        self.user = User.objects.create_user(self.name, '{}@example.com'.format(self.name), 'password')
+        self.feed = Feed.objects.create(name='{}_feed'.format(self.name), **self.feed_fields())
+        self.feed.users.add(self.user)
+
+    def tearDown(self):
+        """
+        Remove the media and ledger directories.
+
+        :return: None
+        """
+        self.settings.disable()
+        shutil.rmtree(self.media)
+        shutil.rmtree(self.ledger)
 
 
 class FileTestCase(TestCase):
@@ -149,6 +223,20 @@ class FeedTestCase(TestCase):
         with self.assertRaises(IntegrityError):
             Feed.objects.create(name='Test Name')
 
+    def test_form_fields(self):
+        """
+        Ensure members can't set the feed's inbox, schema, pruning or scheduling from the feed pages.
+
+        :return: None
+        """
+        self.assertNotIn('inbox', FEED_FIELDS)
+        self.assertNotIn('schema', FEED_FIELDS)
+        self.assertNotIn('prune_after', FEED_FIELDS)
+
+        for name in ('priority', 'weight', 'max_runs', 'cpu_limit', 'memory_limit', 'wall_limit'):
+            self.assertNotIn(name, FEED_FIELDS)
+        self.assertTrue(set(FEED_FIELDS) < {field.name for field in Feed._meta.get_fields()})
+
 
 class ColumnTestCase(TestCase):
     """
@@ -179,3 +267,2299 @@ class ColumnTestCase(TestCase):
         """
         with self.assertRaises(IntegrityError):
             Column.objects.create(name='Test Col', col_type='text')
+
+
+class SchemaDriftTestCase(TestCase):
+    """
+    Test cases for schema drift detection.
+    """
+    def setUp(self):
+        """
+        Set up a feed with an accepted schema and a user to upload with.
+
+        :return: None
+        """
+        self.media = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media)
+        self.settings.enable()
+
+        self.user = User.objects.create_user('good', 'good@example.com', 'password')
+
+        self.schema = {'delimiter': ',', 'has_header': True, 'width': 3, 'columns': ['id', 'name', 'amount']}
+
+        self.feed = Feed.objects.create(name='drift_feed')
+        self.feed.set_schema(self.schema)
+        self.feed.save()
+
+    def tearDown(self):
+        """
+        Remove the uploads.
+
+        :return: None
+        """
+        self.settings.disable()
+        shutil.rmtree(self.media)
+
+    def make_file(self, schema):
+        """
+        Create a file on the feed with a prebuilt schema.
+
+        :param schema: dict, the schema the file should have.
+        :return: File, the new file.
+        """
+        file = File(user=self.user, feed=self.feed)
+        file.data.save('drift.csv', ContentFile(b'test text'))
+        file.schema = json.dumps(schema)
+
+        return file
+
+    def test_no_changes(self):
+        """
+        Ensure identical schemas produce no changes.
+
+        :return: None
+        """
+        self.assertEqual(drift.compare_schemas(self.schema, dict(self.schema)), [])
+
+    def test_column_changes(self):
+        """
+        Ensure added, removed and moved columns are all found.
+
+        :return: None
+        """
+        new = dict(self.schema, width=3, columns=['name', 'id', 'total'])
+
+        kinds = sorted((change['kind'], change.get('column')) for change in drift.compare_schemas(self.schema, new))
+
+        self.assertEqual(kinds, [('added', 'total'), ('moved', 'id'), ('moved', 'name'), ('removed', 'amount')])
+
+    def test_dialect_changes(self):
+        """
+        Ensure delimiter and header changes are found.
+
+        :return: None
+        """
+        new = dict(self.schema, delimiter='|', has_header=False, columns=[])
+
+        kinds = [change['kind'] for change in drift.compare_schemas(self.schema, new)]
+
+        self.assertEqual(kinds, ['delimiter', 'header'])
+
+    def test_type_widening(self):
+        """
+        Ensure type changes are flagged, noting when they only widen the column.
+
+        :return: None
+        """
+        old = dict(self.schema, types=['number', 'varchar2(10)', 'number'])
+        new = dict(self.schema, types=['number', 'varchar2(20)', 'date'])
+
+        changes = drift.compare_schemas(old, new)
+
+        self.assertEqual([(c['column'], c['widened']) for c in changes], [('name', True), ('amount', False)])
+
+    def test_drift_recorded(self):
+        """
+        Ensure a drifting file is recorded but still accepted when the feed doesn't block.
+
+        :return: None
+        """
+        new = dict(self.schema, width=4, columns=['id', 'name', 'amount', 'extra'])
+        file = self.make_file(new)
+
+        record = file.check_drift()
+
+        self.assertIsInstance(record, SchemaDrift)
+        self.assertTrue(file.accepted)
+        self.assertEqual(Feed.objects.get(pk=self.feed.pk).get_schema(), new)
+
+    def test_drift_blocked(self):
+        """
+        Ensure a drifting file is blocked when the feed asks for it, leaving the schema alone.
+
+        :return: None
+        """
+        self.feed.block_on_drift = True
+        self.feed.save()
+
+        file = self.make_file(dict(self.schema, delimiter='|'))
+
+        record = file.check_drift()
+
+        self.assertTrue(record.blocked)
+        self.assertFalse(file.accepted)
+        self.assertEqual(Feed.objects.get(pk=self.feed.pk).get_schema(), self.schema)
+
+        file.accept()
+
+        self.assertEqual(Feed.objects.get(pk=self.feed.pk).get_schema()['delimiter'], '|')
+
+    def test_blocked_file_not_run(self):
+        """
+        Ensure asking to run a procedure on a blocked file shows the page again rather than failing.
+
+        :return: None
+        """
+        self.feed.users.add(self.user)
+
+        file = self.make_file(self.schema)
+        file.accepted = False
+        file.save()
+
+        procedure = Procedure(language='Python', name='echo', comments='Echo.', user=self.user)
+        procedure.procedure.save('echo.py', ContentFile(b'print(1)\n'))
+
+        self.client.login(username='good', password='password')
+        response = self.client.post(reverse('loader:view_file', args=[file.pk]), {'procedure': procedure.pk})
+
+        self.assertEqual(response.status_code, 409)
+
+
+class FeedTemplateTestCase(TestCase):
+    """
+    Test cases for matching uploads against a learnt feed template.
+    """
+    def setUp(self):
+        """
+        Set up a feed with a learnt template and a file whose first lines we control.
+
+        :return: None
+        """
+        self.user = User.objects.create_user('good', 'good@example.com', 'password')
+
+        self.template = {'delimiter': '|', 'terminator': '\r\n', 'encoding': 'utf-8', 'has_header': True, 'width': 3,
+                         'columns': ['id', 'name', 'amount'], 'types': ['number', 'varchar2(5)', 'number']}
+
+        self.feed = Feed.objects.create(name='template_feed')
+        self.feed.set_schema(self.template)
+        self.feed.save()
+
+        self.file = File(user=self.user, feed=self.feed)
+
+    def test_matching_file(self):
+        """
+        Ensure a file laid out like the template takes its dialect and types without sniffing.
+
+        :return: None
+        """
+        self.file.get_first_lines = lambda num, encoding=None: ['id|name|amount\n', '1|bob|2\n']
+
+        self.assertTrue(self.file.get_table_info())
+        self.assertEqual(self.file.delimiter, '|')
+        self.assertEqual(self.file.encoding, 'utf-8')
+        self.assertEqual(self.file.get_column_types(), self.template['types'])
+
+    def test_changed_file(self):
+        """
+        Ensure a file with a different header or width fails the template check.
+
+        :return: None
+        """
+        self.file.get_first_lines = lambda num, encoding=None: ['id|name|amount|extra\n', '1|bob|2|3\n']
+        self.assertFalse(self.file.matches_template(self.template))
+
+        self.file.get_first_lines = lambda num, encoding=None: ['ID|NAME|AMOUNT\n', '1|bob|2\n']
+        self.assertFalse(self.file.matches_template(self.template))
+
+    def test_sample_fits_types(self):
+        """
+        Ensure template types are only trusted while the sampled values still fit them.
+
+        :return: None
+        """
+        self.file.sample = json.dumps([[0, ['1', 'bob', '2']], [1, ['2', '', '']]])
+        self.assertTrue(self.file.sample_fits_types(self.template['types']))
+
+        self.file.sample = json.dumps([[0, ['1', 'bob', 'two']]])
+        self.assertFalse(self.file.sample_fits_types(self.template['types']))
+
+        self.file.sample = json.dumps([[0, ['1', 'robert', '2']]])
+        self.assertFalse(self.file.sample_fits_types(self.template['types']))
+
+
+class SnifferTestCase(TestCase):
+    """
+    Test cases for dialect and encoding detection, run against the files in test_corpus.
+    """
+    CORPUS_DIR = os.path.join(os.path.dirname(__file__), 'test_corpus')
+
+    def test_corpus(self):
+        """
+        Ensure every corpus file is detected as expected.
+
+        :return: None
+        """
+        with open(os.path.join(self.CORPUS_DIR, 'expected.json')) as expected_file:
+            expected = json.load(expected_file)
+
+        for name, attributes in expected.items():
+            dialect = sniffer.sniff_file(os.path.join(self.CORPUS_DIR, name))
+
+            for attribute, value in attributes.items():
+                self.assertEqual(getattr(dialect, attribute), value, '{} {}'.format(name, attribute))
+
+    def test_empty_sample(self):
+        """
+        Ensure an empty file falls back to defaults rather than raising.
+
+        :return: None
+        """
+        dialect = sniffer.detect(b'')
+
+        self.assertEqual(dialect.delimiter, ',')
+        self.assertFalse(dialect.has_header)
+
+    def test_truncated_sample(self):
+        """
+        Ensure a sample cut off mid row and mid character still detects cleanly.
+
+        :return: None
+        """
+        sample = ('id;name\n' + '1;Zoë\n' * 20).encode('utf-8')[:-2]
+
+        dialect = sniffer.detect(sample, size=len(sample))
+
+        self.assertEqual(dialect.delimiter, ';')
+        self.assertEqual(dialect.encoding, 'utf-8')
+
+
+class FileReaderTestCase(TestCase):
+    """
+    Test cases for the shared file reader.
+    """
+    def setUp(self):
+        """
+        Write the same data plain and gzipped, with a quoted newline to trip up naive line counting.
+
+        :return: None
+        """
+        self.dir = tempfile.mkdtemp()
+        self.rows = [[str(idx), 'note\nsplit' if idx == 3 else 'note'] for idx in range(25)]
+
+        data = 'id,note\n' + ''.join('{},"{}"\n'.format(*row) for row in self.rows)
+
+        self.plain = os.path.join(self.dir, 'plain.csv')
+        with open(self.plain, 'w') as plain_file:
+            plain_file.write(data)
+
+        self.zipped = os.path.join(self.dir, 'zipped.csv.gz')
+        with gzip.open(self.zipped, 'wt') as zipped_file:
+            zipped_file.write(data)
+
+    def tearDown(self):
+        """
+        Remove the test files.
+
+        :return: None
+        """
+        shutil.rmtree(self.dir)
+
+    def test_rows(self):
+        """
+        Ensure both files give the same header and rows.
+
+        :return: None
+        """
+        for path in (self.plain, self.zipped):
+            reader = readers.FileReader(path)
+
+            self.assertEqual(reader.header, ['id', 'note'])
+            self.assertEqual(list(reader.rows()), self.rows)
+
+    def test_pages(self):
+        """
+        Ensure pages line up with rows whether read by offset or by skipping.
+
+        :return: None
+        """
+        plain = readers.FileReader(self.plain)
+        zipped = readers.FileReader(self.zipped)
+
+        self.assertEqual(plain.page_count(), 3)
+        self.assertIsNone(zipped.page_count())
+
+        for number in range(4):
+            self.assertEqual(plain.page(number), self.rows[number * 10:(number + 1) * 10])
+            self.assertEqual(zipped.page(number), self.rows[number * 10:(number + 1) * 10])
+
+    def test_chunks(self):
+        """
+        Ensure chunks cover every row with the header as column names.
+
+        :return: None
+        """
+        chunks = list(readers.FileReader(self.plain).chunks(size=10))
+
+        self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+        self.assertEqual(list(chunks[0].columns), ['id', 'note'])
+
+    def test_carriage_returns(self):
+        """
+        Ensure a file with lines ending in a carriage return alone is read row by row, not by newlines on disk.
+
+        :return: None
+        """
+        path = os.path.join(self.dir, 'mac.csv')
+        with open(path, 'w', newline='') as mac_file:
+            mac_file.write('id,note\r' + ''.join('{},{}\r'.format(*row) for row in self.rows if '\n' not in row[1]))
+
+        terminator = sniffer.sniff_file(path).lineterminator
+        reader = readers.FileReader(path, terminator=terminator)
+
+        self.assertEqual(terminator, '\r')
+        self.assertFalse(reader.byte_addressable())
+        self.assertIsNone(reader.split(4))
+        self.assertEqual(reader.page(1), [row for row in self.rows if '\n' not in row[1]][10:20])
+
+
+class SamplingTestCase(TestCase):
+    """
+    Test cases for reservoir sampling of file rows.
+    """
+    def setUp(self):
+        """
+        Write a sorted file, the case where the head of a file is least representative.
+
+        :return: None
+        """
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'sorted.csv')
+
+        with open(self.path, 'w') as data_file:
+            data_file.write('id,value\n')
+            data_file.writelines('{:04d},{:05d}\n'.format(idx, idx * 2) for idx in range(5000))
+
+    def tearDown(self):
+        """
+        Remove the test file.
+
+        :return: None
+        """
+        shutil.rmtree(self.dir)
+
+    def test_reservoir(self):
+        """
+        Ensure a reservoir keeps exactly size distinct items, or everything when given fewer.
+
+        :return: None
+        """
+        reservoir = sampling.Reservoir(10)
+        for idx in range(1000):
+            reservoir.add(idx)
+
+        self.assertEqual(len(set(reservoir.items)), 10)
+
+        reservoir = sampling.Reservoir(10)
+        for idx in range(5):
+            reservoir.add(idx)
+
+        self.assertEqual(reservoir.items, [0, 1, 2, 3, 4])
+
+    def test_stratified_sample(self):
+        """
+        Ensure the sample is spread across the whole file and rows match their numbers.
+
+        :return: None
+        """
+        rows = sampling.sample_rows(readers.FileReader(self.path), size=100, strata=10, seed=1)
+
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows, sorted(rows))
+        self.assertTrue(all(values == ['{:04d}'.format(row), '{:05d}'.format(row * 2)] for row, values in rows))
+
+        # Rows are all the same width, so each tenth of the file holds a tenth of the sample.
+        for stratum in range(10):
+            in_stratum = [row for row, _ in rows if stratum * 500 <= row < (stratum + 1) * 500]
+            self.assertAlmostEqual(len(in_stratum), 10, delta=1)
+
+    def test_reproducible(self):
+        """
+        Ensure the same seed gives the same sample.
+
+        :return: None
+        """
+        reader = readers.FileReader(self.path)
+
+        self.assertEqual(sampling.sample_rows(reader, size=20, seed=3), sampling.sample_rows(reader, size=20, seed=3))
+
+
+class CachingTestCase(TestCase):
+    """
+    Test cases for the cached preview choice lists.
+    """
+    def setUp(self):
+        """
+        Start every test with an empty cache.
+
+        :return: None
+        """
+        cache.clear()
+
+    def test_cached(self):
+        """
+        Ensure the choices only hit the database once.
+
+        :return: None
+        """
+        Column.objects.create(name='Account', col_type='text')
+
+        with self.assertNumQueries(1):
+            caching.special_column_choices()
+            caching.special_column_choices()
+
+    def test_invalidated(self):
+        """
+        Ensure saving or deleting a column drops the cached choices.
+
+        :return: None
+        """
+        column = Column.objects.create(name='Account', col_type='text')
+        self.assertEqual(caching.special_column_choices(), [(column.pk, 'Account')])
+
+        other = Column.objects.create(name='Customer', col_type='text')
+        self.assertEqual(caching.special_column_choices(), [(column.pk, 'Account'), (other.pk, 'Customer')])
+
+        column.delete()
+        self.assertEqual(caching.special_column_choices(), [(other.pk, 'Customer')])
+
+
+class FeedMembershipTestCase(TestCase):
+    """
+    Test cases for checking and caching feed membership.
+    """
+    def setUp(self):
+        """
+        Set up a feed with one member and one outsider.
+
+        :return: None
+        """
+        cache.clear()
+
+        self.member = User.objects.create_user('member', 'member@example.com', 'password')
+        self.outsider = User.objects.create_user('outsider', 'outsider@example.com', 'password')
+
+        self.feed = Feed.objects.create(name='member_feed')
+        self.feed.users.add(self.member)
+
+    def test_has_user(self):
+        """
+        Ensure only members pass the check.
+
+        :return: None
+        """
+        self.assertTrue(self.feed.has_user(self.member))
+        self.assertFalse(self.feed.has_user(self.outsider))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.feed.has_user(self.member))
+
+    def test_cached(self):
+        """
+        Ensure checks are answered from the cache once a user's feed ids are loaded.
+
+        :return: None
+        """
+        Feed.user_feed_ids(self.member)
+
+        with self.assertNumQueries(0):
+            self.assertTrue(self.feed.has_user(self.member))
+
+    def test_invalidated(self):
+        """
+        Ensure adding and removing members from either side clears the cache.
+
+        :return: None
+        """
+        self.assertEqual(Feed.user_feed_ids(self.outsider), frozenset())
+
+        self.feed.users.add(self.outsider)
+        self.assertTrue(self.feed.has_user(self.outsider))
+        self.assertEqual(Feed.user_feed_ids(self.outsider), frozenset([self.feed.pk]))
+
+        self.outsider.feed_set.remove(self.feed)
+        self.assertFalse(self.feed.has_user(self.outsider))
+
+        Feed.user_feed_ids(self.member)
+        self.feed.users.clear()
+        self.assertFalse(self.feed.has_user(self.member))
+
+
+class KeysetPaginationTestCase(TestCase):
+    """
+    Test cases for cursor based pagination.
+    """
+    def setUp(self):
+        """
+        Set up enough feeds to fill several pages.
+
+        :return: None
+        """
+        for idx in range(25):
+            Feed.objects.create(name='feed_{:02d}'.format(idx))
+
+    def test_pages(self):
+        """
+        Ensure following cursors visits every row exactly once, in order.
+
+        :return: None
+        """
+        seen = []
+        page, cursor = pagination.keyset_page(Feed.objects.all(), ('name',), per_page=10)
+        seen.extend(page)
+
+        while cursor:
+            page, cursor = pagination.keyset_page(Feed.objects.all(), ('name',), cursor, per_page=10)
+            seen.extend(page)
+
+        self.assertEqual([feed.name for feed in seen], ['feed_{:02d}'.format(idx) for idx in range(25)])
+
+    def test_descending(self):
+        """
+        Ensure descending orderings with a tie breaker page correctly.
+
+        :return: None
+        """
+        first, cursor = pagination.keyset_page(Feed.objects.all(), ('-name', '-pk'), per_page=20)
+        second, cursor = pagination.keyset_page(Feed.objects.all(), ('-name', '-pk'), cursor, per_page=20)
+
+        self.assertEqual(first[0].name, 'feed_24')
+        self.assertEqual([feed.name for feed in second], ['feed_04', 'feed_03', 'feed_02', 'feed_01', 'feed_00'])
+        self.assertIsNone(cursor)
+
+    def test_bad_cursor(self):
+        """
+        Ensure a mangled cursor just gives the first page.
+
+        :return: None
+        """
+        page, _ = pagination.keyset_page(Feed.objects.all(), ('name',), 'not a cursor', per_page=5)
+
+        self.assertEqual(page[0].name, 'feed_00')
+
+
+class MetricsTestCase(TestCase):
+    """
+    Test cases for stage metrics and their Prometheus output.
+    """
+    def setUp(self):
+        """
+        Set up a feed to record stages against.
+
+        :return: None
+        """
+        self.feed = Feed.objects.create(name='metric_feed')
+
+    def test_stage_recorded(self):
+        """
+        Ensure a stage stores its timing and counters, and failures are marked.
+
+        :return: None
+        """
+        with metrics.stage('load', feed=self.feed) as timer:
+            timer.rows = 10
+
+        with self.assertRaises(ValueError):
+            with metrics.stage('load', feed=self.feed):
+                raise ValueError()
+
+        recorded = StageMetric.objects.order_by('pk')
+
+        self.assertEqual([(m.stage, m.rows, m.success) for m in recorded], [('load', 10, True), ('load', None, False)])
+
+    def test_percentile(self):
+        """
+        Ensure nearest rank percentiles pick the right values.
+
+        :return: None
+        """
+        values = list(range(1, 101))
+
+        self.assertEqual(metrics.percentile(values, 0.5), 50)
+        self.assertEqual(metrics.percentile(values, 0.99), 99)
+        self.assertEqual(metrics.percentile([7], 0.95), 7)
+
+    def test_prometheus_text(self):
+        """
+        Ensure summaries are exposed per feed and stage.
+
+        :return: None
+        """
+        for duration in (0.1, 0.2, 0.3):
+            StageMetric.objects.create(feed=self.feed, stage='sniff', duration=duration, rows=5)
+
+        text = metrics.prometheus_text(metrics.summarise(), metrics.totals())
+
+        self.assertIn('lionel_stage_duration_seconds{feed="metric_feed",quantile="0.5",stage="sniff"} 0.200000', text)
+        self.assertIn('lionel_stage_duration_seconds_count{feed="metric_feed",stage="sniff"} 3', text)
+        self.assertIn('lionel_stage_rows_total{feed="metric_feed",stage="sniff"} 15', text)
+
+    def test_totals_outlast_window(self):
+        """
+        Ensure the counters keep old measurements the window has moved past, so they never go down.
+
+        :return: None
+        """
+        old = StageMetric.objects.create(feed=self.feed, stage='sniff', duration=1.0, rows=5)
+        StageMetric.objects.filter(pk=old.pk).update(started=timezone.now() - datetime.timedelta(days=2))
+        StageMetric.objects.create(feed=self.feed, stage='sniff', duration=2.0, rows=1)
+
+        self.assertEqual([summary['count'] for summary in metrics.summarise()], [1])
+        self.assertEqual([(total['count'], total['rows']) for total in metrics.totals()], [(2, 6)])
+
+
+class ProfilingTestCase(TestCase):
+    """
+    Test cases for on demand profile captures.
+    """
+    def setUp(self):
+        """
+        Set up a switch for one feed, storing captures in a temporary directory.
+
+        :return: None
+        """
+        cache.clear()
+
+        self.media = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media)
+        self.settings.enable()
+
+        self.feed = Feed.objects.create(name='slow_feed')
+        self.other_feed = Feed.objects.create(name='fast_feed')
+
+        self.switch = ProfileSwitch.objects.create(feed=self.feed, remaining=1)
+
+    def tearDown(self):
+        """
+        Remove stored captures.
+
+        :return: None
+        """
+        self.settings.disable()
+        shutil.rmtree(self.media)
+
+    def test_capture(self):
+        """
+        Ensure matching work is captured and the switch counts down until it stops matching.
+
+        :return: None
+        """
+        with profiling.capture('test', feed=self.feed) as session:
+            self.assertIsNotNone(session)
+            sorted(range(10000), key=lambda value: -value)
+
+        profile = ProfileCapture.objects.get()
+
+        self.assertEqual(profile.switch, self.switch)
+        self.assertIn('function calls', profile.report)
+        self.assertTrue(profile.stats.name.endswith('.pstats'))
+
+        with profiling.capture('test', feed=self.feed) as session:
+            self.assertIsNone(session)
+
+    def test_no_match(self):
+        """
+        Ensure work on other feeds isn't captured.
+
+        :return: None
+        """
+        with profiling.capture('test', feed=self.other_feed) as session:
+            self.assertIsNone(session)
+
+        self.assertFalse(ProfileCapture.objects.exists())
+
+    def test_nested(self):
+        """
+        Ensure a capture inside another on the same thread joins it rather than replacing its profiler.
+
+        :return: None
+        """
+        with profiling.capture('outer', feed=self.feed) as outer:
+            with profiling.capture('inner', feed=self.feed) as inner:
+                self.assertIs(inner, outer)
+
+        self.assertEqual(ProfileCapture.objects.get().target, 'outer')
+
+    def test_overlapping_tracing(self):
+        """
+        Ensure tracemalloc stays on until the last of overlapping captures finishes.
+
+        :return: None
+        """
+        profiling._start_tracing()
+        profiling._start_tracing()
+
+        self.assertIsNotNone(profiling._stop_tracing())
+        self.assertTrue(tracemalloc.is_tracing())
+        self.assertIsNotNone(profiling._stop_tracing())
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+class LoadingTestCase(TestCase):
+    """
+    Test the synthetic feed generator and loading files into tables.
+    """
+    def setUp(self):
+        """
+        Generate a small file to work with.
+
+        :return: None
+        """
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'bench.csv.gz')
+
+        bench.generate_file(self.path, rows=25, width=5, compression='gzip', quoting='all', seed=3)
+
+    def tearDown(self):
+        """
+        Remove the generated file.
+
+        :return: None
+        """
+        shutil.rmtree(self.dir)
+
+    def test_generate_file(self):
+        """
+        Ensure generated files are reproducible and readable through FileReader.
+
+        :return: None
+        """
+        reader = readers.FileReader(self.path, encoding='utf-8')
+
+        self.assertEqual(reader.header, ['id', 'int_1', 'float_2', 'str_3', 'date_4'])
+        self.assertEqual([row[0] for row in reader.rows()], [str(row) for row in range(25)])
+
+        other = os.path.join(self.dir, 'other.csv.gz')
+        bench.generate_file(other, rows=25, width=5, compression='gzip', quoting='all', seed=3)
+
+        self.assertEqual(list(readers.FileReader(other, encoding='utf-8').rows()), list(reader.rows()))
+
+    def test_column_names(self):
+        """
+        Ensure headers become unique, safe column names.
+
+        :return: None
+        """
+        self.assertEqual(loading.column_names(['Name', 'name', '1st go', ''], 5),
+                         ['name', 'name_1', 'c_1st_go', 'col_3', 'col_4'])
+
+    def test_sql_type(self):
+        """
+        Ensure inferred types map onto each vendor's types.
+
+        :return: None
+        """
+        self.assertEqual(loading.sql_type('number', 'sqlite'), 'NUMERIC')
+        self.assertEqual(loading.sql_type('varchar2(12)', 'oracle'), 'VARCHAR2(12)')
+        self.assertEqual(loading.sql_type(None, 'postgresql'), 'TEXT')
+
+    def test_clean_row(self):
+        """
+        Ensure rows are fitted to the table and empty fields become NULL.
+
+        :return: None
+        """
+        self.assertEqual(loading.clean_row(['a', ''], 3), ['a', None, None])
+        self.assertEqual(loading.clean_row(['a', 'b', 'c'], 2), ['a', 'b'])
+
+    def test_fit_types(self):
+        """
+        Ensure values outside the sample widen the types they don't fit.
+
+        :return: None
+        """
+        rows = [['1', 'ab', '2017-01-01', 'x']] * 1500 + [['n/a', 'abcdef', 'soon', 'y']]
+
+        self.assertEqual(loading.fit_types(rows, ['number', 'varchar2(2)', 'date', None], batch_size=100),
+                         [None, 'varchar2(6)', None, None])
+        self.assertEqual(loading.fit_types(rows[:1500], ['number', 'varchar2(2)', 'date', None]),
+                         ['number', 'varchar2(2)', 'date', None])
+
+
+class LoadTestTestCase(TestCase):
+    """
+    Test the load test harness.
+    """
+    def setUp(self):
+        """
+        Need a user on a feed and somewhere to put their uploads.
+
+        :return: None
+        """
+        self.media = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media)
+        self.settings.enable()
+
+        self.user = User.objects.create_user('load', 'load@example.com', 'password')
+        self.feed = Feed.objects.create(name='load_feed')
+        self.feed.users.add(self.user)
+
+    def tearDown(self):
+        """
+        Remove the uploads.
+
+        :return: None
+        """
+        self.settings.disable()
+        shutil.rmtree(self.media)
+
+    def test_recorder_report(self):
+        """
+        Ensure timings are summarised per endpoint.
+
+        :return: None
+        """
+        recorder = loadtest.Recorder()
+
+        for idx in range(1, 101):
+            recorder.add('preview', idx / 100, idx % 10 != 0)
+
+        report = recorder.report(10)['preview']
+
+        self.assertEqual(report['count'], 100)
+        self.assertEqual(report['errors'], 10)
+        self.assertEqual(report['throughput'], 10)
+        self.assertEqual(report['p50'], 0.5)
+        self.assertEqual(report['p99'], 0.99)
+
+    def test_encode_multipart(self):
+        """
+        Ensure fields and files are both encoded.
+
+        :return: None
+        """
+        body, content_type = loadtest.encode_multipart({'feed': 1}, {'data': ('a.csv', b'a,b\n1,2\n')})
+
+        self.assertTrue(content_type.startswith('multipart/form-data; boundary='))
+        self.assertIn(b'name="feed"\r\n\r\n1\r\n', body)
+        self.assertIn(b'filename="a.csv"', body)
+        self.assertIn(b'a,b\n1,2\n', body)
+
+    def test_simulated_user(self):
+        """
+        Ensure a simulated user logs in, uploads and previews without errors.
+
+        :return: None
+        """
+        pool = [('load.csv', b'id,name\n1,one\n2,two\n')]
+        recorder = loadtest.Recorder()
+        user = loadtest.SimulatedUser(loadtest.ClientSession(), recorder, 'load', 'password', self.feed.pk, None, pool)
+
+        user.run(float('inf'), max_requests=4)
+
+        report = recorder.report(1)
+
+        self.assertEqual(report['login']['errors'], 0)
+        self.assertEqual(report['upload']['errors'], 0)
+        self.assertEqual(sum(stats['count'] for endpoint, stats in report.items() if endpoint != 'login'), 4)
+        self.assertEqual(File.objects.filter(feed=self.feed).count(), report['upload']['count'])
+
+
+class IngestTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test headless ingestion of files on disk.
+    """
+    name = 'ingest'
+
+    def setUp(self):
+        """
+        Need a feed, a user and a directory of files, two of which are identical.
+
+        :return: None
+        """
+        super(IngestTestCase, self).setUp()
+        self.inbox = tempfile.mkdtemp()
+
+        for name, seed in (('a.csv', 1), ('b.csv', 2), ('copy_of_a.csv', 1)):
+            bench.generate_file(os.path.join(self.inbox, name), rows=20, width=4, seed=seed)
+
+    def tearDown(self):
+        """
+        Remove the files.
+
+        :return: None
+        """
+        super(IngestTestCase, self).tearDown()
+        shutil.rmtree(self.inbox)
+
+    def test_find_files(self):
+        """
+        Ensure directories and globs expand to each file once.
+
+        :return: None
+        """
+        paths = ingest.find_files([self.inbox, os.path.join(self.inbox, '*.csv')])
+
+        self.assertEqual([os.path.basename(path) for path in paths], ['a.csv', 'b.csv', 'copy_of_a.csv'])
+
+    def test_ingest(self):
+        """
+        Ensure files are stored, loaded and repeated content is skipped.
+
+        :return: None
+        """
+        ingester = ingest.Ingester(self.feed, self.user, profile=False)
+        results = [ingester.ingest(path) for path in ingest.find_files([self.inbox])]
+
+        self.assertEqual([result.status for result in results], [ingest.INGESTED, ingest.INGESTED, ingest.SKIPPED])
+        self.assertEqual(results[0].rows, 20)
+        self.assertTrue(results[0].file.data.name.startswith(os.path.join('uploads', 'ingest_feed')))
+
+        summary = ingest.summarise(results, 1)
+
+        self.assertEqual((summary['ingested'], summary['skipped'], summary['rows']), (2, 1, 40))
+
+        again = ingest.Ingester(self.feed, self.user, profile=False)
+
+        self.assertEqual(again.ingest(os.path.join(self.inbox, 'b.csv')).status, ingest.SKIPPED)
+
+    def test_failure_cleaned_up(self):
+        """
+        Ensure a file failing part way leaves no record, table, key index or stored copy behind.
+
+        :return: None
+        """
+        Column.objects.create(name='id', col_type='number')
+
+        class Failing(object):
+            def run(self, file):
+                raise RuntimeError('procedure failed')
+
+        ingester = ingest.Ingester(self.feed, self.user, procedures=[Failing()], profile=False)
+        result = ingester.ingest(os.path.join(self.inbox, 'a.csv'))
+
+        self.assertEqual((result.status, result.error), (ingest.FAILED, 'procedure failed'))
+        self.assertFalse(File.objects.exists())
+        self.assertFalse(KeyIndex.objects.exists())
+        self.assertFalse([name for name in connection.introspection.table_names() if name.startswith('lnl_file_')])
+        self.assertEqual([names for _, _, names in os.walk(self.media) if names], [])
+
+
+class InboxTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test picking up complete files from feed inboxes.
+    """
+    name = 'inbox'
+
+    def feed_fields(self):
+        """
+        :return: dict, fields of the feed besides its name.
+        """
+        return {'inbox': self.inbox}
+
+    def setUp(self):
+        """
+        Need a feed with an inbox and a watcher over it.
+
+        :return: None
+        """
+        self.inbox = tempfile.mkdtemp()
+        super(InboxTestCase, self).setUp()
+
+        self.ingester = ingest.Ingester(self.feed, self.user, profile=False)
+        self.watcher = inbox.Watcher({self.inbox: self.ingester}, workers=1, settle=0, poll=True)
+
+    def tearDown(self):
+        """
+        Remove the directories.
+
+        :return: None
+        """
+        self.watcher.close()
+        super(InboxTestCase, self).tearDown()
+        shutil.rmtree(self.inbox)
+
+    def test_is_candidate(self):
+        """
+        Ensure hidden, partial and marker files are never picked up.
+
+        :return: None
+        """
+        self.assertTrue(inbox.is_candidate('feed.csv'))
+        self.assertFalse(inbox.is_candidate('.feed.csv'))
+        self.assertFalse(inbox.is_candidate('feed.csv.part'))
+        self.assertFalse(inbox.is_candidate('feed.csv.done'))
+
+    def test_allowed_inbox(self):
+        """
+        Ensure only inboxes under LIONEL_INBOX_ROOTS are watched, however their path is spelt.
+
+        :return: None
+        """
+        with override_settings(LIONEL_INBOX_ROOTS=[os.path.dirname(self.inbox)]):
+            self.assertTrue(inbox.allowed_inbox(self.inbox))
+            self.assertFalse(inbox.allowed_inbox(os.path.join(self.inbox, '..', '..')))
+
+        with override_settings(LIONEL_INBOX_ROOTS=[self.media]):
+            self.assertFalse(inbox.allowed_inbox(self.inbox))
+            self.assertFalse(inbox.allowed_inbox(self.media + '_elsewhere'))
+
+            with self.assertRaises(CommandError):
+                call_command('watch_inboxes', '--user', 'inbox', '--once', '--settle', '0', stderr=StringIO())
+
+    def test_scan(self):
+        """
+        Ensure files are only taken once they have held still or have a marker.
+
+        :return: None
+        """
+        still = os.path.join(self.inbox, 'still.csv')
+        marked = os.path.join(self.inbox, 'marked.csv')
+        bench.generate_file(still, rows=5, width=3)
+        bench.generate_file(marked, rows=5, width=3, seed=1)
+        open(marked + inbox.MARKER_SUFFIX, 'w').close()
+
+        self.assertEqual(self.watcher.scan(), [(self.inbox, marked)])
+        self.assertEqual(sorted(path for _, path in self.watcher.scan()), [marked, still])
+
+    def test_move_into_storage(self):
+        """
+        Ensure ingesting from an inbox moves the file rather than copying it.
+
+        :return: None
+        """
+        path = os.path.join(self.inbox, 'moved.csv')
+        bench.generate_file(path, rows=5, width=3)
+
+        result = self.ingester.ingest(path, move=True)
+
+        self.assertEqual(result.status, ingest.INGESTED)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(result.file.data.path))
+        self.assertTrue(result.file.data.name.startswith(os.path.join('uploads', 'inbox_feed')))
+
+
+class ResultCacheTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test the on disk cache of procedure results.
+    """
+    name = 'results'
+
+    def extra_settings(self):
+        """
+        :return: dict, settings to override for these tests.
+        """
+        return {'LIONEL_RESULT_CACHE_SIZE': 10 ** 6}
+
+    def setUp(self):
+        """
+        Need a procedure and a file to key results on.
+
+        :return: None
+        """
+        super(ResultCacheTestCase, self).setUp()
+
+        self.procedure = Procedure(language='Python', name='echo', comments='Echo.', user=self.user,
+                                   deterministic=True)
+        self.procedure.procedure.save('echo.py', ContentFile(b'print(1)\n'))
+
+        self.file = File(user=self.user, feed=self.feed)
+        self.file.data.save('data.csv', ContentFile(b'a,b\n1,2\n'))
+
+    def test_result_key(self):
+        """
+        Ensure the key changes with the input content and the arguments only.
+
+        :return: None
+        """
+        key = results.result_key(self.procedure, self.file, '{}', ())
+
+        self.assertEqual(key, results.result_key(self.procedure, self.file, '{}', ()))
+        self.assertNotEqual(key, results.result_key(self.procedure, self.file, '{}', ('--all',)))
+
+        self.file.checksum = 'other content'
+
+        self.assertNotEqual(key, results.result_key(self.procedure, self.file, '{}', ()))
+
+    def test_store_and_lookup(self):
+        """
+        Ensure a stored result comes back with its output files.
+
+        :return: None
+        """
+        self.assertIsNone(results.lookup('ab' * 32))
+
+        run_dir = results.new_run_dir()
+        with open(os.path.join(run_dir, 'out.csv'), 'w') as output_file:
+            output_file.write('x')
+
+        results.store('ab' * 32, [b'done\n'], 0, run_dir)
+        cached = results.lookup('ab' * 32)
+
+        self.assertTrue(cached.cached)
+        self.assertEqual((cached.output, cached.exit_code), ([b'done\n'], 0))
+        self.assertTrue(os.path.exists(os.path.join(cached.artifacts, 'out.csv')))
+
+    def test_evict(self):
+        """
+        Ensure the least recently used entries go first.
+
+        :return: None
+        """
+        for key, age in (('aa' * 32, 300), ('bb' * 32, 200), ('cc' * 32, 100)):
+            results.store(key, [b'x' * 1000], 0, results.new_run_dir())
+            stamp = time.time() - age
+            os.utime(results.entry_path(key), (stamp, stamp))
+
+        results.lookup('aa' * 32)  # Used again, so now the newest.
+
+        self.assertEqual(results.evict(limit=2500), 1)
+        self.assertIsNotNone(results.lookup('aa' * 32))
+        self.assertIsNone(results.lookup('bb' * 32))
+        self.assertIsNotNone(results.lookup('cc' * 32))
+
+    def test_evict_runs(self):
+        """
+        Ensure eviction leaves the directories of runs going alone, and removes those left by dead processes.
+
+        :return: None
+        """
+        going = results.new_run_dir()
+        left = results.new_run_dir()
+        results.discard_run_dir(left)
+        os.makedirs(left)
+
+        stamp = time.time() - results.STALE_RUN_SECONDS - 1
+
+        for path in (going, left):
+            os.utime(path, (stamp, stamp))
+
+        results.evict(limit=0)
+
+        self.assertTrue(os.path.isdir(going))
+        self.assertFalse(os.path.exists(left))
+
+        results.discard_run_dir(going)
+
+    def test_uncached_run_removed(self):
+        """
+        Ensure the output directory of a run which isn't cached is removed once it is done.
+
+        :return: None
+        """
+        self.procedure.deterministic = False
+        self.procedure.save()
+
+        result = self.procedure.run(self.file)
+
+        self.assertEqual((result.output, result.exit_code, result.artifacts), ([b'1\n'], 0, None))
+        self.assertEqual(os.listdir(os.path.join(results.cache_dir(), 'runs')), [])
+
+
+class ExportTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test streaming files and loaded tables back out.
+    """
+    name = 'export'
+
+    def setUp(self):
+        """
+        Need a loaded file and a logged in member of its feed.
+
+        :return: None
+        """
+        super(ExportTestCase, self).setUp()
+
+        self.file = File(user=self.user, feed=self.feed)
+        self.file.data.save('people.csv', ContentFile(b'name,age\nann,31\nbob,\ncat,4\n'))
+        self.file.load_table()
+        self.file.save()
+
+        self.client.login(username='export', password='password')
+
+    def tearDown(self):
+        """
+        Drop the table and remove the file.
+
+        :return: None
+        """
+        loading.drop_table(self.file.table)
+        super(ExportTestCase, self).tearDown()
+
+    def get(self, name, **params):
+        """
+        :return: bytes, the streamed body of an export.
+        """
+        response = self.client.get(reverse('loader:' + name, args=[self.file.pk]), params)
+
+        self.assertEqual(response.status_code, 200)
+
+        return b''.join(response.streaming_content)
+
+    def test_parse_filters(self):
+        """
+        Ensure filters must name real columns and operators.
+
+        :return: None
+        """
+        self.assertEqual(exports.parse_filters(['age:gt:30', 'age:null'], ['name', 'age']),
+                         [('age', 'gt', '30'), ('age', 'null', '')])
+
+        with self.assertRaises(exports.ExportError):
+            exports.parse_filters(['height:gt:1'], ['name', 'age'])
+
+        with self.assertRaises(exports.ExportError):
+            exports.parse_filters(['age:like:1'], ['name', 'age'])
+
+    def test_export_file(self):
+        """
+        Ensure files stream as they are, or projected, filtered and gzipped.
+
+        :return: None
+        """
+        self.assertEqual(self.get('export_file'), b'name,age\nann,31\nbob,\ncat,4\n')
+        self.assertEqual(self.get('export_file', columns='name', where='age:ge:5'), b'name\r\nann\r\n')
+        self.assertEqual(gzip.decompress(self.get('export_file', gzip='1')), b'name,age\nann,31\nbob,\ncat,4\n')
+
+    def test_export_table(self):
+        """
+        Ensure loaded tables stream with projections and filters.
+
+        :return: None
+        """
+        self.assertEqual(self.get('export_table', columns='name', where='age:null'), b'name\r\nbob\r\n')
+        self.assertEqual(self.get('export_table', columns='age,name', where='name:eq:cat'), b'age,name\r\n4,cat\r\n')
+
+    def test_contains_wildcards(self):
+        """
+        Ensure LIKE's wildcards and escape character in a contains filter only match themselves.
+
+        :return: None
+        """
+        self.assertEqual(exports.like_escape('5%_!\\'), '5!%!_!!\\')
+        self.assertEqual(self.get('export_table', columns='name', where='name:contains:n'), b'name\r\nann\r\n')
+        self.assertEqual(self.get('export_table', columns='name', where='name:contains:_'), b'name\r\n')
+        self.assertEqual(self.get('export_table', columns='name', where='name:contains:%'), b'name\r\n')
+
+    def test_bad_export(self):
+        """
+        Ensure unknown columns are rejected rather than reaching the SQL.
+
+        :return: None
+        """
+        response = self.client.get(reverse('loader:export_table', args=[self.file.pk]), {'columns': 'age;drop'})
+
+        self.assertEqual(response.status_code, 400)
+
+
+class KeyIndexTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test the cross file key lookup index.
+    """
+    name = 'keys'
+
+    def setUp(self):
+        """
+        Need two files with an account column and a member of their feed.
+
+        :return: None
+        """
+        super(KeyIndexTestCase, self).setUp()
+        self.account = Column.objects.create(name='Account', col_type='varchar2(10)')
+
+        self.files = []
+
+        for name, content in (('a.csv', b'account,amount\nA1,5\nA2,6\nA1,7\n'),
+                              ('b.csv', b'name,account\nann,B9\nbob,A2\n')):
+            file = File(user=self.user, feed=self.feed)
+            file.data.save(name, ContentFile(content))
+            file.build_key_indexes()
+            self.files.append(file)
+
+    def test_bloom_filter(self):
+        """
+        Ensure added keys are always found and most others are not.
+
+        :return: None
+        """
+        bloom = keyindex.BloomFilter.for_capacity(1000)
+
+        for idx in range(1000):
+            bloom.add(str(idx))
+
+        self.assertTrue(all(bloom.might_contain(bloom.digest(str(idx))) for idx in range(1000)))
+        self.assertLess(sum(bloom.might_contain(bloom.digest('x{}'.format(idx))) for idx in range(1000)), 50)
+
+    def test_sorted_keys(self):
+        """
+        Ensure every row holding a key is found.
+
+        :return: None
+        """
+        path = os.path.join(self.media, 'test.idx')
+        keyindex.write_keys(path, [('a', 3, 30), ('b', 0, 0), ('b', 5, 50), ('c', 1, 10)])
+        keys = keyindex.SortedKeys(path)
+
+        self.assertEqual(keys.find('b'), [(0, 0), (5, 50)])
+        self.assertEqual(keys.find('c'), [(1, 10)])
+        self.assertEqual(keys.find('bb'), [])
+
+        keys.close()
+
+    def test_build_in_runs(self):
+        """
+        Ensure keys sorted in runs on disk and merged index the same as keys sorted at once.
+
+        :return: None
+        """
+        bloom, path, count = keyindex.build(self.files[0].reader(), [0], run_keys=1)[0]
+        keys = keyindex.SortedKeys(path)
+
+        try:
+            self.assertEqual(count, 3)
+            self.assertEqual([keys.entry(idx)[:2] for idx in range(keys.count)], [('A1', 0), ('A1', 2), ('A2', 1)])
+            self.assertEqual([row for row, _ in keys.find('A1')], [0, 2])
+            self.assertTrue(bloom.might_contain(bloom.digest('A2')))
+        finally:
+            keys.close()
+            os.remove(path)
+
+        at_once, path, _ = keyindex.build(self.files[0].reader(), [0])[0]
+        os.remove(path)
+
+        self.assertEqual(bloom.data, at_once.data)
+
+    def test_build_and_search(self):
+        """
+        Ensure special columns are indexed wherever they sit and lookups find every row.
+
+        :return: None
+        """
+        self.assertEqual([index.position for index in KeyIndex.objects.order_by('file')], [0, 1])
+
+        matches = [(index.file, row) for index, row, _ in keyindex.search('A2', [self.feed.pk])]
+
+        self.assertCountEqual(matches, [(self.files[0], 1), (self.files[1], 1)])
+        self.assertEqual(len(keyindex.search('A1', [self.feed.pk])), 2)
+        self.assertEqual(keyindex.search('A2', []), [])
+        self.assertEqual(keyindex.search('Z0', [self.feed.pk]), [])
+
+    def test_lookup_view(self):
+        """
+        Ensure the lookup page links matches to their page of the preview.
+
+        :return: None
+        """
+        self.client.login(username='keys', password='password')
+        response = self.client.get(reverse('loader:key_lookup'), {'value': 'B9'})
+
+        self.assertContains(response, reverse('loader:view_file', args=[self.files[1].pk]) + '?page=0')
+
+
+class AdmissionTestCase(TestCase):
+    """
+    Test memory admission control.
+    """
+    def setUp(self):
+        """
+        Need a private ledger, a small budget and a file to profile.
+
+        :return: None
+        """
+        self.media = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media, LIONEL_METRICS=False, LIONEL_MEMORY_BUDGET=1000,
+                                          LIONEL_ADMISSION_LEDGER=os.path.join(self.media, 'ledger.json'))
+        self.settings.enable()
+
+        self.user = User.objects.create_user('admission', 'admission@example.com', 'password')
+        self.feed = Feed.objects.create(name='admission_feed')
+
+        self.file = File(user=self.user, feed=self.feed)
+        self.file.data.save('data.csv', ContentFile(b'id,name,score\n1,ann,5\n2,bob,\n3,ann,7\n4,cat,8\n'))
+
+    def tearDown(self):
+        """
+        Remove the file and ledger.
+
+        :return: None
+        """
+        self.settings.disable()
+        shutil.rmtree(self.media)
+
+    def test_reserve(self):
+        """
+        Ensure reservations are refused once the budget is used, but a lone job always runs.
+
+        :return: None
+        """
+        big = admission.try_reserve('load', 5000)
+        self.assertIsNotNone(big)
+        self.assertIsNone(admission.try_reserve('load', 1))
+
+        admission.release(big)
+        first = admission.try_reserve('load', 600)
+
+        self.assertIsNone(admission.try_reserve('load', 600))
+        self.assertIsNotNone(admission.try_reserve('load', 400))
+        self.assertEqual(admission.in_use(), 1000)
+
+        admission.release(first)
+        self.assertEqual(admission.in_use(), 400)
+
+    def test_dead_processes_pruned(self):
+        """
+        Ensure reservations of processes that have gone are dropped.
+
+        :return: None
+        """
+        child = subprocess.Popen(['true'])
+        child.wait()
+
+        with open(admission.ledger_path(), 'w') as ledger_file:
+            json.dump({'gone': {'pid': child.pid, 'bytes': 900, 'operation': 'load', 'since': 0}}, ledger_file)
+
+        self.assertEqual(admission.in_use(), 0)
+
+    def test_admit(self):
+        """
+        Ensure work with a lighter way is downgraded and other work gives up after its timeout.
+
+        :return: None
+        """
+        held = admission.try_reserve('load', 800)
+
+        with admission.admit('profile', 500, fallback=100, timeout=0) as ticket:
+            self.assertTrue(ticket.downgraded)
+            self.assertEqual(admission.in_use(), 900)
+
+        self.assertEqual(admission.in_use(), 800)
+
+        with self.assertRaises(admission.AdmissionError):
+            with admission.admit('procedure', 500, timeout=0):
+                pass
+
+        admission.release(held)
+
+        with admission.admit('profile', 500, fallback=100, timeout=0) as ticket:
+            self.assertFalse(ticket.downgraded)
+
+        with admission.admit('profile', 5000, fallback=100, timeout=0) as ticket:
+            self.assertTrue(ticket.downgraded)
+
+    def test_chunked_profile(self):
+        """
+        Ensure profiling in chunks agrees with profiling the whole DataFrame.
+
+        :return: None
+        """
+        self.file.get_dataframe()
+        self.file.get_column_info()
+        self.file.get_table_size()
+        full = self.file.column_info, tuple(self.file.table_size)
+
+        self.file.column_types = None
+
+        self.file.get_column_info_chunked(size=2)
+
+        self.assertEqual(tuple(self.file.table_size), full[1])
+        self.assertEqual([(name, col_type, nulls) for name, col_type, _, nulls in self.file.column_info],
+                         [(name, col_type, nulls) for name, col_type, _, nulls in full[0]])
+        self.assertEqual([uniques for _, _, uniques, _ in self.file.column_info], [4, None, 3])
+
+        self.file.get_column_info_chunked(size=2, unique_limit=9)
+
+        self.assertEqual([uniques for _, _, uniques, _ in self.file.column_info], [None, None, 3])
+
+    def test_profile_columns_downgrades(self):
+        """
+        Ensure a file too big for the budget is still profiled.
+
+        :return: None
+        """
+        with override_settings(LIONEL_MEMORY_BUDGET=1):
+            self.file.profile_columns()
+
+        self.assertEqual(tuple(self.file.table_size), (4, 3))
+        self.assertFalse(hasattr(self.file, 'df'))
+
+
+class PluginTestCase(TestCase):
+    """
+    Test lazy interpreter discovery and deferred imports.
+    """
+    def test_manifest(self):
+        """
+        Ensure the shipped languages are known and their interpreters load on demand.
+
+        :return: None
+        """
+        self.assertEqual(plugins.languages(), ['Bash', 'Python'])
+        self.assertEqual(plugins.extension('Python'), '.py')
+        self.assertEqual(list(Procedure._meta.get_field('language').choices), [('Bash', 'Bash'), ('Python', 'Python')])
+        self.assertIs(plugins.get('Python'), plugins.get('Python'))
+        self.assertEqual(plugins.get('Python').__name__, 'PythonInterpreter')
+
+    def test_bad_plugin(self):
+        """
+        Ensure an entry point that isn't an Interpreter is refused.
+
+        :return: None
+        """
+        plugins.manifest()['Bad'] = (None, 'loader.bench:generate_file')
+
+        try:
+            with self.assertRaises(TypeError):
+                plugins.get('Bad')
+        finally:
+            del plugins.manifest()['Bad']
+
+    def test_worker_startup_is_light(self):
+        """
+        Ensure starting a worker imports neither pandas nor any interpreter.
+
+        :return: None
+        """
+        check = (bench.WORKER_STARTUP + '; import sys; '
+                 'print(sorted(m for m in sys.modules if m == "pandas" or m.startswith("loader.plugins.")))')
+        output = subprocess.check_output([sys.executable, '-c', check], universal_newlines=True)
+
+        self.assertEqual(output.strip(), "['loader.plugins._interpreter']")
+
+    def test_parse_importtime(self):
+        """
+        Ensure import reports are parsed with their nesting.
+
+        :return: None
+        """
+        report = ('import time: self [us] | cumulative | imported package\n'
+                  'import time:       120 |        120 |   _io\n'
+                  'import time:      1000 |       1500 | loader.models\n')
+
+        self.assertEqual(bench.parse_importtime(report), [('_io', 0.00012, 0.00012, 1),
+                                                          ('loader.models', 0.001, 0.0015, 0)])
+
+
+class ValidationTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test column validation and the reject file.
+    """
+    name = 'validation'
+
+    def setUp(self):
+        """
+        Need validation rules and a file with some bad rows.
+
+        :return: None
+        """
+        super(ValidationTestCase, self).setUp()
+
+        Column.objects.create(name='amount', col_type='number', required=True, min_value=0, max_value=100)
+        Column.objects.create(name='code', col_type='varchar2(2)', pattern='[A-Z]+', allowed='AB\nCD')
+
+        self.file = File(user=self.user, feed=self.feed)
+        self.file.data.save('data.csv', ContentFile(b'amount,code,note\n'
+                                                    b'5,AB,fine\n'
+                                                    b'x,AB,not a number\n'
+                                                    b',CD,missing\n'
+                                                    b'500,ZZZ,everything\n'
+                                                    b'7,CD,too,wide\n'
+                                                    b'9,,short\n'))
+
+    def test_checks(self):
+        """
+        Ensure every rule a row breaks is reported.
+
+        :return: None
+        """
+        validator = validation.Validator.for_file(self.file)
+        failed, reasons = validator.check(list(self.file.reader().rows()))
+
+        self.assertEqual(list(failed), [False, True, True, True, True, False])
+        self.assertEqual(reasons[1], ['amount is not a number'])
+        self.assertEqual(reasons[2], ['amount is missing'])
+        self.assertEqual(reasons[3], ['amount is above 100.0', 'code is longer than 2', 'code is not an allowed value'])
+        self.assertEqual(reasons[4], ['has 4 fields, expected 3'])
+
+    def test_load_quarantines_rejects(self):
+        """
+        Ensure good rows are loaded and bad ones end up in the reject file.
+
+        :return: None
+        """
+        self.assertEqual(self.file.load_table(), 2)
+        self.assertEqual(self.file.rejected, 4)
+
+        with open(self.file.rejects.path, newline='') as reject_file:
+            rejects = list(csv.reader(reject_file))
+
+        self.assertEqual(rejects[0], ['row', 'reasons', 'amount', 'code', 'note'])
+        self.assertEqual([row[0] for row in rejects[1:]], ['1', '2', '3', '4'])
+        self.assertEqual(rejects[1][2:], ['x', 'AB', 'not a number'])
+
+        self.file.save()
+        self.client.login(username='validation', password='password')
+        response = self.client.get(reverse('loader:export_rejects', args=[self.file.pk]))
+
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+
+        self.assertEqual(lines[2], '2,amount is missing,,CD,missing')
+
+    def test_bad_pattern(self):
+        """
+        Ensure a pattern that doesn't compile is refused.
+
+        :return: None
+        """
+        with self.assertRaises(ValidationError):
+            Column(name='bad', col_type='number', pattern='(').clean()
+
+
+class DedupTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test dropping duplicate rows on load.
+    """
+    name = 'dedup'
+
+    def feed_fields(self):
+        """
+        :return: dict, fields of the feed besides its name.
+        """
+        return {'dedup': 'key'}
+
+    def setUp(self):
+        """
+        Need a deduplicating feed and a file with repeated keys and rows.
+
+        :return: None
+        """
+        super(DedupTestCase, self).setUp()
+        Column.objects.create(name='account', col_type='varchar2(2)')
+
+        self.file = File(user=self.user, feed=self.feed)
+        self.file.data.save('data.csv', ContentFile(b'account,amount\nA1,1\nA2,2\nA1,3\nA3,4\nA2,2\nA1,5\n'))
+
+    def loaded(self):
+        """
+        :return: lst[tuple], the rows in the file's table.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT account, amount FROM {}'.format(self.file.table))
+            return sorted((account, int(amount)) for account, amount in cursor.fetchall())
+
+    def report(self):
+        """
+        :return: lst[lst[str]], the duplicate report without its header.
+        """
+        with open(self.file.duplicates.path, newline='') as report_file:
+            return list(csv.reader(report_file))[1:]
+
+    def test_spilling_set(self):
+        """
+        Ensure hashes are found whether they are held in memory or spilled to disk.
+
+        :return: None
+        """
+        directory = tempfile.mkdtemp(dir=self.media)
+        seen = dedup.SpillingSet(3, directory)
+        hashes = [dedup.row_hash([str(idx)]) for idx in range(10)]
+
+        self.assertEqual([seen.add(raw, idx) for idx, raw in enumerate(hashes)], [None] * 10)
+        self.assertEqual(len(seen.runs), 3)
+        self.assertEqual([seen.add(raw, 99) for raw in hashes], list(range(10)))
+
+        seen.close()
+
+    def test_keep_first(self):
+        """
+        Ensure the first row of each key is loaded and the rest reported.
+
+        :return: None
+        """
+        self.assertEqual(self.file.load_table(), 3)
+        self.assertEqual(self.loaded(), [('A1', 1), ('A2', 2), ('A3', 4)])
+        self.assertEqual(self.file.duplicated, 3)
+        self.assertEqual(self.report(), [['2', '0', 'A1', '3'], ['4', '1', 'A2', '2'], ['5', '0', 'A1', '5']])
+
+    def test_keep_last(self):
+        """
+        Ensure the last row of each key is loaded, with a spilling set.
+
+        :return: None
+        """
+        self.feed.dedup_keep = 'last'
+        self.feed.save()
+
+        with override_settings(LIONEL_DEDUP_MEMORY=dedup.ENTRY_BYTES * 2):
+            self.assertEqual(self.file.load_table(), 3)
+
+        self.assertEqual(self.loaded(), [('A1', 5), ('A2', 2), ('A3', 4)])
+        self.assertEqual(self.report(), [['0', '5', 'A1', '1'], ['1', '4', 'A2', '2'], ['2', '5', 'A1', '3']])
+
+    def test_whole_rows(self):
+        """
+        Ensure only exact repeats are dropped when comparing whole rows.
+
+        :return: None
+        """
+        self.feed.dedup = 'row'
+        self.feed.save()
+
+        self.assertEqual(self.file.load_table(), 5)
+        self.assertEqual(self.report(), [['4', '1', 'A2', '2']])
+
+        self.feed.dedup = ''
+        self.feed.save()
+
+        self.assertEqual(self.file.load_table(), 6)
+        self.assertFalse(self.file.duplicates)
+
+
+class CompactionTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test recompressing and pruning old uploads.
+    """
+    name = 'compaction'
+
+    def feed_fields(self):
+        """
+        :return: dict, fields of the feed besides its name.
+        """
+        return {'compress_after': 30, 'prune_after': 365}
+
+    def setUp(self):
+        """
+        Need a feed with a retention policy and uploads of different ages.
+
+        :return: None
+        """
+        super(CompactionTestCase, self).setUp()
+        self.files = {}
+
+        for name, age in (('new', 1), ('old', 60), ('ancient', 400)):
+            file = File(user=self.user, feed=self.feed)
+            file.data.save(name + '.csv', ContentFile(b'id,name\n' + b'1,ann\n' * 100))
+            file.set_checksum()
+            file.save()
+            File.objects.filter(pk=file.pk).update(upload_date=timezone.now() - datetime.timedelta(days=age))
+            self.files[name] = File.objects.get(pk=file.pk)
+
+    def test_apply(self):
+        """
+        Ensure old files are compressed but read the same, and ancient ones are removed.
+
+        :return: None
+        """
+        old_rows = list(self.files['old'].reader().rows())
+        old_path = self.files['old'].data.path
+        ancient_path = self.files['ancient'].data.path
+        self.files['ancient'].load_table()
+        self.files['ancient'].save()
+
+        summary = compaction.summarise(compaction.apply(self.feed))
+
+        self.assertEqual((summary['compacted'], summary['pruned']), (1, 1))
+        self.assertEqual(summary['pruned_bytes'], 608)
+        self.assertLess(summary['compacted_after'], summary['compacted_before'])
+
+        old = File.objects.get(pk=self.files['old'].pk)
+
+        self.assertTrue(old.data.name.endswith('.csv.xz'))
+        self.assertTrue(readers.is_compressed(old.data.path))
+        self.assertEqual(list(old.reader().rows()), old_rows)
+        self.assertEqual(old.checksum, self.files['old'].checksum)
+        self.assertFalse(os.path.exists(old_path))
+
+        self.assertFalse(File.objects.filter(pk=self.files['ancient'].pk).exists())
+        self.assertFalse(os.path.exists(ancient_path))
+        self.assertNotIn(self.files['ancient'].table, connection.introspection.table_names())
+
+        self.assertEqual(File.objects.get(pk=self.files['new'].pk).data.name, self.files['new'].data.name)
+        self.assertEqual(compaction.summarise(compaction.apply(self.feed))['compacted'], 0)
+
+    def test_codecs(self):
+        """
+        Ensure every codec available here reads back transparently.
+
+        :return: None
+        """
+        for codec in ('xz', 'gzip'):
+            path = os.path.join(self.media, 'codec_{}.csv'.format(codec))
+
+            with open(path, 'wb') as data:
+                data.write(b'a,b\n1,2\n')
+
+            compressed = compaction.compress(path, codec)
+
+            with readers.open_binary(compressed) as data:
+                self.assertEqual(data.read(), b'a,b\n1,2\n')
+
+    def test_dry_run(self):
+        """
+        Ensure a dry run reports what it would do and changes nothing.
+
+        :return: None
+        """
+        out = StringIO()
+        call_command('compact_uploads', '--dry-run', stdout=out, stderr=StringIO())
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['total']['compacted'], 1)
+        self.assertEqual(report['total']['pruned'], 1)
+        self.assertEqual(File.objects.filter(feed=self.feed).count(), 3)
+        self.assertTrue(File.objects.get(pk=self.files['old'].pk).data.name.endswith('.csv'))
+
+    def test_name_taken(self):
+        """
+        Ensure compacting never overwrites an upload already called what the compressed copy would be.
+
+        :return: None
+        """
+        old = self.files['old']
+        rows = list(old.reader().rows())
+        taken = old.data.storage.path(old.data.name + '.xz')
+
+        with open(taken, 'wb') as other:
+            other.write(b'someone else')
+
+        compaction.compact(old, 'xz')
+
+        self.assertNotEqual(old.data.path, taken)
+        self.assertTrue(old.data.name.endswith('.xz'))
+        self.assertEqual(list(old.reader().rows()), rows)
+
+        with open(taken, 'rb') as other:
+            self.assertEqual(other.read(), b'someone else')
+
+
+class ParallelLoadTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test splitting files into ranges and loading them over several connections.
+    """
+    name = 'parallel'
+
+    def setUp(self):
+        """
+        Need a file with quoted newlines in it.
+
+        :return: None
+        """
+        super(ParallelLoadTestCase, self).setUp()
+
+        lines = ['id,note'] + ['{},"line {}\nof ""note"""'.format(idx, idx) for idx in range(200)]
+        self.file = File(user=self.user, feed=self.feed)
+        self.file.data.save('data.csv', ContentFile('\n'.join(lines).encode('utf-8') + b'\n'))
+
+    def test_split(self):
+        """
+        Ensure the ranges fall on row boundaries and between them hold every row once.
+
+        :return: None
+        """
+        reader = self.file.reader()
+        rows = list(reader.rows())
+
+        for parts in (1, 2, 7, 500):
+            ranges = reader.split(parts)
+
+            self.assertLessEqual(len(ranges), parts)
+            self.assertEqual([row for start, end in ranges for row in reader.range_rows(start, end)], rows)
+
+    def test_parallelism(self):
+        """
+        Ensure SQLite always loads over one connection.
+
+        :return: None
+        """
+        with override_settings(LIONEL_LOAD_PARALLELISM=8):
+            self.assertEqual(loading.parallelism(), 1)
+
+    def test_load_parallel_falls_back(self):
+        """
+        Ensure a file loaded over one connection loads every row.
+
+        :return: None
+        """
+        self.assertEqual(loading.load_parallel(self.file, workers=1), 200)
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM {}'.format(self.file.table))
+            self.assertEqual(cursor.fetchone()[0], 200)
+
+    def test_load_past_sample(self):
+        """
+        Ensure a value past the sample that doesn't fit its column's sampled type still loads.
+
+        :return: None
+        """
+        lines = ['id,note'] + ['{},ab'.format(idx) for idx in range(1500)] + ['n/a,{}'.format('x' * 50)]
+        self.file.data.save('past.csv', ContentFile('\n'.join(lines).encode('utf-8') + b'\n'))
+        self.file.set_column_types(['number', 'varchar2(2)'])
+
+        self.assertEqual(loading.load_file(self.file), 1501)
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, note FROM {} WHERE id = %s'.format(self.file.table), ['n/a'])
+            self.assertEqual(cursor.fetchall(), [('n/a', 'x' * 50)])
+
+            description = connection.introspection.get_table_description(cursor, self.file.table)
+
+        self.assertEqual([column[1].upper() for column in description], ['TEXT', 'VARCHAR(50)'])
+
+    def loaded(self, table):
+        """
+        :return: lst[tuple], the rows of a table in the order they were inserted.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT id, note FROM {} ORDER BY rowid'.format(table))
+            return cursor.fetchall()
+
+    def staging(self):
+        """
+        :return: lst[str], staging tables left in the database.
+        """
+        return [name for name in connection.introspection.table_names() if name.startswith('lnl_file_') and
+                '_p' in name]
+
+    def test_sqlite_one_writer(self):
+        """
+        Ensure SQLite is loaded by one writer however many workers are asked for.
+
+        :return: None
+        """
+        min_range_bytes, loading.MIN_RANGE_BYTES = loading.MIN_RANGE_BYTES, 1
+
+        try:
+            self.assertEqual(loading.load_parallel(self.file, workers=3), 200)
+        finally:
+            loading.MIN_RANGE_BYTES = min_range_bytes
+
+        self.assertEqual(self.staging(), [])
+        self.assertEqual(len(self.loaded(self.file.table)), 200)
+
+    def test_load_range(self):
+        """
+        Ensure a range is loaded into its staging table in order.
+
+        :return: None
+        """
+        reader = self.file.reader()
+        start, end = reader.split(3)[1]
+        rows = [tuple(row) for row in reader.range_rows(start, end)]
+
+        self.assertEqual(loading.load_range(reader, 'lnl_range', ['id', 'note'], [None, None], start, end,
+                                            batch_size=7), len(rows))
+        self.assertEqual(self.loaded('lnl_range'), rows)
+
+    def test_load_ranges(self):
+        """
+        Ensure the staging tables are merged into the file's table in order, then dropped.
+
+        :return: None
+        """
+        self.assertEqual(loading.load_ranges(self.file, self.file.reader().split(3), batch_size=7), 200)
+        self.assertEqual(self.loaded(self.file.table),
+                         [(str(idx), 'line {}\nof "note"'.format(idx)) for idx in range(200)])
+        self.assertEqual(self.staging(), [])
+
+    def test_staging_dropped_on_failure(self):
+        """
+        Ensure the staging tables are dropped when a range fails to load.
+
+        :return: None
+        """
+        load_range = loading.load_range
+
+        def failing(reader, table, *args):
+            loaded = load_range(reader, table, *args)
+
+            if table.endswith('_p1'):
+                raise IOError('range failed')
+
+            return loaded
+
+        loading.load_range = failing
+
+        try:
+            with self.assertRaises(IOError):
+                loading.load_ranges(self.file, self.file.reader().split(3))
+        finally:
+            loading.load_range = load_range
+
+        self.assertEqual(self.staging(), [])
+        self.assertNotIn(loading.table_name(self.file), connection.introspection.table_names())
+
+class ApiTestCase(FeedFixtureMixin, TestCase):
+    """
+    Test the token authenticated JSON API.
+    """
+    name = 'api'
+
+    def extra_settings(self):
+        """
+        :return: dict, settings to override for these tests.
+        """
+        return {'LIONEL_RUN_WORKERS': 0, 'LIONEL_API_PATHS': [os.path.join(self.media, 'drop')]}
+
+    def setUp(self):
+        """
+        Need a user with a token on a feed, and a procedure.
+
+        :return: None
+        """
+        super(ApiTestCase, self).setUp()
+
+        _, key = ApiToken.issue(self.user, 'tests')
+        self.auth = {'HTTP_AUTHORIZATION': 'Bearer {}'.format(key)}
+
+        self.procedure = Procedure(language='Python', name='echo', comments='Echo.', user=self.user)
+        self.procedure.procedure.save('echo.py', ContentFile(b'print(1)\n'))
+
+    def upload(self, *contents):
+        """
+        :param contents: bytes, the content of each file to upload.
+        :return: dict, the API's answer.
+        """
+        uploads = [SimpleUploadedFile('data_{}.csv'.format(idx), content) for idx, content in enumerate(contents)]
+        response = self.client.post(reverse('loader:api_files'), {'feed': self.feed.pk, 'data': uploads}, **self.auth)
+
+        self.assertEqual(response.status_code, 200)
+
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_token_required(self):
+        """
+        Ensure requests without a valid, active token are turned away.
+
+        :return: None
+        """
+        self.assertEqual(self.client.get(reverse('loader:api_status')).status_code, 401)
+        self.assertEqual(self.client.get(reverse('loader:api_status'),
+                                         HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+        self.assertEqual(self.client.get(reverse('loader:api_status'), **self.auth).status_code, 200)
+
+        ApiToken.objects.update(active=False)
+
+        self.assertEqual(self.client.get(reverse('loader:api_status'), **self.auth).status_code, 401)
+
+    def test_upload_batch(self):
+        """
+        Ensure a batch of uploads is stored, repeated content skipped.
+
+        :return: None
+        """
+        answer = self.upload(b'a,b\n1,2\n', b'a,b\n3,4\n', b'a,b\n1,2\n')
+
+        self.assertEqual([item['status'] for item in answer['files']],
+                         [ingest.INGESTED, ingest.INGESTED, ingest.SKIPPED])
+        self.assertEqual(File.objects.filter(feed=self.feed).count(), 2)
+
+    def test_upload_paths(self):
+        """
+        Ensure files on disk are only read from the allowed directories.
+
+        :return: None
+        """
+        os.makedirs(os.path.join(self.media, 'drop'))
+
+        for name in ('drop/in.csv', 'out.csv'):
+            with open(os.path.join(self.media, name), 'w') as data_file:
+                data_file.write('a,b\n1,2\n')
+
+        body = {'feed': self.feed.pk, 'paths': [os.path.join(self.media, 'out.csv')]}
+        response = self.client.post(reverse('loader:api_files'), json.dumps(body), content_type='application/json',
+                                    **self.auth)
+
+        self.assertEqual(response.status_code, 400)
+
+        body['paths'] = [os.path.join(self.media, 'drop', 'in.csv')]
+        response = self.client.post(reverse('loader:api_files'), json.dumps(body), content_type='application/json',
+                                    **self.auth)
+
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['files'][0]['status'], ingest.INGESTED)
+
+    def test_runs_and_status(self):
+        """
+        Ensure a batch of runs is queued, carried out and reported on, files outside the user's feeds refused.
+
+        :return: None
+        """
+        file_id = self.upload(b'a,b\n1,2\n')['files'][0]['id']
+
+        other = File(user=self.user, feed=Feed.objects.create(name='other_feed'))
+        other.data.save('other.csv', ContentFile(b'a,b\n1,2\n'))
+
+        body = {'runs': [{'file': file_id, 'procedure': self.procedure.pk},
+                         {'file': other.pk, 'procedure': self.procedure.pk}]}
+        response = self.client.post(reverse('loader:api_runs'), json.dumps(body), content_type='application/json',
+                                    **self.auth)
+        queued = json.loads(response.content.decode('utf-8'))['runs']
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(queued[1], {'error': 'Unknown file.'})
+        self.assertEqual(ProcedureRun.objects.count(), 1)
+
+        response = self.client.get(reverse('loader:api_status'),
+                                   {'files': '{},{}'.format(file_id, other.pk), 'runs': str(queued[0]['id'])},
+                                   **self.auth)
+        answer = json.loads(response.content.decode('utf-8'))
+
+        self.assertEqual(list(answer['files']), [str(file_id)])
+        self.assertEqual(answer['runs'][str(queued[0]['id'])]['status'], ProcedureRun.DONE)
+        self.assertIsNotNone(answer['runs'][str(queued[0]['id'])]['finished'])
+
+    def test_recover(self):
+        """
+        Ensure runs left queued are carried out and runs left going past their limit are failed after a restart.
+
+        :return: None
+        """
+        self.feed.wall_limit = 10
+        self.feed.save()
+
+        file = File.objects.get(pk=self.upload(b'a,b\n1,2\n')['files'][0]['id'])
+        left = {name: ProcedureRun.objects.create(procedure=self.procedure, file=file, user=self.user)
+                for name in ('queued', 'lost', 'going')}
+        now = timezone.now()
+
+        ProcedureRun.objects.filter(pk=left['lost'].pk).update(status=ProcedureRun.RUNNING,
+                                                              started=now - datetime.timedelta(minutes=2))
+        ProcedureRun.objects.filter(pk=left['going'].pk).update(status=ProcedureRun.RUNNING, started=now)
+
+        self.assertEqual(runs.recover(ProcedureRun, now=now), (1, 1))
+
+        status = {name: ProcedureRun.objects.get(pk=run.pk) for name, run in left.items()}
+
+        self.assertEqual(status['queued'].status, ProcedureRun.DONE)
+        self.assertEqual((status['lost'].status, status['lost'].error), (ProcedureRun.FAILED, runs.LOST))
+        self.assertEqual(status['going'].status, ProcedureRun.RUNNING)
+
+
+class SchedulerTestCase(TestCase):
+    """
+    Test fair scheduling of procedure runs and their resource limits.
+    """
+    def start_next(self, queue):
+        """
+        :param queue: Scheduler, the scheduler.
+        :return: Ticket or None, the run started, None if none could start.
+        """
+        with queue.condition:
+            ticket = queue.next_ticket()
+
+            if ticket is not None:
+                queue.start(ticket)
+
+        return ticket
+
+    def test_weighted_fair_order(self):
+        """
+        Ensure a feed with twice the weight gets twice the turns, whoever queued first.
+
+        :return: None
+        """
+        light = Feed.objects.create(name='light_feed')
+        heavy = Feed.objects.create(name='heavy_feed', weight=2)
+        queue = scheduler.Scheduler(1)
+
+        for feed in (light, heavy):
+            for _ in range(4):
+                queue.enqueue(feed, job=lambda: None)
+
+        order = []
+
+        while queue.waiting:
+            ticket = self.start_next(queue)
+            order.append(ticket.feed_id)
+            queue.finish(ticket)
+
+        self.assertEqual(order[:6].count(heavy.pk), 4)
+        self.assertEqual(order[:3], [heavy.pk, light.pk, heavy.pk])
+
+    def test_priority_and_quota(self):
+        """
+        Ensure higher priority feeds go first, but no further than their quota.
+
+        :return: None
+        """
+        urgent = Feed.objects.create(name='urgent_feed', priority=5, max_runs=1)
+        batch = Feed.objects.create(name='batch_feed')
+        queue = scheduler.Scheduler(3)
+
+        queue.enqueue(batch, job=lambda: None)
+        queue.enqueue(urgent, job=lambda: None)
+        queue.enqueue(urgent, job=lambda: None)
+
+        self.assertEqual(self.start_next(queue).feed_id, urgent.pk)
+        self.assertEqual(self.start_next(queue).feed_id, batch.pk)
+        self.assertIsNone(self.start_next(queue))
+
+    def test_slot(self):
+        """
+        Ensure a slot is held while a run goes and a run within it doesn't take another.
+
+        :return: None
+        """
+        feed = Feed.objects.create(name='slot_feed')
+        queue = scheduler.Scheduler(1)
+
+        with queue.slot(feed):
+            with queue.slot(feed):
+                self.assertEqual(queue.total, 1)
+
+        self.assertEqual(queue.total, 0)
+
+    def test_slot_timeout(self):
+        """
+        Ensure a run which can't get its turn in time fails and leaves the queue.
+
+        :return: None
+        """
+        busy = Feed.objects.create(name='busy_feed')
+        feed = Feed.objects.create(name='waiting_feed')
+        queue = scheduler.Scheduler(1)
+
+        queue.enqueue(busy, job=lambda: None)
+        self.start_next(queue)
+
+        with self.assertRaises(scheduler.SchedulerError):
+            with queue.slot(feed, timeout=0.1):
+                pass
+
+        self.assertEqual(queue.waiting, [])
+
+    def test_no_runs(self):
+        """
+        Ensure a feed capped at no runs is refused, and its runs fail rather than wait forever.
+
+        :return: None
+        """
+        feed = Feed.objects.create(name='stopped_feed', max_runs=0)
+
+        with self.assertRaises(ValidationError):
+            feed.full_clean()
+
+        with self.assertRaises(scheduler.SchedulerError):
+            scheduler.Scheduler(1).enqueue(feed, job=lambda: None)
+
+    def test_limits(self):
+        """
+        Ensure a feed's limits win over the settings.
+
+        :return: None
+        """
+        feed = Feed.objects.create(name='limited_feed', cpu_limit=5, memory_limit=100)
+
+        with override_settings(LIONEL_RUN_CPU_SECONDS=60, LIONEL_RUN_MEMORY=None, LIONEL_RUN_WALL_SECONDS=10):
+            self.assertEqual(scheduler.limits(feed), scheduler.Limits(5, 100 * 1024 ** 2, 10))
+
+    def test_run_process_limits(self):
+        """
+        Ensure processes are stopped at their wall clock, CPU and memory limits.
+
+        :return: None
+        """
+        started = time.time()
+        output, exit_code = run_process([sys.executable, '-c', 'import time; print(1, flush=True); time.sleep(30)'],
+                                        limits=scheduler.Limits(None, None, 0.5))
+
+        self.assertEqual(output, [b'1\n'])
+        self.assertLess(exit_code, 0)
+        self.assertLess(time.time() - started, 10)
+
+        _, exit_code = run_process([sys.executable, '-c', 'while True: pass'], limits=scheduler.Limits(1, None, 30))
+
+        self.assertLess(exit_code, 0)
+
+        output, exit_code = run_process([sys.executable, '-c', 'print(len(bytearray(1024 ** 3)))'],
+                                        limits=scheduler.Limits(None, 300 * 1024 ** 2, 30))
+
+        self.assertEqual((output, exit_code), ([], 1))
@@ -1,6 +1,6 @@
 from django.conf.urls import url
 
-from loader import views
+from loader import api, views
 
 urlpatterns = [
     url(r'^login/$', views.login_to_app, name='login'),
@@ -18,4 +18,14 @@ urlpatterns = [
     url(r'^procedures/create/$', views.ProcedureCreate.as_view(), name='create_proc'),
     url(r'^files/(?P<pk>[0-9]+)/$', views.FileView.as_view(), name='view_file'),
     url(r'^new_file/$', views.LoadFileView.as_view(), name='load_file'),
+    url(r'^files/(?P<pk>[0-9]+)/export/$', views.export_file, name='export_file'),
+    url(r'^files/(?P<pk>[0-9]+)/table/export/$', views.export_table, name='export_table'),
+    url(r'^files/(?P<pk>[0-9]+)/rejects/$', views.export_rejects, name='export_rejects'),
+    url(r'^files/(?P<pk>[0-9]+)/duplicates/$', views.export_duplicates, name='export_duplicates'),
+    url(r'^lookup/$', views.key_lookup, name='key_lookup'),
+    url(r'^metrics/$', views.metrics_endpoint, name='metrics'),
+    url(r'^profiles/(?P<pk>[0-9]+)/stats/$', views.download_profile, name='download_profile'),
+    url(r'^api/files/$', api.upload_files, name='api_files'),
+    url(r'^api/runs/$', api.queue_runs, name='api_runs'),
+    url(r'^api/status/$', api.status, name='api_status'),
 ]
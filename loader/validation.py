@@ -0,0 +1,179 @@
+"""
+Check a File's rows against the validation rules of its special columns.
+
+Each Column can declare a type, a range, a pattern, whether a value is required and a set of allowed values. The rules
+of every file column named after a Column are compiled once into checks that run over a whole batch of rows at a time
+with pandas, so the cost per row is a few vectorised operations rather than Python code. Rows that fail are written to a
+reject file with their row number and every reason they failed, the rest carry on to be loaded.
+"""
+import collections
+import csv
+import itertools
+import re
+
+from loader import loading
+
+BATCH_SIZE = 100000  # Rows checked at a time.
+
+_VARCHAR = re.compile(r'^varchar2?\((\d+)\)$')
+
+
+def compile_checks(column):
+    """
+    Turn a Column's rules into checks.
+
+    :param column: Column obj, the column and its rules.
+    :return: lst[tuple], (reason, check) pairs, a check takes a Series of raw values, '' for a missing one, and returns a
+             boolean array, True where the value fails.
+    """
+    import pandas
+
+    checks = []
+    name = column.name
+    varchar = _VARCHAR.match(column.col_type or '')
+
+    parsed = {}
+
+    def numbers(values):
+        # The type and range checks of a column share one parse of each batch.
+        if parsed.get('values') is not values:
+            parsed['values'] = values
+            parsed['numbers'] = pandas.to_numeric(values, errors='coerce')
+
+        return parsed['numbers']
+
+    if column.required:
+        checks.append(('{} is missing'.format(name), lambda values: (values == '').values))
+
+    if column.col_type == 'number':
+        checks.append(('{} is not a number'.format(name),
+                       lambda values: ((values != '') & numbers(values).isnull()).values))
+    elif column.col_type == 'date':
+        checks.append(('{} is not a date'.format(name),
+                       lambda values: ((values != '') & pandas.to_datetime(values, errors='coerce').isnull()).values))
+    elif varchar:
+        longest = int(varchar.group(1))
+        checks.append(('{} is longer than {}'.format(name, longest),
+                       lambda values: (values.str.len() > longest).values))
+
+    # Comparisons with NaN are False, so values that aren't numbers are left to the type check.
+    if column.min_value is not None:
+        checks.append(('{} is below {}'.format(name, column.min_value),
+                       lambda values: (numbers(values) < column.min_value).values))
+
+    if column.max_value is not None:
+        checks.append(('{} is above {}'.format(name, column.max_value),
+                       lambda values: (numbers(values) > column.max_value).values))
+
+    if column.pattern:
+        pattern = re.compile('(?:{})\\Z'.format(column.pattern))
+        checks.append(('{} does not match {}'.format(name, column.pattern),
+                       lambda values: ((values != '') & ~values.str.match(pattern).astype(bool)).values))
+
+    allowed = column.get_allowed()
+
+    if allowed:
+        checks.append(('{} is not an allowed value'.format(name),
+                       lambda values: ((values != '') & ~values.isin(allowed)).values))
+
+    return checks
+
+
+class Validator(object):
+    """
+    The compiled checks for the columns of one file.
+    """
+
+    def __init__(self, width, checks):
+        """
+        :param width: int, number of columns the file has.
+        :param checks: dict, column index to its lst of (reason, check) pairs.
+        """
+        self.width = width
+        self.checks = {position: column_checks for position, column_checks in checks.items() if column_checks}
+
+    @classmethod
+    def for_file(cls, file):
+        """
+        :param file: File obj, the file.
+        :return: Validator, checks for every column of the file named after a Column.
+        """
+        return cls(file.reader().width, {position: compile_checks(column) for position, column in file.key_columns()})
+
+    def __bool__(self):
+        return bool(self.checks)
+
+    def check(self, batch):
+        """
+        Check a batch of rows.
+
+        :param batch: lst[lst[str]], the rows.
+        :return: tuple, (boolean array True for rows that failed, dict of index in the batch to its reasons).
+        """
+        import numpy
+        import pandas
+
+        widths = numpy.fromiter((len(row) for row in batch), dtype=numpy.int64, count=len(batch))
+        failed = widths > self.width
+        reasons = collections.defaultdict(list)
+
+        for idx in numpy.flatnonzero(failed):
+            reasons[idx].append('has {} fields, expected {}'.format(widths[idx], self.width))
+
+        for position, column_checks in self.checks.items():
+            values = pandas.Series([row[position] if position < len(row) else '' for row in batch], dtype=object)
+
+            for reason, check in column_checks:
+                failing = check(values)
+
+                for idx in numpy.flatnonzero(failing):
+                    reasons[idx].append(reason)
+
+                failed |= failing
+
+        return failed, reasons
+
+
+class Quarantine(object):
+    """
+    A reject file, the rows that failed validation with why.
+    """
+
+    def __init__(self, stream, header, delimiter=','):
+        """
+        :param stream: file obj, text stream to write to.
+        :param header: lst[str], the file's header.
+        :param delimiter: str, field delimiter.
+        """
+        self.writer = csv.writer(stream, delimiter=delimiter)
+        self.writer.writerow(['row', 'reasons'] + list(header))
+        self.count = 0
+
+    def add(self, row_number, reasons, row):
+        """
+        :param row_number: int, the row's index among the file's data rows.
+        :param reasons: lst[str], why it failed.
+        :param row: lst[str], its fields.
+        """
+        self.writer.writerow([row_number, '; '.join(reasons)] + list(row))
+        self.count += 1
+
+
+def checked_rows(rows, validator, quarantine, batch_size=BATCH_SIZE):
+    """
+    Pass on the rows that pass validation, sending the rest to quarantine.
+
+    :param rows: iterable, (row number, row) pairs in file order.
+    :param validator: Validator, the checks.
+    :param quarantine: Quarantine, where failing rows go.
+    :param batch_size: int, rows checked at a time.
+    :return: generator, (row number, row) pairs of the rows that passed.
+    """
+    for batch in loading.batches(rows, batch_size):
+        failed, reasons = validator.check([row for _, row in batch])
+
+        for idx in sorted(reasons):
+            quarantine.add(batch[idx][0], reasons[idx], batch[idx][1])
+
+        for pair in itertools.compress(batch, ~failed):
+            yield pair
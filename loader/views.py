@@ -1,16 +1,29 @@
-import codecs
-import csv
+import datetime
+import logging
+import os
 
+from django.conf import settings
 from django.contrib.auth import authenticate, login, logout
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.models import User
 from django.contrib.auth.views import password_change
 from django.core.urlresolvers import reverse
-from django.db.models.functions import Lower
-from django.shortcuts import render, redirect, Http404
+from django.http import FileResponse, HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, render, redirect, Http404
+from django.utils.dateparse import parse_date
+from django.utils.html import escape
 from django.views.generic import View, ListView, CreateView, UpdateView
+from loader import caching, exports, keyindex, metrics, pagination, profiling, readers
 from loader.forms import FileForm, ProcedureForm, ValidationError, LoginForm
-from loader.models import File, Column, Procedure, Feed
+from loader.models import File, Procedure, Feed, ProfileCapture
+
+logger = logging.getLogger(__name__)
+
+# Feed fields members may set on the feed pages. The inbox is a directory on the server, pruning deletes uploads and
+# the scheduling fields take turns and resources from other feeds, so only admins set those.
+FEED_FIELDS = ['name', 'users', 'block_on_drift', 'dedup', 'dedup_keep', 'compress_after', 'compression']
 
 
 def login_to_app(request):
@@ -44,6 +57,222 @@ def login_to_app(request):
     return render(request, 'login.html', {'form': form})
 
 
+def get_authorised_file(user, pk):
+    """
+    Fetch a file, making sure the user belongs to its feed.
+
+    :param user: User, the user asking for the file.
+    :param pk: int, pk of the file.
+    :return: File, the file with its feed loaded.
+    """
+    try:
+        file = File.objects.select_related('feed').get(pk=pk)
+    except File.DoesNotExist:
+        raise Http404('Sorry that file does not exist.')
+
+    if not file.feed.has_user(user):
+        raise Http404('Sorry you cannot access this file.')
+
+    return file
+
+
+def metrics_endpoint(request):
+    """
+    Serve stage timings in the Prometheus text format.
+
+    Scrapers authenticate with the LIONEL_METRICS_TOKEN bearer token when one is set, otherwise only staff can look.
+
+    :param request: HTTP request.
+    :return: HTTP response, the exposition text.
+    """
+    token = getattr(settings, 'LIONEL_METRICS_TOKEN', None)
+
+    if token:
+        if request.META.get('HTTP_AUTHORIZATION') != 'Bearer {}'.format(token):
+            return HttpResponse('Unauthorised', status=401, content_type='text/plain')
+    elif not request.user.is_staff:
+        return HttpResponse('Forbidden', status=403, content_type='text/plain')
+
+    return HttpResponse(metrics.prometheus_text(metrics.summarise(), metrics.totals()), content_type='text/plain; version=0.0.4')
+
+
+@staff_member_required
+def download_profile(request, pk):
+    """
+    Download the pstats dump of a profile capture.
+
+    :param request: HTTP request from a staff user.
+    :param pk: int, pk of the capture.
+    :return: HTTP response, the stats file.
+    """
+    profile = get_object_or_404(ProfileCapture, pk=pk)
+
+    response = FileResponse(profile.stats.open('rb'), content_type='application/octet-stream')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(os.path.basename(profile.stats.name))
+
+    return response
+
+
+def streamed_csv(chunks, filename, compress):
+    """
+    Build a streaming CSV download.
+
+    :param chunks: iterable, bytes of the CSV.
+    :param filename: str, name to save it as, without an extension.
+    :param compress: bool, gzip it on the fly?
+    :return: StreamingHttpResponse, the download.
+    """
+    if compress:
+        response = StreamingHttpResponse(exports.gzipped(chunks), content_type='application/gzip')
+        filename += '.csv.gz'
+    else:
+        response = StreamingHttpResponse(chunks, content_type='text/csv')
+        filename += '.csv'
+
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(filename)
+
+    return response
+
+
+def streamed_report(request, report):
+    """
+    Stream a report of rows dropped from a load.
+
+    :param request: HTTP request, gzip=1 in its GET parameters compresses the download.
+    :param report: FieldFile, the report.
+    :return: HTTP response, the CSV download.
+    """
+    def chunks():
+        with open(report.path, 'rb') as report_file:
+            for chunk in iter(lambda: report_file.read(1024 * 1024), b''):
+                yield chunk
+
+    name = os.path.splitext(os.path.basename(report.name))[0]
+
+    return streamed_csv(chunks(), name, request.GET.get('gzip') == '1')
+
+
+@login_required
+def export_rejects(request, pk):
+    """
+    Stream the rows of a file that failed validation when it was loaded, with the reasons they failed.
+
+    :param request: HTTP request.
+    :param pk: int, pk of the file.
+    :return: HTTP response, the CSV download.
+    """
+    file = get_authorised_file(request.user, pk)
+
+    if not file.rejects:
+        raise Http404('No rows of this file have been rejected.')
+
+    return streamed_report(request, file.rejects)
+
+
+@login_required
+def export_duplicates(request, pk):
+    """
+    Stream the rows of a file dropped as duplicates when it was loaded, with the rows kept in their place.
+
+    :param request: HTTP request.
+    :param pk: int, pk of the file.
+    :return: HTTP response, the CSV download.
+    """
+    file = get_authorised_file(request.user, pk)
+
+    if not file.duplicates:
+        raise Http404('No rows of this file have been dropped as duplicates.')
+
+    return streamed_report(request, file.duplicates)
+
+
+@login_required
+def export_table(request, pk):
+    """
+    Stream a file's loaded table as CSV.
+
+    GET parameters: columns, a comma separated projection; where, repeatable column:operator:value filters; gzip=1 to
+    compress.
+
+    :param request: HTTP request.
+    :param pk: int, pk of the file.
+    :return: HTTP response, the CSV download.
+    """
+    file = get_authorised_file(request.user, pk)
+
+    if not file.table:
+        raise Http404('This file has not been loaded into a table.')
+
+    available = exports.table_columns(file.table)
+
+    try:
+        columns = exports.parse_columns(request.GET.get('columns', ''), available)
+        filters = exports.parse_filters(request.GET.getlist('where'), available)
+    except exports.ExportError as error:
+        return HttpResponseBadRequest(str(error))
+
+    chunks = exports.csv_chunks(columns, exports.table_rows(file.table, columns, filters))
+
+    return streamed_csv(chunks, file.table, request.GET.get('gzip') == '1')
+
+
+@login_required
+def export_file(request, pk):
+    """
+    Stream a file's data as CSV, decompressed if it was uploaded compressed.
+
+    Takes the same GET parameters as export_table. Without a projection or filters the file is sent as it is.
+
+    :param request: HTTP request.
+    :param pk: int, pk of the file.
+    :return: HTTP response, the CSV download.
+    """
+    file = get_authorised_file(request.user, pk)
+    reader = file.reader()
+    available = exports.export_columns(reader)
+
+    try:
+        columns = exports.parse_columns(request.GET.get('columns', ''), available)
+        filters = exports.parse_filters(request.GET.getlist('where'), available)
+    except exports.ExportError as error:
+        return HttpResponseBadRequest(str(error))
+
+    if columns == available and not filters:
+        chunks = exports.raw_chunks(reader)
+    else:
+        chunks = exports.csv_chunks(columns, exports.file_rows(reader, columns, filters), reader.delimiter)
+
+    name = os.path.splitext(os.path.basename(file.data.name))[0]
+
+    return streamed_csv(chunks, name, request.GET.get('gzip') == '1')
+
+
+@login_required
+def key_lookup(request):
+    """
+    Find the uploads, in the user's feeds, holding a key in one of their special columns.
+
+    :param request: HTTP request, value is the key and column optionally limits it to one special column.
+    :return: HTTP response, the matching rows linked to their page of the preview.
+    """
+    value = request.GET.get('value', '').strip()
+    column = request.GET.get('column', '')
+    column = int(column) if column.isdigit() else None
+    matches = []
+
+    if value:
+        for index, row, offset in keyindex.search(value, Feed.user_feed_ids(request.user), column):
+            matches.append({'file': index.file,
+                            'column': index.column,
+                            'row': row + 1,
+                            'page': row // readers.PAGE_SIZE})
+
+    return render(request, 'lookup.html', {'value': value,
+                                           'column': column,
+                                           'columns': caching.special_column_choices(),
+                                           'matches': matches})
+
+
 def logout_of_app(request):
     """
     Basic view to logout a user. Redirects to the login screen.
@@ -73,19 +302,66 @@ class UserHomeView(LoginRequiredMixin, View):
 
 class FileListView(LoginRequiredMixin, ListView):
     """
-    Allow a user to view the feeds they have access to.
+    Allow a user to view the files they have uploaded, newest first.
+
+    Files can be filtered by feed and upload date, and are paged with a cursor so deep pages stay fast.
     """
-    model = Feed
+    model = File
     context_object_name = 'user_files'
     template_name = 'files.html'
+    ordering = ('-upload_date', '-pk')
+
+    def get_filters(self):
+        """
+        Read the feed and date range filters from the query string.
+
+        :return: dict, the feed pk and since/until dates, None where not given.
+        """
+        feed = self.request.GET.get('feed')
+
+        return {'feed': int(feed) if feed and feed.isdigit() else None,
+                'since': parse_date(self.request.GET.get('since') or ''),
+                'until': parse_date(self.request.GET.get('until') or '')}
 
     def get_queryset(self):
         """
-        Limit the feeds to the logged in user
+        Limit the files to the logged in user and the filters, then fetch one page.
 
-        :return: QuerySet, the feeds the user has access to.
+        :return: list, the files on this page.
+        """
+        filters = self.get_filters()
+        files = self.request.user.file_set.select_related('feed', 'user')
+
+        if filters['feed']:
+            files = files.filter(feed_id=filters['feed'])
+        if filters['since']:
+            files = files.filter(upload_date__gte=filters['since'])
+        if filters['until']:
+            files = files.filter(upload_date__lt=filters['until'] + datetime.timedelta(days=1))
+
+        page, self.next_cursor = pagination.keyset_page(files, self.ordering, self.request.GET.get('cursor'))
+
+        return page
+
+    def get_context_data(self, **kwargs):
         """
-        return self.request.user.file_set.all()
+        Add the filters and the next page link to the context.
+
+        :return: dict, context dict for the view.
+        """
+        ctx = super(FileListView, self).get_context_data(**kwargs)
+
+        query = self.request.GET.copy()
+        query.pop('cursor', None)
+
+        if self.next_cursor:
+            query['cursor'] = self.next_cursor
+            ctx['next_page'] = query.urlencode()
+
+        ctx['filters'] = self.get_filters()
+        ctx['feeds'] = self.request.user.feed_set.order_by('name')
+
+        return ctx
 
 
 class FeedListView(LoginRequiredMixin, ListView):
@@ -95,14 +371,30 @@ class FeedListView(LoginRequiredMixin, ListView):
     model = Feed
     context_object_name = 'user_feeds'
     template_name = 'feeds.html'
+    ordering = ('name',)
 
     def get_queryset(self):
         """
-        Limit the feeds to the logged in user
+        Limit the feeds to the logged in user, one page at a time.
 
-        :return: QuerySet, the feeds the user has access to.
+        :return: list, the feeds on this page.
         """
-        return self.request.user.feed_set.all()
+        page, self.next_cursor = pagination.keyset_page(self.request.user.feed_set.all(),
+                                                        self.ordering,
+                                                        self.request.GET.get('cursor'))
+
+        return page
+
+    def get_context_data(self, **kwargs):
+        """
+        Add the next page link to the context.
+
+        :return: dict, context dict for the view.
+        """
+        ctx = super(FeedListView, self).get_context_data(**kwargs)
+        ctx['next_cursor'] = self.next_cursor
+
+        return ctx
 
 
 class UserUpdate(LoginRequiredMixin, UpdateView):
@@ -146,7 +438,7 @@ class FeedCreate(LoginRequiredMixin, CreateView):
     Manage Feed creation.
     """
     model = Feed
-    fields = '__all__'
+    fields = FEED_FIELDS
     template_name = 'feed_create_form.html'
 
     def get_success_url(self):
@@ -163,21 +455,33 @@ class FeedUpdate(LoginRequiredMixin, UpdateView):
     Manage feed updates
     """
     model = Feed
-    fields = '__all__'
+    fields = FEED_FIELDS
     template_name = 'feed_update_form.html'
 
-    def get(self, *args, **kwargs):
+    def get_object(self, queryset=None):
         """
-        Ensure that the person accessing this feed is allowed access.
+        Ensure that the person accessing this feed is allowed access, for both viewing and updating.
 
-        :return: Http response, 404 or successful feed update form.
+        :return: Feed, the feed being updated.
         """
-        feed = Feed.objects.get(pk=kwargs['pk'])
+        feed = super(FeedUpdate, self).get_object(queryset)
 
-        if self.request.user in feed.users.all():
-            return super(FeedUpdate, self).get(*args, **kwargs)
-        else:
-            return Http404('Sorry you cannot access this feed.')
+        if not feed.has_user(self.request.user):
+            raise Http404('Sorry you cannot access this feed.')
+
+        return feed
+
+    def get_context_data(self, **kwargs):
+        """
+        Add the drift history of this feed to the context.
+
+        :return: dict, context dict for the view.
+        """
+        ctx = super(FeedUpdate, self).get_context_data(**kwargs)
+
+        ctx['drifts'] = self.object.schemadrift_set.select_related('file').order_by('-detected')
+
+        return ctx
 
     def get_success_url(self):
         """
@@ -274,13 +578,23 @@ class ProcedureUpdate(LoginRequiredMixin, UpdateView):
         return reverse('loader:update_proc', kwargs={'pk': self.object.id})
 
 
-class LoadFileView(LoginRequiredMixin, View):
+class LoadFileView(LoginRequiredMixin, profiling.ProfiledViewMixin, View):
     """
     Handle the file loading views here.
     """
     FORM_CLASS = FileForm
     MODEL = File
 
+    def get_profile_feed(self, request, *args, **kwargs):
+        """
+        Let profile switches match on the feed being uploaded to.
+
+        :return: Feed or None, the feed picked in the form.
+        """
+        feed = request.POST.get('feed', '')
+
+        return Feed.objects.filter(pk=feed).first() if feed.isdigit() else None
+
     def get(self, request, *args, **kwargs):
         """
         Load up the file uploader form.
@@ -302,74 +616,110 @@ class LoadFileView(LoginRequiredMixin, View):
         form = self.FORM_CLASS(request.user, request.POST, request.FILES)
 
         if form.is_valid():
-            new_upload = self.MODEL(**form.cleaned_data)
-            new_upload.save()
-            new_upload.get_table_info()
+            with metrics.stage('upload', feed=form.cleaned_data['feed']) as timer:
+                new_upload = self.MODEL(**form.cleaned_data)
+                new_upload.save()
+                new_upload.set_checksum()
+                timer.file = new_upload
+                timer.bytes = new_upload.data.size
+
+            new_upload.analyse()
             new_upload.save()
 
+            if new_upload.accepted:
+                new_upload.build_key_indexes()
+
             return redirect('loader:view_file', new_upload.pk)
 
         return render(request, 'loader.html', {'form': form})
 
 
-class FileView(LoginRequiredMixin, View):
+class FileView(LoginRequiredMixin, profiling.ProfiledViewMixin, View):
     """
     A table based view for a file we are loading.
     """
+    def get_profile_feed(self, request, pk, *args, **kwargs):
+        """
+        Let profile switches match on the feed of the file being viewed.
+
+        :return: Feed or None, the file's feed.
+        """
+        return Feed.objects.filter(file__pk=pk).first()
+
     def get(self, request, pk, *args, **kwargs):
         """
         Parse the file and load on screen.
 
+        The view GET parameter picks between the head of the file and the sample taken at upload.
+
         :param request: HTTP request.
         :param file_pk: pk of the file we need to load into the view.
         :return: HTTP response, the loaded table
         """
-        file_to_load = File.objects.get(pk=pk)
+        file_to_load = get_authorised_file(request.user, pk)
 
-        special_cols = Column.objects.all().order_by(Lower('name'))
-        data_file = file_to_load.data.file
-        reader = csv.reader(codecs.iterdecode(data_file, 'utf-8-sig'), delimiter=file_to_load.delimiter)
-        data = []
-        row_num = 0
-        if file_to_load.has_header:
-            header = next(reader)
-            no_cols = len(header)
-        else:
-            data.append(next(reader))
-            header = ['']*len(data[0])
-            row_num += 1
-            no_cols = len(data[0])
+        view = request.GET.get('view', 'head')
+        if view != 'sample' or not file_to_load.sample:
+            view = 'head'
 
-        choices = ""
-        for col in special_cols:
-            choices += '<option value="{pk}">{name}</option>\n'.format(pk=col.pk, name=col.name)
+        try:
+            page = max(int(request.GET.get('page', 0)), 0)
+        except ValueError:
+            page = 0
 
-        template_choice = """<input name="col_select_{col_num}" type="text" value="{header}">"""
-        """
+        special_cols = caching.special_column_choices()
+
+        def build_context():
+            """
+            Read the file and build the preview table, only needed when it isn't cached.
+
+            :return: dict, context for the preview template.
+            """
+            reader = file_to_load.reader()
+            header = reader.header or ['']*reader.width
+
+            choices = ''.join('<option value="{pk}">{name}</option>\n'.format(pk=col_pk, name=escape(name))
+                              for col_pk, name in special_cols)
+
+            template_choice = """<input name="col_select_{col_num}" type="text" value="{header}">"""
+            """
 <select class="form-control" name="col_select_{col_num}">
     <option value selected disabled>Special Column</option>
     <option value="None">None</option>
     {choices}
 </select>"""
 
-        column_choice_row = []
-        for idx in range(no_cols):
-            if header:
-                column_choice_row.append(template_choice.format(col_num=idx, choices=choices, header=header[idx]))
+            column_choice_row = [template_choice.format(col_num=idx, choices=choices, header=escape(col))
+                                 for idx, col in enumerate(header)]
+
+            if view == 'sample':
+                data = [values for _, values in file_to_load.get_sample()]
+            else:
+                data = reader.page(page)
+
+            return {'data': data,
+                    'column_choice': column_choice_row,
+                    'header': header,
+                    'page': page,
+                    'page_count': reader.page_count(),
+                    'view': view}
 
-        for row in reader:
-            data.append(row)
-            row_num += 1
-            if row_num >= 10:
-                break
+        def timed_context():
+            """
+            Build the context as a timed stage, so only previews which read the file record a metric.
 
-        procedures = Procedure.objects.all()
+            :return: dict, context for the preview template.
+            """
+            with metrics.stage('preview', file=file_to_load):
+                return build_context()
 
-        return render(request, 'table.html', {'data': data,
-                                              'column_choice': column_choice_row,
+        preview = caching.render_preview(file_to_load, view, page, timed_context)
+
+        return render(request, 'table.html', {'preview': preview,
                                               'columns': special_cols,
-                                              'header': header,
-                                              'procedures': procedures,
+                                              'procedures': caching.procedure_choices(),
+                                              'drift': caching.file_drift(file_to_load),
+                                              'view': view,
                                               'file': file_to_load})
 
     def post(self, request, pk, *args, **kwargs):
@@ -380,7 +730,7 @@ class FileView(LoginRequiredMixin, View):
         :param file_pk: pk of the file we need to load into the view.
         :return: HTTP response, the loaded table
         """
-        print(request.POST.get('column_num_0'))
+        logger.debug('Running a procedure on file %s with %s', pk, request.POST.get('column_num_0'))
         proc_pk = request.POST.get('procedure')
 
         if proc_pk:
@@ -388,17 +738,28 @@ class FileView(LoginRequiredMixin, View):
         else:
             raise ValidationError('You need to select a procedure to run.')
 
-        file_to_run = File.objects.get(pk=pk)
+        file_to_run = get_authorised_file(request.user, pk)
+
+        if not file_to_run.accepted:
+            # The page already says the file is blocked by drift, show it again rather than running anything.
+            response = self.get(request, pk, *args, **kwargs)
+            response.status_code = 409
 
-        no_cols = len(file_to_run.get_first_lines(1)[0].split(file_to_run.delimiter))
+            return response
+
+        no_cols = file_to_run.reader().width
 
         cols = self.get_columns(request.POST, no_cols)
+        renamed = cols != file_to_run.get_columns()
 
         file_to_run.set_columns(cols)
 
         file_to_run.save()
 
-        output = proc.run(file_to_run)
+        if renamed:  # The special columns may have changed.
+            file_to_run.build_key_indexes()
+
+        output = proc.run(file_to_run, force=bool(request.POST.get('force')))
 
         return self.get(request, pk, *args, **kwargs)
 